@@ -1,36 +1,37 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 import uuid
-from app.models.chat import Chat
+import json
+import time
 from app.models.visitor import Visitor
 # from app.schemas.chat import ChatCreate, ChatOut
-from app.core.database import get_db
+from app.api.deps import get_db
 from datetime import datetime, timedelta
 # from typing import List
 from pydantic import BaseModel
 from app.services.qdrant_service import search_similar_vectors
 # from app.services.openai_service import generate_reply
-from sqlalchemy.orm import Session
-from app.db.session import SessionLocal
+from app.services.chat_writer import chat_writer
+from app.services.session_cache import session_cache, CachedSession
+from app.core.config import get_settings
 from app.models.visitor import Visitor
 from app.models.visitor_session import VisitorSession
 from app.models.chatbot import Chatbot
+from app.services.admission import AdmissionRejected
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
+SESSION_TTL = timedelta(seconds=get_settings().SESSION_TTL_SECONDS)
+
 class MessageIn(BaseModel):
     visitor_anonymous_id: str | None = None
     session_id: int | None = None
     message: str
     context: list[dict] | None = []
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 # @router.post("/{chatbot_id}/message")
 # def send_message(chatbot_id: int, payload: MessageIn, db: Session = Depends(get_db)):
 #     # locate chatbot
@@ -101,43 +102,225 @@ def get_db():
 #     except Exception as e:
 #         raise HTTPException(status_code=500, detail=str(e))
 
-from app.services.ollama_service import generate_reply
+from app.services.ollama_service import generate_reply, open_reply_stream
+
+
+def _cached_session(chatbot_id: int, payload: MessageIn) -> CachedSession | None:
+    if payload.session_id:
+        return session_cache.by_id(payload.session_id, chatbot_id)
+    if payload.visitor_anonymous_id:
+        return session_cache.by_visitor(chatbot_id, payload.visitor_anonymous_id)
+    return None
 
-@router.post("/{chatbot_id}/message")
-async def send_message(chatbot_id: int, payload: MessageIn, db: Session = Depends(get_db)):
-    # Locate chatbot
-    chatbot = db.get(Chatbot, chatbot_id)
-    if not chatbot:
-        raise HTTPException(404, "Chatbot not found")
 
+_SESSION_COLUMNS = (VisitorSession.id, VisitorSession.visitor_id, VisitorSession.expires_at, Visitor.anonymous_id)
+
+
+async def _find_session(chatbot_id: int, payload: MessageIn, db: AsyncSession) -> CachedSession | None:
+    # an active session named by session_id, else the visitor's latest active one for this chatbot
+    now = datetime.utcnow()
+    active = (VisitorSession.chatbot_id == chatbot_id) & (
+        VisitorSession.expires_at.is_(None) | (VisitorSession.expires_at > now)
+    )
+    query = select(*_SESSION_COLUMNS).join(Visitor, Visitor.id == VisitorSession.visitor_id).where(active)
+    if payload.session_id:
+        query = query.where(VisitorSession.id == payload.session_id)
+    elif payload.visitor_anonymous_id:
+        query = query.where(Visitor.anonymous_id == payload.visitor_anonymous_id).order_by(VisitorSession.started_at.desc())
     else:
+        return None
+    row = (await db.execute(query.limit(1))).first()
+    if row is None:
+        return None
+    return CachedSession(id=row.id, visitor_id=row.visitor_id, chatbot_id=chatbot_id, anonymous_id=row.anonymous_id, expires_at=row.expires_at)
+
+
+async def _create_session(chatbot_id: int, payload: MessageIn, db: AsyncSession) -> CachedSession:
+    visitor = None
+    if payload.visitor_anonymous_id:
+        result = await db.execute(select(Visitor).where(Visitor.anonymous_id == payload.visitor_anonymous_id))
+        visitor = result.scalar_one_or_none()
+    if visitor is None:
         visitor = Visitor(anonymous_id=payload.visitor_anonymous_id or "anon-" + str(uuid.uuid4()))
         db.add(visitor)
-        db.commit()
-        db.refresh(visitor)
-        session = VisitorSession(visitor_id=visitor.id, chatbot_id=chatbot_id)
-        db.add(session)
-        db.commit()
-        db.refresh(session)
-
-    # Save visitor message
-    chat = Chat(visitor_session_id=session.id, chatbot_id=chatbot_id, role="visitor", message=payload.message)
-    db.add(chat)
-    db.commit()
-    db.refresh(chat)
+        await db.flush()  # assigns visitor.id
 
-    # 🧠 Generate bot reply via Ollama + Qdrant
+    session = VisitorSession(visitor_id=visitor.id, chatbot_id=chatbot_id, expires_at=datetime.utcnow() + SESSION_TTL)
+    db.add(session)
+    await db.commit()  # the session id is handed to the client, so it must exist now
+    return CachedSession(
+        id=session.id, visitor_id=visitor.id, chatbot_id=chatbot_id,
+        anonymous_id=visitor.anonymous_id, expires_at=session.expires_at,
+    )
+
+
+async def _extend_session(session: CachedSession, db: AsyncSession):
+    # sliding expiry, written at most once per half TTL instead of on every message
+    now = datetime.utcnow()
+    if session.expires_at is None or session.expires_at - now > SESSION_TTL / 2:
+        return
+    expires_at = now + SESSION_TTL
+    await db.execute(update(VisitorSession).where(VisitorSession.id == session.id).values(expires_at=expires_at))
+    await db.commit()
+    session.expires_at = expires_at
+
+
+async def _resolve_session(chatbot_id: int, payload: MessageIn, db: AsyncSession) -> CachedSession:
+    """
+    The conversation's session: from the in-process cache (no database round-trip), else
+    looked up by session_id / visitor_anonymous_id, else newly created.
+    """
+    session = _cached_session(chatbot_id, payload)
+    if session is None:
+        # Locate chatbot (a cached session implies it existed; deleting it clears the cache)
+        chatbot = await db.get(Chatbot, chatbot_id)
+        if not chatbot:
+            raise HTTPException(404, "Chatbot not found")
+        session = await _find_session(chatbot_id, payload, db) or await _create_session(chatbot_id, payload, db)
+        session_cache.put(session)
+    await _extend_session(session, db)
+    return session
+
+
+async def _start_visitor_turn(chatbot_id: int, payload: MessageIn, db: AsyncSession) -> tuple[CachedSession, datetime]:
+    session = await _resolve_session(chatbot_id, payload, db)
+    # don't sit on a pooled connection while the model works
+    await db.close()
+    return session, datetime.utcnow()
+
+
+def _save_visitor_message(session_id: int, chatbot_id: int, message: str, asked_at: datetime):
+    # write-behind, and only once the turn was admitted: a 429 / 503 leaves no half turn behind
+    chat_writer.enqueue(session_id, chatbot_id, "visitor", message, created_at=asked_at)
+
+
+def _save_bot_reply(session_id: int, chatbot_id: int, bot_text: str):
+    # write-behind: the reply doesn't wait for the transcript to reach the database
+    chat_writer.enqueue(session_id, chatbot_id, "bot", bot_text)
+
+
+def _rejected(e: AdmissionRejected) -> HTTPException:
+    # no generation slot: 429 / 503 with Retry-After right away
+    return HTTPException(e.status_code, e.detail, headers=e.headers)
+
+
+def _session_key(chatbot_id, session_id: int | None = None, payload: MessageIn | None = None) -> str | None:
+    """
+    Same conversation -> same Ollama backend (its KV cache holds the previous turns).
+    Keyed on the resolved session, so a conversation's first turn lands where its follow-ups
+    will; without a session the visitor id is used. With neither there is nothing worth
+    keeping warm and the least-loaded backend is used.
+    """
+    if session_id is not None:
+        return f"{chatbot_id}:session:{session_id}"
+    if payload is not None and payload.visitor_anonymous_id:
+        return f"{chatbot_id}:visitor:{payload.visitor_anonymous_id}"
+    return None
+
+
+async def _failed_stream(error: Exception):
+    # retrieval / prompt building failed before any token: surface it as the stream's error event
+    raise error
+    yield
+
+
+def _stream_event(fmt: str, event: str, data: dict) -> str:
+    if fmt == "ndjson":
+        return json.dumps({"type": event, **data}) + "\n"
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _streaming_reply(tokens, fmt: str, done_extra: dict, on_complete=None, slot=None) -> StreamingResponse:
+    """
+    Forward tokens as Server-Sent Events (default) or NDJSON (?format=ndjson).
+    The full text is handed to on_complete once the stream finishes.
+    The generation slot (if any) is released as soon as the model is done.
+    """
+    async def body():
+        started = time.perf_counter()
+        ttft_ms = None
+        parts = []
+        try:
+            async for token in tokens:
+                if ttft_ms is None:
+                    ttft_ms = round((time.perf_counter() - started) * 1000, 1)
+                parts.append(token)
+                yield _stream_event(fmt, "token", {"token": token})
+        except Exception as e:
+            parts.append(f"⚠️ Local AI error: {str(e)}")
+            yield _stream_event(fmt, "error", {"error": str(e)})
+        finally:
+            if slot is not None:
+                slot.release()
+
+        reply = "".join(parts)
+        if on_complete is not None:
+            on_complete(reply)
+        yield _stream_event(fmt, "done", {"reply": reply, "ttft_ms": ttft_ms, **done_extra})
+
+    media_type = "application/x-ndjson" if fmt == "ndjson" else "text/event-stream"
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # releases the slot if the body never ran (client gone before the first byte)
+        background=BackgroundTask(slot.release) if slot is not None else None,
+    )
+
+
+@router.post("/{chatbot_id}/message")
+async def send_message(chatbot_id: int, payload: MessageIn, db: AsyncSession = Depends(get_db)):
+    session, asked_at = await _start_visitor_turn(chatbot_id, payload, db)
+
+    # 🧠 Generate bot reply via Ollama + Qdrant (or the semantic answer cache)
+    info = {"cache_hit": False}
     try:
-        bot_text = await generate_reply(payload.message, chatbot_id)
+        bot_text = await generate_reply(
+            payload.message, chatbot_id, history=payload.context, info=info,
+            session_key=_session_key(chatbot_id, session.id),
+        )
+    except AdmissionRejected as e:
+        raise _rejected(e)
     except Exception as e:
         bot_text = f"⚠️ Local AI error: {str(e)}"
 
-    # Save bot reply
-    bot_chat = Chat(visitor_session_id=session.id, chatbot_id=chatbot_id, role="bot", message=bot_text)
-    db.add(bot_chat)
-    db.commit()
+    # Save the turn
+    _save_visitor_message(session.id, chatbot_id, payload.message, asked_at)
+    _save_bot_reply(session.id, chatbot_id, bot_text)
+
+    return {"reply": bot_text, "session_id": session.id, **info}
+
 
-    return {"reply": bot_text, "session_id": session.id}
+@router.post("/{chatbot_id}/message/stream")
+async def send_message_stream(
+    chatbot_id: int,
+    payload: MessageIn,
+    format: str = Query("sse", pattern="^(sse|ndjson)$"),
+    db: AsyncSession = Depends(get_db),
+):
+    session, asked_at = await _start_visitor_turn(chatbot_id, payload, db)
+    session_id = session.id
+
+    # cache_hit / prompt_tokens are set by now; the stream adds prefill before the final "done" event
+    done_extra = {"session_id": session_id, "cache_hit": False}
+    try:
+        tokens, slot = await open_reply_stream(
+            payload.message, chatbot_id, history=payload.context, info=done_extra,
+            session_key=_session_key(chatbot_id, session_id),
+        )
+    except AdmissionRejected as e:
+        raise _rejected(e)
+    except Exception as e:
+        tokens, slot = _failed_stream(e), None
+    _save_visitor_message(session_id, chatbot_id, payload.message, asked_at)
+
+    return _streaming_reply(
+        tokens,
+        format,
+        done_extra,
+        on_complete=lambda reply: _save_bot_reply(session_id, chatbot_id, reply),
+        slot=slot,
+    )
 
 
 
@@ -148,12 +331,37 @@ async def send_message(chatbot_id: str, payload: MessageIn):
     
 
     # 🧠 Generate bot reply via Ollama + Qdrant
+    info = {"cache_hit": False}
     try:
-        bot_text = await generate_reply(payload.message, chatbot_id, history = payload.context)
+        bot_text = await generate_reply(
+            payload.message, chatbot_id, history = payload.context, info=info,
+            session_key=_session_key(chatbot_id, payload.session_id, payload),
+        )
+    except AdmissionRejected as e:
+        raise _rejected(e)
     except Exception as e:
         import traceback
         traceback.print_exc()   # <-- add this
         bot_text = f"⚠️ Local AI error: {str(e)}"
 
 
-    return {"reply": bot_text}
+    return {"reply": bot_text, **info}
+
+
+@router.post("/{chatbot_id}/ollamaTesting/stream")
+async def send_message_testing_stream(
+    chatbot_id: str,
+    payload: MessageIn,
+    format: str = Query("sse", pattern="^(sse|ndjson)$"),
+):
+    done_extra = {"cache_hit": False}
+    try:
+        tokens, slot = await open_reply_stream(
+            payload.message, chatbot_id, history=payload.context, info=done_extra,
+            session_key=_session_key(chatbot_id, payload.session_id, payload),
+        )
+    except AdmissionRejected as e:
+        raise _rejected(e)
+    except Exception as e:
+        tokens, slot = _failed_stream(e), None
+    return _streaming_reply(tokens, format, done_extra, slot=slot)
@@ -1,41 +1,32 @@
 # app/api/api_v1/routes/chatbot.py
-from typing import List, Generator, Optional
+from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile, status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db.session import SessionLocal
+from app.api.deps import get_db
 from app.schemas.chatbot import ChatbotCreate, ChatbotRead, ChatbotUpdate, ChatbotOut
 from app.models.chatbot import Chatbot
 from app.models.company import Company
 
 # service functions that integrate LangChain + Qdrant; implemented in app.services.chatbot_service
-from app.services.chatbot_service import (
-    train_chatbot_from_files,
-    train_chatbot_from_url,
-    query_chatbot,
-)
+from app.services.chatbot_service import query_chatbot
+from app.services.admission import AdmissionRejected
+from app.services.answer_cache import invalidate_chatbot_answers
+from app.services.session_cache import session_cache
+from app.services.ingestion_jobs import submit_files_job, submit_url_job, get_job_status, cancel_job
+from app.services.vector_placement import LAYOUTS, start_migration, placement_info
 
 router = APIRouter(prefix="/chatbot", tags=["chatbot"])
 
 
-def get_db() -> Generator[Session, None, None]:
-    """
-    Simple DB dependency using your SessionLocal factory.
-    """
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
 #
 # CRUD for Chatbots
 #
 @router.post("/create")
-def create_chatbot(payload: ChatbotCreate, db: Session = Depends(get_db)):
-    company = db.query(Company).filter(Company.id == payload.company_id).first()
+async def create_chatbot(payload: ChatbotCreate, db: AsyncSession = Depends(get_db)):
+    company = await db.get(Company, payload.company_id)
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
 
@@ -45,32 +36,34 @@ def create_chatbot(payload: ChatbotCreate, db: Session = Depends(get_db)):
         company_id=payload.company_id,
     )
     db.add(bot)
-    db.commit()
-    db.refresh(bot)
+    await db.commit()
+    await db.refresh(bot)
     return bot
 
 
 @router.get("/", response_model=List[ChatbotOut])
-def list_chatbots(db: Session = Depends(get_db)):
-    return db.query(Chatbot).all()
+async def list_chatbots(db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(Chatbot))
+    return result.scalars().all()
 
 
 @router.get("/company/{company_id}", response_model=List[ChatbotOut])
-def list_company_chatbots(company_id: int, db: Session = Depends(get_db)):
-    return db.query(Chatbot).filter(Chatbot.company_id == company_id).all()
+async def list_company_chatbots(company_id: int, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(Chatbot).where(Chatbot.company_id == company_id))
+    return result.scalars().all()
 
 
 @router.get("/{chatbot_id}", response_model=ChatbotOut)
-def read_chatbot(chatbot_id: int, db: Session = Depends(get_db)):
-    bot = db.query(Chatbot).filter(Chatbot.id == chatbot_id).first()
+async def read_chatbot(chatbot_id: int, db: AsyncSession = Depends(get_db)):
+    bot = await db.get(Chatbot, chatbot_id)
     if not bot:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chatbot not found")
     return bot
 
 
 @router.put("/{chatbot_id}", response_model=ChatbotOut)
-def update_chatbot(chatbot_id: int, data: ChatbotUpdate, db: Session = Depends(get_db)):
-    bot = db.query(Chatbot).filter(Chatbot.id == chatbot_id).first()
+async def update_chatbot(chatbot_id: int, data: ChatbotUpdate, db: AsyncSession = Depends(get_db)):
+    bot = await db.get(Chatbot, chatbot_id)
     if not bot:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chatbot not found")
 
@@ -79,50 +72,95 @@ def update_chatbot(chatbot_id: int, data: ChatbotUpdate, db: Session = Depends(g
     if data.description is not None:
         bot.description = data.description
 
-    db.commit()
-    db.refresh(bot)
+    await db.commit()
+    await db.refresh(bot)
     return bot
 
 
 @router.delete("/{chatbot_id}", status_code=status.HTTP_200_OK)
-def delete_chatbot(chatbot_id: int, db: Session = Depends(get_db)):
-    bot = db.query(Chatbot).filter(Chatbot.id == chatbot_id).first()
+async def delete_chatbot(chatbot_id: int, db: AsyncSession = Depends(get_db)):
+    bot = await db.get(Chatbot, chatbot_id)
     if not bot:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chatbot not found")
-    db.delete(bot)
-    db.commit()
+    await db.delete(bot)  # loads the cascaded sessions / chats inside the async session
+    await db.commit()
+    await invalidate_chatbot_answers(chatbot_id)
+    session_cache.invalidate_chatbot(chatbot_id)
     return {"message": "Chatbot deleted successfully"}
 
 
 #
 # Training endpoints
 #
-@router.post("/train-files")
+async def _check_training_target(db: AsyncSession, company_id: int, chatbot_id: int):
+    # validated before anything is spooled, so a bad id is a 404 instead of an FK error
+    if not await db.get(Company, company_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Company not found")
+    bot = await db.get(Chatbot, chatbot_id)
+    if not bot or bot.company_id != company_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chatbot not found")
+
+
+@router.post("/train-files", status_code=status.HTTP_202_ACCEPTED)
 async def train_chatbot_files(
     company_id: int = Form(...),
     chatbot_id: int = Form(...),
-    files: List[UploadFile] = File(...)
+    files: List[UploadFile] = File(...),
+    db: AsyncSession = Depends(get_db),
 ):
-    # read bytes from UploadFile list
-    file_pairs = []
-    for up in files:
-        content = await up.read()
-        file_pairs.append((up.filename, content))
-    return await train_chatbot_from_files(company_id, chatbot_id, file_pairs)
+    await _check_training_target(db, company_id, chatbot_id)
+    # uploads are spooled to disk and indexed by a background worker
+    job_id = await submit_files_job(company_id, chatbot_id, files)
+    return {"job_id": job_id, "status": "queued", "message": f"Training job {job_id} queued"}
 
 
-@router.post("/train-url")
+@router.post("/train-url", status_code=status.HTTP_202_ACCEPTED)
 async def train_chatbot_url(
     company_id: int = Form(...),
     chatbot_id: int = Form(...),
-    file_pairs: str = Form(...)
+    file_pairs: str = Form(...),
+    db: AsyncSession = Depends(get_db),
 ):
-    # read bytes from UploadFile list
-    # file_pairs = []
-    # for up in files:
-    #     content = await up.read()
-    #     file_pairs.append((up.filename, content))
-    return await train_chatbot_from_url(company_id, chatbot_id, file_pairs)
+    await _check_training_target(db, company_id, chatbot_id)
+    # file_pairs carries the url to crawl
+    job_id = await submit_url_job(company_id, chatbot_id, file_pairs)
+    return {"job_id": job_id, "status": "queued", "message": f"Training job {job_id} queued"}
+
+
+#
+# Training job status
+#
+@router.get("/jobs/{job_id}")
+async def training_job_status(job_id: str):
+    job = await get_job_status(job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_training_job(job_id: str):
+    job = await cancel_job(job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+
+#
+# Vector placement (shared collection vs dedicated chatbot_{id} collection)
+#
+@router.get("/{chatbot_id}/placement")
+async def chatbot_placement(chatbot_id: int):
+    return await placement_info(chatbot_id)
+
+
+@router.post("/{chatbot_id}/placement", status_code=status.HTTP_202_ACCEPTED)
+async def move_chatbot_placement(chatbot_id: int, layout: str = Form(...)):
+    if layout not in LAYOUTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"layout must be one of {LAYOUTS}")
+    # online move: the bot keeps answering from its current layout until the flip
+    start_migration(chatbot_id, layout)
+    return {"chatbot_id": chatbot_id, "target_layout": layout, "message": "Migration started"}
 
 
 #
@@ -138,7 +176,10 @@ async def query_chatbot_route(
     """
     Query chatbot by ID (with company_id + query passed in form).
     """
-    response = await query_chatbot(company_id, chatbot_id, query)
+    try:
+        response = await query_chatbot(company_id, chatbot_id, query)
+    except AdmissionRejected as e:
+        raise HTTPException(e.status_code, e.detail, headers=e.headers)
     if not response:
         raise HTTPException(status_code=404, detail="Chatbot not found")
     return response
@@ -3,7 +3,7 @@ from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 from fastapi import Form
 
-from app.db.session import SessionLocal
+from app.api.deps import get_sync_db as get_db
 from app.models.company import Company
 from app.schemas.company import CompanyCreate, CompanyRead, CompanyLogin
 
@@ -11,13 +11,6 @@ router = APIRouter(prefix="/company", tags=["company"])
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -1,44 +1,44 @@
 # app/api/upload_routes.py
 from fastapi import APIRouter, HTTPException
-from qdrant_client.models import PointStruct
-from app.services.qdrant_service import qdrant, EMBED_MODEL, COLLECTION_NAME
-import uuid
 from app.models.chatbot import Chatbot
 
 router = APIRouter(prefix="/upload", tags=["upload"])
-import tempfile
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from pdfminer.high_level import extract_text
-from qdrant_client.http.models import PointStruct
-import uuid, os
-from app.db.session import SessionLocal
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.api.deps import get_db
+from app.services.pdf_ingestion import (
+    spool_upload_to_disk,
+    ingest_pages,
+    remove_quietly,
+)
+from app.services.parsing_executor import run_in_parse_pool, iter_pdf_pages_parallel
+from app.services.document_parsers import extract_pdf_text_pdfminer
+from app.utils.memory import RssTracker
 
 
 router = APIRouter()
 
-def get_db():
-    db = SessionLocal()
-    try:
-        return db
-    finally:
-        db.close()
-
 
-def extract_pdf_text(file_path: str) -> str:
+async def extract_pdf_text(file_path: str, tracker: RssTracker = None) -> str:
     try:
-        return extract_text(file_path)
+        return await run_in_parse_pool(extract_pdf_text_pdfminer, file_path, tracker=tracker)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"PDF extraction failed: {e}")
 
 
+async def _whole_document(file_path: str, tracker: RssTracker = None):
+    # legacy "full" mode: one giant page
+    yield await extract_pdf_text(file_path, tracker)
+
+
 @router.post("/upload")
 async def upload_pdf(
     companyId: str = Form(...),   # <-- accept string
     chatName: str = Form(...),    # <-- accept string
     file: UploadFile = File(...),
+    mode: str = Form("stream"),   # "stream" = page by page, "full" = legacy whole-document extract
+    db: AsyncSession = Depends(get_db),
 ):
-    db: Session = get_db()
 
     # Convert ID to integer safely
     try:
@@ -46,9 +46,17 @@ async def upload_pdf(
     except:
         raise HTTPException(status_code=400, detail="companyId must be an integer")
 
+    if mode not in ("stream", "full"):
+        raise HTTPException(status_code=400, detail="mode must be 'stream' or 'full'")
+
+    # --- PDF FILE VALIDATION ---
+    filename = file.filename.lower()
+    if not filename.endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Only PDF files allowed")
+
     # 1️⃣ Validate company exists
     from app.models.company import Company
-    company = db.query(Company).filter(Company.id == company_id_int).first()
+    company = await db.get(Company, company_id_int)
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
 
@@ -59,69 +67,37 @@ async def upload_pdf(
         company_id=company_id_int,
     )
     db.add(new_chatbot)
-    db.commit()
-    db.refresh(new_chatbot)
+    await db.commit()
+    await db.refresh(new_chatbot)
 
     chatbot_id = new_chatbot.id
+    # ingestion can take minutes: don't hold a pooled connection through it
+    await db.close()
 
-    # --- PDF FILE VALIDATION ---
-    filename = file.filename.lower()
-    if not filename.endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="Only PDF files allowed")
-
-    temp_dir = tempfile.gettempdir()
-    temp_path = os.path.join(temp_dir, f"{uuid.uuid4()}.pdf")
-
-    with open(temp_path, "wb") as f:
-        f.write(await file.read())
-
-    text = extract_pdf_text(temp_path)
+    # 3️⃣ Spool to disk in fixed-size pieces, then chunk / embed / upsert page by page
+    temp_path = await spool_upload_to_disk(file)
+    tracker = RssTracker()  # parent RSS + the parse workers' peaks
+    try:
+        if mode == "stream":
+            pages = iter_pdf_pages_parallel(temp_path, tracker=tracker)
+        else:
+            pages = _whole_document(temp_path, tracker)
+        try:
+            report = await ingest_pages(pages, company_id_int, chatbot_id, chatName, file.filename, tracker=tracker)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"PDF extraction failed: {e}")
+    finally:
+        remove_quietly(temp_path)
 
-    if not text.strip():
+    if not report["chunks_stored"]:
         raise HTTPException(status_code=400, detail="PDF contains no text")
 
-    # --- Chunking ---
-    CHUNK_SIZE = 500
-    OVERLAP = 100
-    step = CHUNK_SIZE - OVERLAP
-
-    chunks = [
-        text[i: i + CHUNK_SIZE]
-        for i in range(0, len(text), step)
-        if text[i: i + CHUNK_SIZE].strip()
-    ]
-
-    embeddings = EMBED_MODEL.encode(chunks, show_progress_bar=False)
-
-    # --- Store in Qdrant ---
-    points = []
-    for i, emb in enumerate(embeddings):
-        vec = emb.tolist() if hasattr(emb, "tolist") else list(emb)
-
-        points.append(
-            PointStruct(
-                id=str(uuid.uuid4()),
-                vector=vec,
-                payload={
-                    "companyId": company_id_int,
-                    "chatbotId": chatbot_id,
-                    "chatName": chatName,
-                    "chunk_index": i,
-                    "text": chunks[i],
-                },
-            )
-        )
-
-    qdrant.upsert(collection_name=COLLECTION_NAME, points=points)
-
-    # Remove temp file
-    try:
-        os.remove(temp_path)
-    except:
-        pass
-
     return {
         "status": "success",
         "chatbot_id": chatbot_id,
-        "chunks_stored": len(points),
+        "chunks_stored": report["chunks_stored"],
+        "pages": report["pages"],
+        "memory": report["memory"],
     }
@@ -0,0 +1,29 @@
+# app/api/deps.py
+#
+# Shared FastAPI dependencies (one place instead of a get_db per route module).
+from typing import AsyncIterator, Iterator
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.db.async_session import AsyncSessionLocal
+from app.db.session import SessionLocal
+
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    """AsyncSession for async routes; rolled back if the handler fails before committing."""
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except Exception:
+            await db.rollback()
+            raise
+
+
+def get_sync_db() -> Iterator[Session]:
+    """Sync Session for plain `def` routes (they run in the threadpool, not on the event loop)."""
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
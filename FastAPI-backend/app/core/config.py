@@ -7,9 +7,16 @@ load_dotenv()
 
 class Settings(BaseSettings):
     DATABASE_URL: str
+    ASYNC_DATABASE_URL: str = ""  # defaults to DATABASE_URL with the asyncpg driver
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
     # OPENAI_API_KEY: str
     QDRANT_URL: str = "http://localhost:6333"
-    # QDRANT_API_KEY: str = ""
+    QDRANT_API_KEY: str = ""
+    QDRANT_PREFER_GRPC: bool = False
+    QDRANT_GRPC_PORT: int = 6334
+    QDRANT_TIMEOUT: int = 30
+    QDRANT_MAX_CONNECTIONS: int = 32
     ADMIN_API_KEY: str = "admin"
     SESSION_TTL_SECONDS: int = 3600
     SERVER_HOST: str = "0.0.0.0"
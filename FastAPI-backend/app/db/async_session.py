@@ -0,0 +1,36 @@
+# app/db/async_session.py
+#
+# Async engine / session factory (asyncpg) for request handlers.
+# Same database as app/db/session.py; the sync SessionLocal stays for background workers
+# and scripts. Routes get an AsyncSession through app.api.deps.get_db.
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from app.core.config import get_settings
+
+# ✅ Import all models so relationships resolve (same registry as the sync session)
+import app.db.session  # noqa: F401
+
+
+def _async_url(url: str) -> str:
+    # postgresql:// or postgresql+psycopg2:// -> postgresql+asyncpg://
+    parsed = make_url(url)
+    if parsed.drivername.startswith("postgresql"):
+        parsed = parsed.set(drivername="postgresql+asyncpg")
+    return parsed.render_as_string(hide_password=False)
+
+
+settings = get_settings()
+ASYNC_DATABASE_URL = settings.ASYNC_DATABASE_URL or _async_url(settings.DATABASE_URL)
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+)
+# objects stay readable after commit (responses are built from them after the commit)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+async def close_async_engine():
+    await async_engine.dispose()
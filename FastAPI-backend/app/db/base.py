@@ -3,6 +3,9 @@ from app.models.visitor import Visitor
 from app.models.visitor_session import VisitorSession
 from app.models.chatbot import Chatbot
 from app.models.chat import Chat
+from app.models.ingestion_job import IngestionJob
+from app.models.vector_placement import VectorPlacement
+from app.models.chatbot_knowledge_version import ChatbotKnowledgeVersion
 
 
 from app.db.base_class import Base
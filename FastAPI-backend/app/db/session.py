@@ -9,6 +9,9 @@ import app.models.visitor_session
 import app.models.company
 import app.models.chatbot
 import app.models.chat
+import app.models.ingestion_job
+import app.models.vector_placement
+import app.models.chatbot_knowledge_version
 
 SQLALCHEMY_DATABASE_URL = get_settings().DATABASE_URL
 
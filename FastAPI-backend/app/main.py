@@ -1,19 +1,35 @@
 # main.py
+import time
+_import_started = time.perf_counter()
 import sys, os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 import asyncio
 from dotenv import load_dotenv
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.database import Base, engine, SessionLocal
 from app.api.api_v1.routes import router as api_router
 from app.core.config import get_settings
 # from app.services.visitor_service import cleanup_expired_sessions_task
 from app.db.session import engine, init_db
+from app.db.async_session import close_async_engine
+from app.services.chat_writer import start_chat_writer, stop_chat_writer
+from app.services.session_sweeper import start_session_sweeper, stop_session_sweeper
 from app.db.base import Base
-from app.services.qdrant_service import init_qdrant_collection, COLLECTION_NAME
+from app.services.qdrant_service import init_qdrant_collection, close_qdrant_client, COLLECTION_NAME, query_embedder
+from app.services.parsing_executor import shutdown_parse_executor
+from app.services.ingestion_jobs import start_ingestion_workers, stop_ingestion_workers
+from app.services.ollama_client import start_ollama_client, close_ollama_client
+from app.services.warm_pool import warm_pool, start_warm_pool, stop_warm_pool
+from app.services.model_registry import warm_embedding_models
+from app.services.reranker import RERANK_ENABLED, warm_reranker, shutdown_reranker
+from app.services.vector_placement import start_placement_migrator, stop_placement_migrator
+from app.utils.metrics import snapshot as metrics_snapshot, gauge
 import asyncio
-import httpx
+
+# cold-start tracking: how long importing the app took (models are NOT loaded here)
+gauge("app_import_seconds", "time to import app.main and its routes").set(round(time.perf_counter() - _import_started, 3))
 
 
 load_dotenv()
@@ -29,24 +45,41 @@ origins = [
 
 
 
-#ollama load
-async def warm_ollama():
-    async with httpx.AsyncClient(timeout=120) as client:
-        await client.post("http://127.0.0.1:11434/api/generate", json={
-            "model": "llama2",
-            "prompt": "hello",
-            "stream": False
-        })
-
 # on start of app
 @app.on_event("startup")
-def startup():
-    asyncio.create_task(warm_ollama())
-    created = init_qdrant_collection()
+async def startup():
+    await start_ollama_client()
+    # preloads the chat / embedding models on every Ollama backend and keeps them loaded
+    start_warm_pool()
+    # embedding model loads in the background; "/" is served right away
+    asyncio.create_task(warm_embedding_models())
+    if RERANK_ENABLED:
+        asyncio.create_task(warm_reranker())
+    await start_ingestion_workers()
+    created = await init_qdrant_collection()
     if created:
         print(f"Created collection {COLLECTION_NAME}")
     else:
         print(f"Collection {COLLECTION_NAME} already exists")
+    start_placement_migrator()
+    await start_chat_writer()
+    # deletes expired visitor sessions + their chats in throttled batches
+    await start_session_sweeper()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await stop_ingestion_workers()
+    await stop_placement_migrator()
+    await stop_session_sweeper()
+    await stop_warm_pool()
+    shutdown_parse_executor()
+    shutdown_reranker()
+    await close_ollama_client()
+    await query_embedder.close()
+    await close_qdrant_client()
+    # flush buffered chat rows before the engine goes away
+    await stop_chat_writer()
+    await close_async_engine()
 
 app.add_middleware(
     CORSMiddleware,
@@ -83,3 +116,13 @@ from app.api.api_v1.routes import router as api_router
 @app.get("/")
 def root():
     return {"message": "Backend running successfully 🚀"}
+
+@app.get("/ready")
+def ready():
+    # 503 until every model the service uses is loaded (see warm_pool)
+    status = warm_pool.readiness()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/metrics")
+def metrics():
+    return metrics_snapshot()
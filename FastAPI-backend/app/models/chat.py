@@ -18,7 +18,7 @@ class Chat(Base):
     __tablename__ = "chats"
 
     id = Column(Integer, primary_key=True, index=True)
-    visitor_session_id = Column(Integer, ForeignKey("visitor_sessions.id"), nullable=True)
+    visitor_session_id = Column(Integer, ForeignKey("visitor_sessions.id"), nullable=True, index=True)
     chatbot_id = Column(Integer, ForeignKey("chatbots.id"), nullable=True)
 
     # role can be 'user'|'bot' etc.
@@ -0,0 +1,14 @@
+# app/models/chatbot_knowledge_version.py
+from sqlalchemy import Column, Integer, DateTime
+from app.db.base import Base
+from datetime import datetime
+
+class ChatbotKnowledgeVersion(Base):
+    __tablename__ = "chatbot_knowledge_versions"
+
+    # bumped whenever a chatbot's knowledge base changes (retrain, delete); every API process
+    # compares it with the generation of its cached answers. No FK: the bump on delete must
+    # outlive the chatbot row so other processes still drop their answers.
+    chatbot_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
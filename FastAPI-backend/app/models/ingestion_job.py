@@ -0,0 +1,31 @@
+# app/models/ingestion_job.py
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
+from app.db.base import Base
+from datetime import datetime
+
+class IngestionJob(Base):
+    __tablename__ = "ingestion_jobs"
+
+    id = Column(String(36), primary_key=True, index=True)  # uuid4, returned to the client
+    company_id = Column(Integer, ForeignKey("companies.id", ondelete="CASCADE"), nullable=False, index=True)
+    chatbot_id = Column(Integer, ForeignKey("chatbots.id", ondelete="CASCADE"), nullable=False, index=True)
+
+    kind = Column(String(20), nullable=False)  # 'files' | 'url'
+    # files: directory holding the spooled uploads; url: the url to crawl
+    source = Column(Text, nullable=False)
+
+    # status: queued | running | succeeded | failed | cancelled
+    status = Column(String(20), nullable=False, default="queued", index=True)
+    # stage: queued | parsing | indexing | finished
+    stage = Column(String(20), nullable=False, default="queued")
+    chunks_done = Column(Integer, nullable=False, default=0)
+    chunks_total = Column(Integer, nullable=True)
+    error = Column(Text, nullable=True)
+
+    # the process running the job ("host:pid") and how long its claim holds without a heartbeat
+    owner = Column(String(255), nullable=True)
+    lease_until = Column(DateTime, nullable=True, index=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
@@ -0,0 +1,27 @@
+# app/models/vector_placement.py
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from app.db.base import Base
+from datetime import datetime
+
+class VectorPlacement(Base):
+    __tablename__ = "vector_placements"
+
+    # one row per chatbot: where its training vectors live
+    chatbot_id = Column(Integer, ForeignKey("chatbots.id", ondelete="CASCADE"), primary_key=True)
+
+    # layout: shared (one collection, filtered / sharded by chatbot) | dedicated (chatbot_{id})
+    layout = Column(String(20), nullable=False, default="shared")
+    collection = Column(String(255), nullable=False)
+    shard_key = Column(String(64), nullable=True)  # only with custom sharding on the shared collection
+
+    # status: active | migrating (writes go to both the current and the target layout)
+    status = Column(String(20), nullable=False, default="active")
+    target_layout = Column(String(20), nullable=True)
+    point_count = Column(Integer, nullable=False, default=0)
+    # process running the migration ("host:pid") and until when its claim holds without a heartbeat
+    owner = Column(String(255), nullable=True)
+    lease_until = Column(DateTime, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    migrated_at = Column(DateTime, nullable=True)
@@ -11,7 +11,7 @@ class VisitorSession(Base):
     visitor_id = Column(Integer, ForeignKey("visitors.id", ondelete="CASCADE"), nullable=False)
     chatbot_id = Column(Integer, ForeignKey("chatbots.id", ondelete="CASCADE"), nullable=False)
     started_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=True, index=True)  # drives the expiry sweeper
 
      # ✅ This is the missing relationship
     chats = relationship("Chat", back_populates="visitor_session", cascade="all, delete-orphan")
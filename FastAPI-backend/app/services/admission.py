@@ -0,0 +1,253 @@
+# app/services/admission.py
+#
+# Admission control in front of LLM generation.
+# - at most ADMISSION_CONCURRENCY_PER_BACKEND generations run at once on each Ollama
+#   backend; the rest wait in a bounded queue instead of piling up inside Ollama. A slot
+#   belongs to one backend and the generation is sent there: the conversation's own backend
+#   (backend_order of its affinity key) when it has room, else the next one in that order.
+#   Ejected / unhealthy backends only get slots when no backend is available
+# - the queue is weighted-fair across companies: each waiting request gets a virtual finish
+#   time (previous finish of its company + 1 / weight), and the smallest goes next, so one
+#   busy tenant can't starve the others (ADMISSION_COMPANY_WEIGHTS="12:2,7:0.5", default 1)
+# - requests are turned away early with Retry-After instead of timing out at 60 s:
+#     429  the company already holds its share of the queue (ADMISSION_TENANT_QUEUE_SHARE)
+#     503  the queue is full, the expected wait exceeds the deadline, or the deadline passed
+# - queue depth, running generations, wait time and rejections are on GET /metrics
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+from app.db.session import SessionLocal
+from app.models.chatbot import Chatbot
+from app.services.ollama_client import backend_order, backend_stats
+from app.utils.metrics import counter, gauge, histogram, LATENCY_BUCKETS_S
+
+# ---- CONFIG ----
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_CONCURRENCY_PER_BACKEND = int(os.getenv("ADMISSION_CONCURRENCY_PER_BACKEND", "4"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_TENANT_QUEUE_SHARE = float(os.getenv("ADMISSION_TENANT_QUEUE_SHARE", "0.5"))
+ADMISSION_MAX_WAIT_S = float(os.getenv("ADMISSION_MAX_WAIT_S", "20"))
+ADMISSION_COMPANY_WEIGHTS = {
+    k.strip(): float(v)
+    for k, _, v in (item.partition(":") for item in os.getenv("ADMISSION_COMPANY_WEIGHTS", "").split(",") if ":" in item)
+}
+
+_wait_seconds = histogram("admission_wait_seconds", LATENCY_BUCKETS_S, "time a generation waited for a slot")
+_rejected_429 = counter("admission_rejected_429", "generations refused: company over its queue share")
+_rejected_503 = counter("admission_rejected_503", "generations refused: queue full or expected wait too long")
+_timeouts = counter("admission_deadline_expired", "generations that waited past ADMISSION_MAX_WAIT_S")
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, retry_after: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+    @property
+    def headers(self) -> dict:
+        return {"Retry-After": str(self.retry_after)}
+
+
+class Slot:
+    """
+    A granted generation slot on `backend` (None when admission is disabled: route as usual).
+    release() is idempotent.
+    """
+
+    def __init__(self, controller: Optional["AdmissionController"], backend: Optional[str] = None):
+        self._controller = controller
+        self.backend = backend
+        self._granted = time.perf_counter()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            if self._controller is not None:
+                self._controller._release(self.backend, time.perf_counter() - self._granted)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class AdmissionController:
+    def __init__(self):
+        self._active: Dict[str, int] = {}  # backend -> slots held
+        # (finish tag, seq, tenant, affinity key, waiter); a waiter's result is its backend
+        self._queue: List[Tuple[float, int, str, Optional[str], asyncio.Future]] = []
+        self._queued_by_tenant: Dict[str, int] = {}
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self._seq = itertools.count()
+        self._service_ewma = 5.0  # seconds per generation, refined as slots are released
+
+    # ---- sizing ----
+    def capacity(self) -> int:
+        """Slots across all backends (for the expected wait and /metrics)."""
+        available = sum(1 for s in backend_stats().values() if s["available"])
+        return ADMISSION_CONCURRENCY_PER_BACKEND * max(1, available)
+
+    def queue_depth(self) -> int:
+        return sum(self._queued_by_tenant.values())
+
+    def active(self) -> int:
+        return sum(self._active.values())
+
+    def active_by_backend(self) -> Dict[str, int]:
+        return dict(self._active)
+
+    def _pick(self, affinity_key: Optional[str]) -> Optional[str]:
+        """The first backend in the key's order with a free slot, or None if all are full."""
+        order = backend_order(affinity_key)
+        stats = backend_stats()
+        candidates = [url for url in order if stats.get(url, {}).get("available")] or order
+        for url in candidates:
+            if self._active.get(url, 0) < ADMISSION_CONCURRENCY_PER_BACKEND:
+                return url
+        return None
+
+    def _grant(self, backend: str):
+        self._active[backend] = self._active.get(backend, 0) + 1
+
+    def _expected_wait(self, position: int) -> float:
+        return (position + 1) / self.capacity() * self._service_ewma
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._expected_wait(self.queue_depth())))
+
+    # ---- queueing ----
+    def _dequeued(self, tenant: str):
+        left = self._queued_by_tenant.get(tenant, 0) - 1
+        if left > 0:
+            self._queued_by_tenant[tenant] = left
+        else:
+            self._queued_by_tenant.pop(tenant, None)
+
+    def _dispatch(self):
+        while self._queue:
+            tag, _, tenant, affinity_key, waiter = self._queue[0]
+            if waiter.done():  # gave up waiting, already uncounted
+                heapq.heappop(self._queue)
+                continue
+            backend = self._pick(affinity_key)
+            if backend is None:
+                break
+            heapq.heappop(self._queue)
+            self._dequeued(tenant)
+            self._virtual_time = tag
+            self._grant(backend)
+            waiter.set_result(backend)
+        if not self.queue_depth():
+            # idle: forget old finish tags so a returning tenant isn't penalised for past usage
+            self._last_finish.clear()
+
+    def _release(self, backend: str, held: Optional[float] = None):
+        """Free a slot; `held` (seconds) feeds the service-time estimate unless None."""
+        left = self._active.get(backend, 0) - 1
+        if left > 0:
+            self._active[backend] = left
+        else:
+            self._active.pop(backend, None)
+        if held is not None:
+            self._service_ewma = 0.2 * held + 0.8 * self._service_ewma
+        self._dispatch()
+
+    async def acquire(self, tenant: str, affinity_key: Optional[str] = None, max_wait: float = ADMISSION_MAX_WAIT_S) -> Slot:
+        """Wait for a generation slot or raise AdmissionRejected."""
+        if not ADMISSION_ENABLED:
+            return Slot(None)
+
+        self._dispatch()  # capacity may have grown since the last release
+        backend = None if self.queue_depth() else self._pick(affinity_key)
+        if backend is not None:
+            self._grant(backend)
+            _wait_seconds.observe(0.0)
+            return Slot(self, backend)
+
+        depth = self.queue_depth()
+        if depth >= ADMISSION_QUEUE_SIZE:
+            _rejected_503.inc()
+            raise AdmissionRejected(503, self._retry_after(), "Generation queue is full, try again shortly")
+        if self._queued_by_tenant.get(tenant, 0) >= max(1, int(ADMISSION_QUEUE_SIZE * ADMISSION_TENANT_QUEUE_SHARE)):
+            _rejected_429.inc()
+            raise AdmissionRejected(429, self._retry_after(), "Too many queued requests for this company")
+        if self._expected_wait(depth) > max_wait:
+            _rejected_503.inc()
+            raise AdmissionRejected(503, self._retry_after(), "Generation is overloaded, try again shortly")
+
+        weight = ADMISSION_COMPANY_WEIGHTS.get(tenant, 1.0)
+        tag = max(self._virtual_time, self._last_finish.get(tenant, 0.0)) + 1.0 / weight
+        self._last_finish[tenant] = tag
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (tag, next(self._seq), tenant, affinity_key, waiter))
+        self._queued_by_tenant[tenant] = self._queued_by_tenant.get(tenant, 0) + 1
+
+        started = time.perf_counter()
+        try:
+            backend = await asyncio.wait_for(asyncio.shield(waiter), max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # granted just as we gave up: hand the slot straight back (it ran nothing,
+                # so it says nothing about service time)
+                self._release(waiter.result())
+            else:
+                waiter.cancel()  # _dispatch skips it
+                self._dequeued(tenant)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            _timeouts.inc()
+            _rejected_503.inc()
+            raise AdmissionRejected(503, self._retry_after(), "Timed out waiting for a generation slot")
+        _wait_seconds.observe(time.perf_counter() - started)
+        return Slot(self, backend)
+
+
+admission = AdmissionController()
+
+gauge("admission_queue_depth", "generations waiting for a slot", fn=admission.queue_depth)
+gauge("admission_active", "generations holding a slot", fn=admission.active)
+gauge("admission_capacity", "generation slots (per-backend limit x available backends)", fn=admission.capacity)
+gauge("admission_active_by_backend", "generation slots held on each Ollama backend", fn=admission.active_by_backend)
+
+
+# ---- tenant lookup ----
+_tenants: Dict[str, str] = {}
+
+
+def _company_of(chatbot_id) -> Optional[int]:
+    db = SessionLocal()
+    try:
+        chatbot = db.get(Chatbot, int(chatbot_id))
+        return chatbot.company_id if chatbot else None
+    except (TypeError, ValueError):
+        return None
+    finally:
+        db.close()
+
+
+async def tenant_for_chatbot(chatbot_id) -> str:
+    """Fair-queueing key for a chatbot: its company id (cached), or the chatbot itself if unknown."""
+    key = str(chatbot_id)
+    tenant = _tenants.get(key)
+    if tenant is None:
+        company_id = await asyncio.to_thread(_company_of, chatbot_id)
+        tenant = str(company_id) if company_id is not None else f"chatbot:{key}"
+        if len(_tenants) > 10000:
+            _tenants.clear()
+        _tenants[key] = tenant
+    return tenant
+
+
+async def admit(chatbot_id, affinity_key: Optional[str] = None) -> Slot:
+    """A slot for one of the chatbot's generations; send it to slot.backend."""
+    return await admission.acquire(await tenant_for_chatbot(chatbot_id), affinity_key)
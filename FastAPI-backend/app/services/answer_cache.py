@@ -0,0 +1,247 @@
+# app/services/answer_cache.py
+#
+# Semantic answer cache, one namespace per chatbot.
+# A visitor question whose embedding is within ANSWER_CACHE_THRESHOLD (cosine) of a
+# question we already answered for the same chatbot gets the stored answer back
+# instead of a new Ollama generation.
+#
+# - entries expire after ANSWER_CACHE_TTL_SECONDS, the least recently used go first
+#   once ANSWER_CACHE_MAX_ENTRIES is reached
+# - invalidate(chatbot_id) drops a chatbot's answers and bumps its generation, so an
+#   answer that was being generated while the bot was retrained is never stored
+# - the generation is shared through the chatbot_knowledge_versions table: a retrain in one
+#   API process bumps it there, and every process checks it (at most every
+#   ANSWER_CACHE_GENERATION_CHECK_S) before a lookup and drops its answers when it moved
+# - only history-free questions are cached: a follow-up answer depends on the conversation
+import os
+import time
+import itertools
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.db.async_session import AsyncSessionLocal
+from app.models.chatbot_knowledge_version import ChatbotKnowledgeVersion
+from app.utils.metrics import counter, gauge
+
+# ---- CONFIG ----
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.92"))  # cosine similarity
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+# how stale another process's view of a retrain may be
+ANSWER_CACHE_GENERATION_CHECK_S = float(os.getenv("ANSWER_CACHE_GENERATION_CHECK_S", "2"))
+
+_hits = counter("answer_cache_hits", "questions answered from the semantic answer cache")
+_misses = counter("answer_cache_misses", "questions that needed a fresh generation")
+_expired = counter("answer_cache_expired", "entries dropped because their TTL passed")
+_evictions = counter("answer_cache_evictions", "entries evicted by the LRU bound")
+_invalidations = counter("answer_cache_invalidations", "chatbot namespaces cleared after retrain / delete")
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    vector: np.ndarray  # unit length
+    created_at: float
+    extra: dict = field(default_factory=dict)  # e.g. sources shown with the answer
+
+
+class _BotAnswers:
+    """Entries of one (chatbot, embedding space) pair plus a lazily rebuilt vector matrix."""
+
+    def __init__(self):
+        self.entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._ids: List[int] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def changed(self):
+        self._matrix = None
+
+    def matrix(self) -> Tuple[List[int], np.ndarray]:
+        if self._matrix is None:
+            self._ids = list(self.entries)
+            self._matrix = np.stack([self.entries[i].vector for i in self._ids])
+        return self._ids, self._matrix
+
+
+def _unit(vector: Sequence[float]) -> Optional[np.ndarray]:
+    vec = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else None
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self._bots: Dict[Tuple[str, str], _BotAnswers] = {}
+        self._lru: "OrderedDict[Tuple[str, str, int], None]" = OrderedDict()  # global recency order
+        self._generations: Dict[str, int] = {}
+        self._ids = itertools.count()
+
+    def __len__(self):
+        return len(self._lru)
+
+    def generation(self, chatbot_id) -> int:
+        """Read before generating, pass to store(): a retrain in between makes the store a no-op."""
+        return self._generations.get(str(chatbot_id), 0)
+
+    def _drop(self, bot_key: Tuple[str, str], entry_id: int):
+        bucket = self._bots.get(bot_key)
+        if bucket is not None and bucket.entries.pop(entry_id, None) is not None:
+            bucket.changed()
+            if not bucket.entries:
+                del self._bots[bot_key]
+        self._lru.pop((*bot_key, entry_id), None)
+
+    def lookup(self, space: str, chatbot_id, vector: Sequence[float]) -> Optional[CachedAnswer]:
+        """Closest unexpired answer for this chatbot above the threshold, else None."""
+        bot_key = (space, str(chatbot_id))
+        bucket = self._bots.get(bot_key)
+        query = _unit(vector)
+        if bucket is None or query is None:
+            _misses.inc()
+            return None
+
+        ids, matrix = bucket.matrix()
+        if matrix.shape[1] != query.shape[0]:
+            _misses.inc()
+            return None
+        scores = matrix @ query
+        now = time.monotonic()
+        for idx in np.argsort(-scores):
+            if scores[idx] < self.threshold:
+                break
+            entry_id = ids[idx]
+            entry = bucket.entries[entry_id]
+            if now - entry.created_at > self.ttl:
+                self._drop(bot_key, entry_id)
+                _expired.inc()
+                continue
+            self._lru.move_to_end((*bot_key, entry_id))
+            _hits.inc()
+            return entry
+
+        _misses.inc()
+        return None
+
+    def store(self, space: str, chatbot_id, question: str, vector: Sequence[float], answer: str, generation: int, extra: Optional[dict] = None):
+        if generation != self.generation(chatbot_id):
+            return  # knowledge base changed while this answer was being generated
+        unit = _unit(vector)
+        if unit is None:
+            return
+
+        bot_key = (space, str(chatbot_id))
+        entry_id = next(self._ids)
+        bucket = self._bots.setdefault(bot_key, _BotAnswers())
+        bucket.entries[entry_id] = CachedAnswer(question, answer, unit, time.monotonic(), extra or {})
+        bucket.changed()
+        self._lru[(*bot_key, entry_id)] = None
+
+        while len(self._lru) > self.max_entries:
+            (space_, bot, oldest), _ = self._lru.popitem(last=False)
+            self._drop((space_, bot), oldest)
+            _evictions.inc()
+
+    def sync_generation(self, chatbot_id, shared: int):
+        """Adopt the shared generation; answers cached under an older one are dropped."""
+        if self._generations.get(str(chatbot_id), 0) != shared:
+            self._clear(str(chatbot_id))
+            self._generations[str(chatbot_id)] = shared
+
+    def invalidate(self, chatbot_id):
+        bot = str(chatbot_id)
+        self._generations[bot] = self._generations.get(bot, 0) + 1
+        self._clear(bot)
+
+    def _clear(self, bot: str):
+        for bot_key in [k for k in self._bots if k[1] == bot]:
+            for entry_id in list(self._bots[bot_key].entries):
+                self._lru.pop((*bot_key, entry_id), None)
+            del self._bots[bot_key]
+        _invalidations.inc()
+
+
+answer_cache = SemanticAnswerCache()
+gauge("answer_cache_entries", "answers held by the semantic answer cache", fn=lambda: len(answer_cache))
+
+
+# ---- shared generation ----
+_checked: Dict[str, Tuple[float, int]] = {}  # chatbot -> (checked at, shared generation)
+
+
+async def _read_generation(chatbot_id) -> int:
+    async with AsyncSessionLocal() as db:
+        version = await db.scalar(
+            select(ChatbotKnowledgeVersion.version).where(ChatbotKnowledgeVersion.chatbot_id == int(chatbot_id))
+        )
+    return version or 0
+
+
+async def _bump_generation(chatbot_id) -> int:
+    for _ in range(2):
+        async with AsyncSessionLocal() as db:
+            version = await db.scalar(
+                update(ChatbotKnowledgeVersion)
+                .where(ChatbotKnowledgeVersion.chatbot_id == int(chatbot_id))
+                .values(version=ChatbotKnowledgeVersion.version + 1)
+                .returning(ChatbotKnowledgeVersion.version)
+            )
+            if version is None:
+                db.add(ChatbotKnowledgeVersion(chatbot_id=int(chatbot_id), version=1))
+                version = 1
+            try:
+                await db.commit()
+                return version
+            except IntegrityError:
+                continue  # another process inserted the first row; bump that one
+    raise RuntimeError(f"could not bump knowledge version of chatbot {chatbot_id}")
+
+
+async def refresh_generation(chatbot_id) -> Optional[int]:
+    """
+    Generation to use for this lookup / store, synced with the other processes.
+    None (skip the cache this time) if the shared generation can't be read.
+    """
+    bot = str(chatbot_id)
+    now = time.monotonic()
+    checked = _checked.get(bot)
+    if checked is None or now - checked[0] > ANSWER_CACHE_GENERATION_CHECK_S:
+        try:
+            shared = await _read_generation(chatbot_id)
+        except Exception as e:
+            print(f"⚠️ Answer cache generation check failed for chatbot {bot}: {e}")
+            return None
+        if len(_checked) > 10000:
+            _checked.clear()
+        _checked[bot] = (now, shared)
+        answer_cache.sync_generation(chatbot_id, shared)
+    return answer_cache.generation(chatbot_id)
+
+
+async def invalidate_chatbot_answers(chatbot_id):
+    """Call whenever a chatbot's knowledge base changes (retrain, delete); reaches every process."""
+    answer_cache.invalidate(chatbot_id)
+    try:
+        shared = await _bump_generation(chatbot_id)
+    except Exception as e:
+        # this process is clean; the others keep their answers until ANSWER_CACHE_TTL_SECONDS
+        print(f"❌ Could not publish answer cache invalidation for chatbot {chatbot_id}: {e}")
+        _checked.pop(str(chatbot_id), None)
+        return
+    _checked[str(chatbot_id)] = (time.monotonic(), shared)
+    answer_cache.sync_generation(chatbot_id, shared)
@@ -0,0 +1,319 @@
+# app/services/chat_writer.py
+#
+# Write-behind buffer for chat transcript rows.
+# Chat routes enqueue Chat rows and return; a background task writes them with one
+# multi-row INSERT when CHAT_WRITE_BATCH rows are buffered or CHAT_WRITE_INTERVAL_MS
+# has passed, whichever comes first.
+# Durability:
+#   - the buffer is flushed on shutdown (stop_chat_writer)
+#   - with CHAT_WAL_PATH set, every row is appended to a write-ahead log first; a flush
+#     rotates the log into a segment that is deleted once its rows are committed
+#     (at-least-once: a crash between commit and delete can write a row twice)
+#   - each worker process logs to its own files, {CHAT_WAL_PATH}.{pid}.log and
+#     {CHAT_WAL_PATH}.{pid}.{ns}.seg; on startup a worker claims (renames) and replays only
+#     the files whose owning pid is no longer running, so live workers' logs are never
+#     touched. Liveness is checked with the local pid table: CHAT_WAL_PATH must be on a
+#     disk private to one host / container.
+#   - CHAT_WAL_FSYNC=1 fsyncs each append (survives power loss, costs a disk sync per row)
+# Failures:
+#   - a batch that fails is retried row by row; rows the database rejects (constraint /
+#     data errors) go to the dead-letter log (CHAT_DEAD_LETTER_PATH as JSON lines, or the
+#     process log when unset) and the rest of the batch is still written
+#   - if the database itself is unreachable the remaining rows (and their WAL segments)
+#     stay buffered and are retried on the next trigger
+#   - the buffer holds at most CHAT_WRITE_MAX_BUFFERED rows; while it is full new rows are
+#     dropped and counted in chat_write_overflow_dropped instead of growing memory
+import os
+import json
+import glob
+import time
+import asyncio
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+
+from app.db.async_session import async_engine
+from app.models.chat import Chat
+from app.utils.metrics import counter, gauge, histogram, LATENCY_BUCKETS_S, SIZE_BUCKETS
+
+# ---- CONFIG ----
+CHAT_WRITE_BATCH = int(os.getenv("CHAT_WRITE_BATCH", "200"))
+CHAT_WRITE_INTERVAL_MS = float(os.getenv("CHAT_WRITE_INTERVAL_MS", "200"))
+CHAT_WRITE_MAX_BATCH = 2000  # keeps one INSERT well under the driver's bind-parameter limit
+CHAT_WAL_PATH = os.getenv("CHAT_WAL_PATH", "")  # empty = no WAL, buffered rows are lost on a crash
+CHAT_WAL_FSYNC = os.getenv("CHAT_WAL_FSYNC", "0") == "1"
+CHAT_WRITE_MAX_BUFFERED = int(os.getenv("CHAT_WRITE_MAX_BUFFERED", "50000"))
+CHAT_DEAD_LETTER_PATH = os.getenv("CHAT_DEAD_LETTER_PATH", "")  # empty = rejected rows are printed
+
+_flush_seconds = histogram("chat_write_flush_seconds", LATENCY_BUCKETS_S, "time to write one batch of chat rows")
+_batch_rows = histogram("chat_write_batch_rows", SIZE_BUCKETS, "chat rows per INSERT")
+_enqueue_to_commit = histogram("chat_write_delay_seconds", LATENCY_BUCKETS_S, "enqueue -> committed, oldest row of a batch")
+_failures = counter("chat_write_failures", "chat row batches that failed to write (retried row by row)")
+_rows_written = counter("chat_rows_written", "chat rows committed by the write-behind buffer")
+_dead_letters = counter("chat_write_dead_letters", "chat rows the database rejected, sent to the dead-letter log")
+_overflow = counter("chat_write_overflow_dropped", "chat rows dropped because the buffer was full")
+
+
+class ChatWriter:
+    def __init__(
+        self,
+        wal_path: str = CHAT_WAL_PATH,
+        dead_letter_path: str = CHAT_DEAD_LETTER_PATH,
+        max_buffered: int = CHAT_WRITE_MAX_BUFFERED,
+    ):
+        self._buffer: List[dict] = []
+        self._oldest: Optional[float] = None
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self._wal_path = wal_path
+        self._wal = None
+        self._wal_file: Optional[str] = None  # this process's live log, set when it is opened
+        self._pending_segments: List[str] = []
+        self._dead_letter_path = dead_letter_path
+        self._max_buffered = max_buffered
+        self._overflowing = False
+
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    # ---- WAL ----
+    def _segment_name(self) -> str:
+        return f"{self._wal_path}.{os.getpid()}.{time.time_ns()}.seg"
+
+    def _open_wal(self):
+        if self._wal_path and self._wal is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self._wal_path)), exist_ok=True)
+            # pid taken at open time, after any fork, so every worker gets its own file
+            self._wal_file = f"{self._wal_path}.{os.getpid()}.log"
+            self._wal = open(self._wal_file, "a", encoding="utf-8")
+
+    def _wal_append(self, row: dict):
+        if self._wal is None:
+            return
+        self._wal.write(json.dumps({**row, "created_at": row["created_at"].isoformat()}) + "\n")
+        self._wal.flush()
+        if CHAT_WAL_FSYNC:
+            os.fsync(self._wal.fileno())
+
+    def _rotate_wal(self) -> Optional[str]:
+        """Move the current log aside as a segment covering the rows being flushed."""
+        if self._wal is None:
+            return None
+        self._wal.close()
+        segment = self._segment_name()
+        os.replace(self._wal_file, segment)
+        self._wal = open(self._wal_file, "a", encoding="utf-8")
+        return segment
+
+    def _read_wal_files(self, paths: List[str]) -> List[dict]:
+        rows = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line from a crash mid-write
+                    row["created_at"] = datetime.fromisoformat(row["created_at"])
+                    rows.append(row)
+        return rows
+
+    def _orphaned_wal_files(self) -> List[str]:
+        """Logs and segments whose owning process is gone."""
+        orphaned = []
+        for path in glob.glob(f"{glob.escape(self._wal_path)}.*"):
+            pid, _, kind = path[len(self._wal_path) + 1 :].partition(".")
+            if not pid.isdigit() or not (kind == "log" or kind.endswith(".seg")):
+                continue  # not a WAL file (e.g. the dead-letter log next to it)
+            if not _process_alive(int(pid)):
+                orphaned.append(path)
+        return sorted(orphaned)
+
+    async def recover(self):
+        """Replay rows left in the WAL by processes that are no longer running."""
+        if not self._wal_path or self._wal is not None:
+            return  # no WAL, or already running (our own files are not orphans)
+        claimed = []
+        for path in self._orphaned_wal_files():
+            segment = self._segment_name()
+            try:
+                # the rename is the claim: if another starting worker got there first it fails
+                os.rename(path, segment)
+            except FileNotFoundError:
+                continue
+            claimed.append(segment)
+        if not claimed:
+            return
+        rows = self._read_wal_files(claimed)
+        print(f"♻️ Replaying {len(rows)} chat rows from {len(claimed)} orphaned WAL files")
+        # replayed rows go through the normal flush (row-by-row retry, dead letters); their
+        # segments are deleted once the buffer has drained, and are ours to replay otherwise
+        self._buffer[:0] = rows
+        if rows and self._oldest is None:
+            self._oldest = time.perf_counter()
+        self._pending_segments.extend(claimed)
+        await self.flush()
+
+    # ---- buffer ----
+    def enqueue(
+        self,
+        visitor_session_id: Optional[int],
+        chatbot_id: Optional[int],
+        role: str,
+        message: str,
+        created_at: Optional[datetime] = None,
+    ):
+        row = {
+            "visitor_session_id": visitor_session_id,
+            "chatbot_id": chatbot_id,
+            "role": role,
+            "message": message,
+            "created_at": created_at or datetime.utcnow(),
+        }
+        if len(self._buffer) >= self._max_buffered:
+            _overflow.inc()
+            if not self._overflowing:
+                print(f"🚨 Chat write buffer full ({len(self._buffer)} rows), dropping new rows until it drains")
+                self._overflowing = True
+            return
+        self._overflowing = False
+        self._wal_append(row)
+        self._buffer.append(row)
+        if self._oldest is None:
+            self._oldest = time.perf_counter()
+        if len(self._buffer) >= CHAT_WRITE_BATCH:
+            self._wake.set()
+
+    async def _insert(self, rows: List[dict]):
+        async with async_engine.begin() as conn:
+            await conn.execute(insert(Chat).values(rows))
+
+    def _dead_letter(self, row: dict, error: Exception):
+        _dead_letters.inc()
+        line = json.dumps({**row, "created_at": row["created_at"].isoformat(), "error": str(error)})
+        if not self._dead_letter_path:
+            print(f"☠️ Chat row rejected by the database: {line}")
+            return
+        try:
+            with open(self._dead_letter_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"☠️ Chat row rejected by the database ({e} writing the dead-letter log): {line}")
+
+    async def _write(self, rows: List[dict]) -> Tuple[int, List[dict]]:
+        """
+        Write one batch: (rows committed, rows to keep for a retry).
+        If the multi-row INSERT fails, the rows are retried one at a time so a single bad
+        row can't hold up the others; rows the database rejects are dead-lettered, and on
+        any other error (database down) the rows not yet written are handed back.
+        """
+        try:
+            await self._insert(rows)
+            return len(rows), []
+        except Exception as e:
+            _failures.inc()
+            print(f"❌ Chat write of {len(rows)} rows failed, retrying row by row: {e}")
+        written = 0
+        for i, row in enumerate(rows):
+            try:
+                await self._insert([row])
+                written += 1
+            except (IntegrityError, DataError) as e:
+                self._dead_letter(row, e)
+            except Exception as e:
+                print(f"❌ Chat write failed, will retry {len(rows) - i} rows: {e}")
+                return written, rows[i:]
+        return written, []
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._buffer:
+                rows = self._buffer[:CHAT_WRITE_MAX_BATCH]
+                self._buffer = self._buffer[CHAT_WRITE_MAX_BATCH:]
+                oldest, self._oldest = self._oldest, (time.perf_counter() if self._buffer else None)
+                if not self._buffer:
+                    segment = self._rotate_wal()
+                    if segment:
+                        self._pending_segments.append(segment)
+
+                started = time.perf_counter()
+                written, retry = await self._write(rows)
+                if written:
+                    finished = time.perf_counter()
+                    _flush_seconds.observe(finished - started)
+                    _batch_rows.observe(written)
+                    _rows_written.inc(written)
+                    if oldest is not None:
+                        _enqueue_to_commit.observe(finished - oldest)
+                if retry:
+                    self._buffer[:0] = retry
+                    self._oldest = oldest
+                    return
+
+            # everything logged so far is committed (or dead-lettered)
+            for segment in self._pending_segments:
+                try:
+                    os.remove(segment)
+                except FileNotFoundError:
+                    pass
+            self._pending_segments.clear()
+
+    async def _run(self):
+        interval = CHAT_WRITE_INTERVAL_MS / 1000.0
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"❌ Chat writer flush error: {e}")
+
+    async def start(self):
+        await self.recover()
+        self._open_wal()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+
+def _process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        # files under our own pid at startup were left by an earlier process that had it
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, owned by someone else
+    return True
+
+
+chat_writer = ChatWriter()
+gauge("chat_write_buffered", "chat rows waiting to be written", fn=chat_writer.buffered)
+
+
+async def start_chat_writer():
+    await chat_writer.start()
+
+
+async def stop_chat_writer():
+    await chat_writer.stop()
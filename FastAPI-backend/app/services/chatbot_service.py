@@ -1,62 +1,35 @@
 # app/services/chatbot_service.py
 import os
-import io
 import math
 import asyncio
-from typing import List, Tuple, Optional
-import httpx
-from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from typing import List, Tuple, Optional, Callable, Awaitable
+from bs4 import BeautifulSoup
+from qdrant_client.models import PointStruct, FieldCondition, MatchValue
 # from qdrant_client.http.models import PointStruct, VectorParams, Distance
 from app.db.session import SessionLocal
 from app.models.chatbot import Chatbot
 from app.models.company import Company
 from app.models.chat import Chat
 from sqlalchemy.orm import Session
-from PyPDF2 import PdfReader
-import docx
+from app.services.qdrant_service import chunk_point_id
+from app.services import vector_placement
+from app.services.embedding_cache import cached_embed_async
+from app.services.prompt_builder import assemble
+from app.services.answer_cache import answer_cache, invalidate_chatbot_answers, refresh_generation, ANSWER_CACHE_ENABLED
+from app.services.admission import admission
+from app.services.ollama_client import ollama_post, get_web_client, close_ollama_client
 
 # ---- CONFIG ----
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
 LLM_MODEL = os.getenv("OLLAMA_LLM_MODEL", "smollm2:135m")  # generation model
 QDRANT_HOST = os.getenv("QDRANT_HOST", "127.0.0.1")
 QDRANT_PORT = int(os.getenv("QDRANT_PORT", "6333"))
-COLLECTION_PREFIX = "chatbot_"  # final collection name: chatbot_{chatbot_id}
-
-# initialize qdrant client
-# qdrant = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
-qdrant = QdrantClient("http://localhost:6333")
+# where a chatbot's vectors live (shared collection or chatbot_{id}) is decided by vector_placement
 
 # ---- UTIL: file parsers ----
-def extract_text_from_pdf(file_bytes: bytes) -> str:
-    reader = PdfReader(io.BytesIO(file_bytes))
-    pages = []
-    for p in reader.pages:
-        try:
-            pages.append(p.extract_text() or "")
-        except Exception:
-            pages.append("")
-    return "\n".join(pages)
-
-def extract_text_from_docx(file_bytes: bytes) -> str:
-    doc = docx.Document(io.BytesIO(file_bytes))
-    paragraphs = [p.text for p in doc.paragraphs]
-    return "\n".join(paragraphs)
-
-def extract_text_from_txt(file_bytes: bytes) -> str:
-    return file_bytes.decode(errors="ignore")
-
-def extract_text_from_file(filename: str, file_bytes: bytes) -> str:
-    lower = filename.lower()
-    if lower.endswith(".pdf"):
-        return extract_text_from_pdf(file_bytes)
-    if lower.endswith(".docx"):
-        return extract_text_from_docx(file_bytes)
-    if lower.endswith(".txt") or lower.endswith(".md") or lower.endswith(".html"):
-        return extract_text_from_txt(file_bytes)
-    # fallback: try decode
-    return extract_text_from_txt(file_bytes)
+# parsers live in document_parsers so the parsing process pool can import them cheaply
+from app.services.parsing_executor import parse_documents
+from app.utils.memory import RssTracker
 
 # ---- TEXT CHUNKER (simple) ----
 def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100) -> List[str]:
@@ -71,169 +44,206 @@ def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100) -> List[str
 
 # ---- OLLAMA EMBEDDING / GENERATE ----
 async def ollama_embed(texts: list[str]) -> list[list[float]]:
+    """
+    Embeddings via Ollama, served from the shared embedding cache when possible.
+    Only texts never embedded with EMBED_MODEL before reach Ollama.
+    """
+    return await cached_embed_async(f"ollama:{EMBED_MODEL}", texts, _ollama_embed_uncached)
+
+async def _ollama_embed_uncached(texts: list[str]) -> list[list[float]]:
     """
     Generate embeddings using Ollama — supports both /api/embed and /api/embeddings.
     Automatically detects which endpoint works.
     """
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        payload = {"model": EMBED_MODEL, "input": texts}
+    payload = {"model": EMBED_MODEL, "input": texts}
 
-        # Try new endpoint first
-        try:
-            resp = await client.post(f"{OLLAMA_URL}/api/embeddings", json=payload)
-            if resp.status_code == 404:
-                # fallback to older endpoint
-                resp = await client.post(f"{OLLAMA_URL}/api/embed", json=payload)
-            resp.raise_for_status()
-            data = resp.json()
-        except Exception as e:
-            raise RuntimeError(f"Failed to get embeddings from Ollama: {str(e)}")
-
-        # Normalize result (different models return slightly different structures)
-        if "embedding" in data:
-            return [data["embedding"]]
-        elif "embeddings" in data:
-            return data["embeddings"]
-        elif "data" in data:
-            return [d["embedding"] for d in data["data"]]
-        else:
-            raise ValueError(f"Unexpected Ollama embedding response: {data}")
-
-async def ollama_generate(prompt: str, max_tokens: int = 512, stream: bool = False) -> str:
+    # Try new endpoint first
+    try:
+        resp = await ollama_post("embed", "/api/embeddings", payload)
+        if resp.status_code == 404:
+            # fallback to older endpoint
+            resp = await ollama_post("embed", "/api/embed", payload)
+        resp.raise_for_status()
+        data = resp.json()
+    except Exception as e:
+        raise RuntimeError(f"Failed to get embeddings from Ollama: {str(e)}")
+
+    # Normalize result (different models return slightly different structures)
+    if "embedding" in data:
+        return [data["embedding"]]
+    elif "embeddings" in data:
+        return data["embeddings"]
+    elif "data" in data:
+        return [d["embedding"] for d in data["data"]]
+    else:
+        raise ValueError(f"Unexpected Ollama embedding response: {data}")
+
+async def ollama_generate(prompt: str, max_tokens: int = 512, stream: bool = False, backend: Optional[str] = None) -> str:
     """
     Call Ollama generate endpoint with the prompt, return text output.
+    backend pins the call (e.g. to the backend an admission slot was granted on).
     """
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        payload = {
-            "model": LLM_MODEL,
-            "prompt": prompt,
-            "max_tokens": max_tokens,
-            "stream": stream,
-        }
-        url = f"{OLLAMA_URL}/api/generate"
-        resp = await client.post(url, json=payload)
-        resp.raise_for_status()
-        body = resp.json()
-        # Ollama output forms vary: check common keys:
-        # Example: { "result": "..."} or {"text": "..."} or {"output": [{"generated_text": "..."}]}
-        if isinstance(body, dict):
-            if "text" in body:
-                return body["text"]
-            if "result" in body:
-                # sometimes result is single text element
-                r = body["result"]
-                if isinstance(r, str):
-                    return r
-            if "output" in body and isinstance(body["output"], list):
-                # try to find generated output
-                first = body["output"][0]
-                for k in ("generated_text", "text", "content"):
-                    if k in first:
-                        return first[k]
-        # fallback: stringify
-        return str(body)
+    payload = {
+        "model": LLM_MODEL,
+        "prompt": prompt,
+        "max_tokens": max_tokens,
+        "stream": stream,
+    }
+    resp = await ollama_post("generate", "/api/generate", payload, backend=backend)
+    resp.raise_for_status()
+    body = resp.json()
+    # Ollama output forms vary: check common keys:
+    # Example: { "result": "..."} or {"text": "..."} or {"output": [{"generated_text": "..."}]}
+    if isinstance(body, dict):
+        if "text" in body:
+            return body["text"]
+        if "result" in body:
+            # sometimes result is single text element
+            r = body["result"]
+            if isinstance(r, str):
+                return r
+        if "output" in body and isinstance(body["output"], list):
+            # try to find generated output
+            first = body["output"][0]
+            for k in ("generated_text", "text", "content"):
+                if k in first:
+                    return first[k]
+    # fallback: stringify
+    return str(body)
 
 # ---- QDRANT helpers ----
-def ensure_collection(chatbot_id: int, vector_size: int = 768):
-    collection_name = f"chatbot_{chatbot_id}"
-
-    try:
-        qdrant.get_collection(collection_name)
-        return
-    except Exception:
-        print(f"⚙️ Creating new Qdrant collection: {collection_name}")
-
-        qdrant.recreate_collection(
-            collection_name=collection_name,
-            vectors_config=VectorParams(
-                size=vector_size,
-                distance=Distance.COSINE
-            )
-        )
-
-
-
-
-async def upsert_chunks_to_qdrant(chatbot_id: int, chunks: List[Tuple[str, dict]], vectors: List[List[float]]):
+async def upsert_chunks_to_qdrant(chatbot_id: int, chunks: List[Tuple[str, dict]], vectors: List[List[float]], point_ids: Optional[List[str]] = None):
     """
     chunks: list of tuples (chunk_text, meta_dict)
     vectors: list of vectors aligned to chunks
+    point_ids: precomputed ids aligned to chunks (derived from content when omitted)
     """
-    collection_name = f"{COLLECTION_PREFIX}{chatbot_id}"
-    vector_size = len(vectors[0]) if vectors else 0
-    ensure_collection(chatbot_id, vector_size)
-
+    if not vectors:
+        return
     points: List[PointStruct] = []
     for i, (chunk_text, meta) in enumerate(chunks):
-        # create a stable id or leave None for qdrant to generate
-        point_id = f"{chatbot_id}_{i}_{hash(chunk_text) & 0xFFFFFFFF}"
-        points.append(PointStruct(id=point_id, vector=vectors[i], payload={"text": chunk_text, **meta}))
-    qdrant.upsert(collection_name=collection_name, points=points)
-
-# ---- HIGH LEVEL TRAIN (files) ----
-async def train_chatbot_from_files(company_id: int, chatbot_id: int, files: List[Tuple[str, bytes]]):
+        # content-addressed id: same chatbot + source + text -> same point, from any worker
+        point_id = point_ids[i] if point_ids else chunk_point_id(chatbot_id, meta.get("source", ""), chunk_text)
+        payload = {"text": chunk_text, **meta, "chatbotId": int(chatbot_id)}
+        points.append(PointStruct(id=point_id, vector=vectors[i], payload=payload))
+    # dedicated collection or shared one, sized from the actual vectors
+    await vector_placement.upsert_points(chatbot_id, points, vector_size=len(vectors[0]))
+
+async def existing_point_ids(chatbot_id: int, sources) -> set:
+    """Ids already stored for the given sources (empty if nothing was indexed yet)."""
+    ids = set()
+    for source in sources:
+        ids |= await vector_placement.point_ids(chatbot_id, FieldCondition(key="source", match=MatchValue(value=source)))
+    return ids
+
+# ---- CHUNK PREP ----
+async def chunk_files(files: List[Tuple[str, bytes]]) -> List[Tuple[str, dict]]:
     """
     files: list of tuples (filename, file_bytes)
+    returns: list of tuples (chunk_text, meta_dict)
     """
-    # parse & chunk all files
+    # parse all files in parallel on the parsing process pool, then chunk
+    tracker = RssTracker()
+    texts = await parse_documents(files, tracker)
+    print(f"🧾 Parsed {len(files)} files: {tracker.as_dict()}")
     all_chunks: List[Tuple[str, dict]] = []
-    for filename, file_bytes in files:
-        text = extract_text_from_file(filename, file_bytes)
+    for (filename, _), text in zip(files, texts):
         if not text.strip():
             continue
         chunks = chunk_text(text, chunk_size=400, overlap=50)
         for idx, c in enumerate(chunks):
             meta = {"source": filename, "chunk_index": idx}
             all_chunks.append((c, meta))
+    return all_chunks
 
-    if not all_chunks:
-        return {"message": "No text extracted from files."}
-
-    # call embeddings in batches (async)
-    texts = [c for c, _ in all_chunks]
-    BATCH = 16
-    vectors = []
-    for i in range(0, len(texts), BATCH):
-        batch_texts = texts[i : i + BATCH]
-        emb = await ollama_embed(batch_texts)
-        vectors.extend(emb)
-
-    # upsert to qdrant
-    await upsert_chunks_to_qdrant(chatbot_id, all_chunks, vectors)
-    return {"message": f"Indexed {len(all_chunks)} chunks into Qdrant for chatbot {chatbot_id}"}
-
-# ---- TRAIN FROM URL (simple crawler) ----
-import httpx
-from bs4 import BeautifulSoup
-
-async def train_chatbot_from_url(company_id: int, chatbot_id: int, url: str):
-    # simple fetch + parse text
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.get(url)
-        r.raise_for_status()
-        html = r.text
+async def chunk_url(url: str) -> List[Tuple[str, dict]]:
+    # simple fetch + parse text (shared pooled client, not a new one per crawl)
+    r = await get_web_client().get(url)
+    r.raise_for_status()
+    html = r.text
     soup = BeautifulSoup(html, "html.parser")
     # remove scripts/styles
     for s in soup(["script", "style", "noscript"]):
         s.decompose()
     text = soup.get_text(separator="\n")
     chunks = chunk_text(text, chunk_size=400, overlap=50)
-    chunk_pairs = [(c, {"source": url, "chunk_index": i}) for i, c in enumerate(chunks)]
+    return [(c, {"source": url, "chunk_index": i}) for i, c in enumerate(chunks)]
 
-    # embed & upsert
-    BATCH = 16
-    vectors = []
-    for i in range(0, len(chunks), BATCH):
-        emb = await ollama_embed(chunks[i : i + BATCH])
-        vectors.extend(emb)
+# ---- EMBED + UPSERT ----
+EMBED_BATCH = 16
 
-    await upsert_chunks_to_qdrant(chatbot_id, chunk_pairs, vectors)
-    return {"message": f"Crawled {len(chunks)} chunks from {url} and indexed into Qdrant."}
+async def index_chunks(
+    chatbot_id: int,
+    chunks: List[Tuple[str, dict]],
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+) -> dict:
+    """
+    Incremental re-index of the sources present in `chunks`:
+    - chunks whose content-addressed id is already stored are skipped (no re-embed)
+    - new / changed chunks are embedded + upserted one batch at a time
+    - points of those sources that no longer appear are deleted once the new ones are in
+    Because skipping is id based, a resumed job naturally continues where it stopped.
+    on_progress(done, total) is awaited after every batch; it may raise to abort.
+    """
+    by_id = {}
+    for chunk_text, meta in chunks:
+        by_id.setdefault(chunk_point_id(chatbot_id, meta.get("source", ""), chunk_text), (chunk_text, meta))
+
+    existing = await existing_point_ids(chatbot_id, {meta.get("source", "") for _, meta in chunks})
+    new_ids = [pid for pid in by_id if pid not in existing]
+    stale_ids = existing - by_id.keys()
+
+    total = len(by_id)
+    done = total - len(new_ids)
+    if on_progress is not None:
+        await on_progress(done, total)
+
+    for i in range(0, len(new_ids), EMBED_BATCH):
+        batch_ids = new_ids[i : i + EMBED_BATCH]
+        batch = [by_id[pid] for pid in batch_ids]
+        vectors = await ollama_embed([c for c, _ in batch])
+        await upsert_chunks_to_qdrant(chatbot_id, batch, vectors, point_ids=batch_ids)
+        done += len(batch)
+        if on_progress is not None:
+            await on_progress(done, total)
+
+    if stale_ids:
+        await vector_placement.delete_points(chatbot_id, stale_ids)
+
+    if new_ids or stale_ids:
+        # cached answers were generated from the old knowledge base
+        await invalidate_chatbot_answers(chatbot_id)
+        # size drives shared <-> dedicated placement
+        await vector_placement.record_point_count(chatbot_id)
+
+    return {
+        "chunks": total,
+        "embedded": len(new_ids),
+        "unchanged": total - len(new_ids),
+        "deleted": len(stale_ids),
+    }
+
+# ---- HIGH LEVEL TRAIN (files) ----
+async def train_chatbot_from_files(company_id: int, chatbot_id: int, files: List[Tuple[str, bytes]]):
+    """
+    files: list of tuples (filename, file_bytes)
+    """
+    all_chunks = await chunk_files(files)
+    if not all_chunks:
+        return {"message": "No text extracted from files."}
+
+    delta = await index_chunks(chatbot_id, all_chunks)
+    return {"message": f"Indexed {len(all_chunks)} chunks into Qdrant for chatbot {chatbot_id}", **delta}
+
+# ---- TRAIN FROM URL (simple crawler) ----
+async def train_chatbot_from_url(company_id: int, chatbot_id: int, url: str):
+    chunk_pairs = await chunk_url(url)
+    delta = await index_chunks(chatbot_id, chunk_pairs)
+    return {"message": f"Crawled {len(chunk_pairs)} chunks from {url} and indexed into Qdrant.", **delta}
 
 # ---- QUERY: RAG (search + generate) ----
-def qdrant_search(chatbot_id: int, query_vector: List[float], top_k: int = 5):
-    collection_name = f"{COLLECTION_PREFIX}{chatbot_id}"
-    hits = qdrant.search(collection_name=collection_name, query_vector=query_vector, limit=top_k)
+async def qdrant_search(chatbot_id: int, query_vector: List[float], top_k: int = 5):
+    hits = await vector_placement.search(chatbot_id, query_vector, limit=top_k)
     return hits
 
 async def query_chatbot(company_id: int, chatbot_id: int, question: str) -> dict:
@@ -244,9 +254,15 @@ async def query_chatbot(company_id: int, chatbot_id: int, question: str) -> dict
     q_embs = await ollama_embed([question])
     q_vec = q_embs[0]
 
+    # a near-identical question was already answered for this chatbot
+    generation = await refresh_generation(chatbot_id) if ANSWER_CACHE_ENABLED else None
+    cached = answer_cache.lookup("ollama", chatbot_id, q_vec) if generation is not None else None
+    if cached is not None:
+        return {"answer": cached.answer, "sources": cached.extra.get("sources", []), "cache_hit": True}
+
     # 2) search Qdrant
     try:
-        hits = qdrant_search(chatbot_id, q_vec, top_k=5)
+        hits = await qdrant_search(chatbot_id, q_vec, top_k=5)
     except Exception as e:
         return {"error": f"Qdrant search error: {str(e)}"}
 
@@ -259,22 +275,41 @@ async def query_chatbot(company_id: int, chatbot_id: int, question: str) -> dict
         src = payload.get("source")
         context_pieces.append(f"Source: {src}\n{text}")
 
-    context = "\n\n---\n\n".join(context_pieces)
-    prompt = (
+    # keep the best-ranked pieces that fit the token budget; the empty template is what gets
+    # budgeted, so the scaffolding around context and question is counted too
+    instructions = (
         "You are a helpful assistant. Use the following context from the company's documents to answer the question.\n\n"
-        f"CONTEXT:\n{context}\n\nQUESTION: {question}\n\nProvide a concise helpful answer and mention sources if present."
+        "CONTEXT:\n{context}\n\nQUESTION: {question}\n\n"
+        "Provide a concise helpful answer and mention sources if present."
     )
-
-    # 4) generate answer from Ollama
-    answer = await ollama_generate(prompt, max_tokens=512)
-    return {"answer": answer, "sources": [h.payload.get("source") for h in hits]}
+    parts = assemble(instructions.format(context="", question=""), question, context_pieces, separator="\n\n---\n\n")
+    context = "\n\n---\n\n".join(parts.context)
+    prompt = instructions.format(context=context, question=parts.question)
+
+    # 4) generate answer from Ollama (waits for a generation slot; AdmissionRejected if overloaded)
+    async with await admission.acquire(str(company_id)) as slot:
+        answer = await ollama_generate(prompt, max_tokens=512, backend=slot.backend)
+    # only the hits whose text actually made it into the prompt
+    sources = [(hits[i].payload or {}).get("source") for i in parts.chunk_indices]
+    if generation is not None:
+        answer_cache.store("ollama", chatbot_id, question, q_vec, answer, generation, extra={"sources": sources})
+    return {"answer": answer, "sources": sources, "cache_hit": False, "prompt_tokens": parts.report}
 
 # ---- convenience wrappers if your FastAPI endpoints call sync functions ----
+def _run(coro):
+    # each asyncio.run is a new event loop: close the pooled clients before it ends
+    async def main():
+        try:
+            return await coro
+        finally:
+            await close_ollama_client()
+    return asyncio.run(main())
+
 def sync_train_files_wrapper(company_id: int, chatbot_id: int, files: List[Tuple[str, bytes]]):
-    return asyncio.run(train_chatbot_from_files(company_id, chatbot_id, files))
+    return _run(train_chatbot_from_files(company_id, chatbot_id, files))
 
 def sync_train_url_wrapper(company_id: int, chatbot_id: int, url: str):
-    return asyncio.run(train_chatbot_from_url(company_id, chatbot_id, url))
+    return _run(train_chatbot_from_url(company_id, chatbot_id, url))
 
 def sync_query_wrapper(company_id: int, chatbot_id: int, question: str):
-    return asyncio.run(query_chatbot(company_id, chatbot_id, question))
+    return _run(query_chatbot(company_id, chatbot_id, question))
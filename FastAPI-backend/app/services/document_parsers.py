@@ -0,0 +1,75 @@
+# app/services/document_parsers.py
+#
+# Pure, picklable parsing functions. These run inside the parsing process pool
+# (see parsing_executor.py), so keep this module free of app imports
+# (DB sessions, Qdrant clients, models) - each worker process imports it on spawn.
+import io
+from typing import List
+
+from PyPDF2 import PdfReader
+import docx
+
+
+# ---- whole-document parsers (bytes in, text out) ----
+def extract_text_from_pdf(file_bytes: bytes) -> str:
+    reader = PdfReader(io.BytesIO(file_bytes))
+    pages = []
+    for p in reader.pages:
+        try:
+            pages.append(p.extract_text() or "")
+        except Exception:
+            pages.append("")
+    return "\n".join(pages)
+
+def extract_text_from_docx(file_bytes: bytes) -> str:
+    doc = docx.Document(io.BytesIO(file_bytes))
+    paragraphs = [p.text for p in doc.paragraphs]
+    return "\n".join(paragraphs)
+
+def extract_text_from_txt(file_bytes: bytes) -> str:
+    return file_bytes.decode(errors="ignore")
+
+def extract_text_from_file(filename: str, file_bytes: bytes) -> str:
+    lower = filename.lower()
+    if lower.endswith(".pdf"):
+        return extract_text_from_pdf(file_bytes)
+    if lower.endswith(".docx"):
+        return extract_text_from_docx(file_bytes)
+    if lower.endswith(".txt") or lower.endswith(".md") or lower.endswith(".html"):
+        return extract_text_from_txt(file_bytes)
+    # fallback: try decode
+    return extract_text_from_txt(file_bytes)
+
+
+# ---- page-range parsers (path in, so big files aren't pickled to every worker) ----
+def pdf_page_count(file_path: str) -> int:
+    return len(PdfReader(file_path).pages)
+
+def extract_pdf_pages_pypdf(file_path: str, start: int, end: int) -> List[str]:
+    """Text of pages [start, end) using PyPDF2 - same per-page output as extract_text_from_pdf."""
+    reader = PdfReader(file_path)
+    pages = []
+    for i in range(start, min(end, len(reader.pages))):
+        try:
+            pages.append(reader.pages[i].extract_text() or "")
+        except Exception:
+            pages.append("")
+    return pages
+
+def extract_pdf_pages_pdfminer(file_path: str, start: int, end: int) -> List[str]:
+    """Text of pages [start, end) using pdfminer layout analysis (used by /upload)."""
+    from pdfminer.high_level import extract_pages
+    from pdfminer.layout import LTTextContainer
+
+    pages = []
+    for page_layout in extract_pages(file_path, page_numbers=range(start, end)):
+        pages.append("".join(
+            element.get_text()
+            for element in page_layout
+            if isinstance(element, LTTextContainer)
+        ))
+    return pages
+
+def extract_pdf_text_pdfminer(file_path: str) -> str:
+    from pdfminer.high_level import extract_text
+    return extract_text(file_path)
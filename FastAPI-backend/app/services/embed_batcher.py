@@ -0,0 +1,96 @@
+# app/services/embed_batcher.py
+#
+# Dynamic micro-batching for query embeddings.
+# Concurrent callers drop their text in a queue; a single collector task waits up to
+# max_delay_ms (or until max_batch texts are queued), runs ONE batched encode on a
+# dedicated thread and resolves every caller's future. Under load this turns N
+# single-text encodes into a few batched ones, and the event loop never runs the model.
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from app.utils.metrics import histogram, LATENCY_BUCKETS_S, SIZE_BUCKETS
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        encode_fn: Callable[[List[str]], Sequence[Sequence[float]]],
+        max_batch: int = 32,
+        max_delay_ms: float = 5.0,
+        name: str = "query_embed",
+    ):
+        self.encode_fn = encode_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.0
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-encoder")
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self._batch_size = histogram(f"{name}_batch_size", SIZE_BUCKETS, "texts per batched encode")
+        self._queue_delay = histogram(f"{name}_queue_delay_seconds", LATENCY_BUCKETS_S, "enqueue -> batch start")
+        self._encode_time = histogram(f"{name}_encode_seconds", LATENCY_BUCKETS_S, "time spent in one batched encode")
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._queue = asyncio.Queue()
+            self._loop = loop
+            self._task = loop.create_task(self._collect())
+
+    async def embed(self, text: str) -> List[float]:
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, fut, time.perf_counter()))
+        return await fut
+
+    async def _next_batch(self) -> List[Tuple[str, asyncio.Future, float]]:
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            # callers that gave up (request cancelled) don't need encoding
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            for _, _, enqueued in batch:
+                self._queue_delay.observe(started - enqueued)
+            self._batch_size.observe(len(batch))
+
+            try:
+                vectors = await loop.run_in_executor(self._executor, self.encode_fn, [t for t, _, _ in batch])
+            except Exception as e:
+                for _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            finally:
+                self._encode_time.observe(time.perf_counter() - started)
+
+            for (_, fut, _), vec in zip(batch, vectors):
+                if not fut.done():
+                    fut.set_result(list(vec))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,177 @@
+# app/services/embedding_cache.py
+#
+# Two-tier embedding cache shared by ingestion and query paths.
+#   tier 1: in-process LRU bounded by bytes (EMBED_CACHE_MEMORY_BYTES)
+#   tier 2: SQLite file on disk (EMBED_CACHE_PATH, "" disables it)
+# Keyed by (model name, sha256 of whitespace-normalized text), so the same chunk or
+# visitor question is only embedded once per model - across requests and restarts.
+import os
+import array
+import asyncio
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from app.utils.metrics import counter, gauge
+
+# ---- CONFIG ----
+EMBED_CACHE_MEMORY_BYTES = int(os.getenv("EMBED_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join(tempfile.gettempdir(), "tribe_embed_cache.sqlite3"))
+
+# rough per-entry overhead of the OrderedDict slot + key tuple, on top of the vector bytes
+_ENTRY_OVERHEAD = 200
+
+_hits_memory = counter("embed_cache_hits_memory", "embedding lookups served from the in-process LRU")
+_hits_disk = counter("embed_cache_hits_disk", "embedding lookups served from the on-disk store")
+_misses = counter("embed_cache_misses", "embedding lookups that had to call the model")
+_evictions = counter("embed_cache_evictions", "entries evicted from the in-process LRU")
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def _pack(vector: Sequence[float]) -> bytes:
+    return array.array("f", vector).tobytes()
+
+
+def _unpack(blob: bytes) -> List[float]:
+    vec = array.array("f")
+    vec.frombytes(blob)
+    return vec.tolist()
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes: int = EMBED_CACHE_MEMORY_BYTES, path: str = EMBED_CACHE_PATH):
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self._lru: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._lock = threading.Lock()  # ingestion encodes on worker threads
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL,"
+                " PRIMARY KEY (model, text_hash))"
+            )
+            self._db.commit()
+
+    # ---- tier 1 ----
+    def _remember(self, key: Tuple[str, str], blob: bytes):
+        old = self._lru.pop(key, None)
+        if old is not None:
+            self.bytes_used -= len(old) + _ENTRY_OVERHEAD
+        self._lru[key] = blob
+        self.bytes_used += len(blob) + _ENTRY_OVERHEAD
+        while self.bytes_used > self.max_bytes and self._lru:
+            _, evicted = self._lru.popitem(last=False)
+            self.bytes_used -= len(evicted) + _ENTRY_OVERHEAD
+            _evictions.inc()
+
+    # ---- public API ----
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        hashes = [text_hash(t) for t in texts]
+        found: List[Optional[bytes]] = [None] * len(texts)
+        missing = []
+
+        with self._lock:
+            for i, h in enumerate(hashes):
+                blob = self._lru.get((model, h))
+                if blob is not None:
+                    self._lru.move_to_end((model, h))
+                    found[i] = blob
+                    _hits_memory.inc()
+                else:
+                    missing.append(i)
+
+            if missing and self._db is not None:
+                wanted = list({hashes[i] for i in missing})
+                rows = {}
+                for j in range(0, len(wanted), 500):  # stay under SQLite's bound-parameter limit
+                    part = wanted[j : j + 500]
+                    placeholders = ",".join("?" * len(part))
+                    rows.update(self._db.execute(
+                        f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                        [model, *part],
+                    ).fetchall())
+                still_missing = []
+                for i in missing:
+                    blob = rows.get(hashes[i])
+                    if blob is not None:
+                        found[i] = blob
+                        self._remember((model, hashes[i]), blob)
+                        _hits_disk.inc()
+                    else:
+                        still_missing.append(i)
+                missing = still_missing
+
+        _misses.inc(len(missing))
+        return [_unpack(b) if b is not None else None for b in found]
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        entries = [(text_hash(t), _pack(v)) for t, v in zip(texts, vectors)]
+        with self._lock:
+            for h, blob in entries:
+                self._remember((model, h), blob)
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                    [(model, h, blob) for h, blob in entries],
+                )
+                self._db.commit()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._lru),
+            "bytes_used": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "hits_memory": _hits_memory.value,
+            "hits_disk": _hits_disk.value,
+            "misses": _misses.value,
+            "evictions": _evictions.value,
+        }
+
+
+embedding_cache = EmbeddingCache()
+gauge("embed_cache_bytes", "bytes held by the in-process embedding LRU", fn=lambda: embedding_cache.bytes_used)
+
+
+def _split(model: str, texts: List[str]):
+    cached = embedding_cache.get_many(model, texts)
+    # dedupe misses so a repeated text inside one batch is embedded once
+    miss_texts = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+    return cached, miss_texts
+
+
+def _merge(texts: List[str], cached, miss_texts, miss_vectors) -> List[List[float]]:
+    fresh = dict(zip(miss_texts, miss_vectors))
+    return [v if v is not None else fresh[t] for t, v in zip(texts, cached)]
+
+
+def cached_embed(model: str, texts: List[str], embed_fn: Callable[[List[str]], Sequence[Sequence[float]]]) -> List[List[float]]:
+    """Sync version: embed_fn(list_of_texts) -> vectors is only called for cache misses."""
+    cached, miss_texts = _split(model, texts)
+    miss_vectors = []
+    if miss_texts:
+        miss_vectors = [list(v) for v in embed_fn(miss_texts)]
+        embedding_cache.put_many(model, miss_texts, miss_vectors)
+    return _merge(texts, cached, miss_texts, miss_vectors)
+
+
+async def cached_embed_async(model: str, texts: List[str], embed_fn: Callable[[List[str]], Awaitable[Sequence[Sequence[float]]]]) -> List[List[float]]:
+    """Async version: cache I/O runs on a thread, embed_fn is awaited for cache misses only."""
+    cached, miss_texts = await asyncio.to_thread(_split, model, texts)
+    miss_vectors = []
+    if miss_texts:
+        miss_vectors = [list(v) for v in await embed_fn(miss_texts)]
+        await asyncio.to_thread(embedding_cache.put_many, model, miss_texts, miss_vectors)
+    return _merge(texts, cached, miss_texts, miss_vectors)
@@ -0,0 +1,100 @@
+# app/services/embedding_recall.py
+#
+# Quality / speed check of an embedding backend against the fp32 PyTorch baseline.
+# For every query, the top-k passages found with the candidate backend are compared
+# with the top-k found with fp32 vectors (recall@k), and each candidate vector is
+# compared with its fp32 twin (cosine). Throughput of both backends is reported too.
+#
+#   python -m app.services.embedding_recall passages.txt [queries.txt] --backend onnx-int8 --k 10
+#
+# passages: one per line (e.g. chunks exported from a real upload); without a
+# queries file every 10th passage doubles as a query.
+import sys
+import time
+import argparse
+from typing import List, Optional
+
+import numpy as np
+
+from app.services.model_registry import DEFAULT_EMBED_MODEL, EMBED_BACKENDS, get_embedding_model
+
+RECALL_TOLERANCE = 0.95  # minimum mean recall@k vs fp32
+COSINE_TOLERANCE = 0.98  # minimum mean cosine(candidate vector, fp32 vector)
+
+
+def _encode(model_name: str, backend: str, texts: List[str], batch_size: int):
+    model = get_embedding_model(model_name, backend)
+    model.encode(texts[:batch_size], batch_size=batch_size)  # warm-up, not timed
+    started = time.perf_counter()
+    vectors = model.encode(texts, batch_size=batch_size, normalize_embeddings=True, show_progress_bar=False)
+    return np.asarray(vectors, dtype=np.float32), time.perf_counter() - started
+
+
+def _top_k(passages: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ passages.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def recall_check(
+    passages: List[str],
+    queries: Optional[List[str]] = None,
+    backend: str = "onnx-int8",
+    model_name: str = DEFAULT_EMBED_MODEL,
+    k: int = 10,
+    batch_size: int = 64,
+) -> dict:
+    queries = queries or passages[::10]
+    k = min(k, len(passages))
+
+    base_p, base_secs = _encode(model_name, "torch", passages, batch_size)
+    cand_p, cand_secs = _encode(model_name, backend, passages, batch_size)
+    base_q, _ = _encode(model_name, "torch", queries, batch_size)
+    cand_q, _ = _encode(model_name, backend, queries, batch_size)
+
+    base_top = _top_k(base_p, base_q, k)
+    cand_top = _top_k(cand_p, cand_q, k)
+    recalls = [len(set(b) & set(c)) / k for b, c in zip(base_top, cand_top)]
+    cosines = np.sum(base_p * cand_p, axis=1)
+
+    report = {
+        "model": model_name,
+        "backend": backend,
+        "passages": len(passages),
+        "queries": len(queries),
+        "k": k,
+        "recall_at_k": round(float(np.mean(recalls)), 4),
+        "worst_query_recall": round(float(np.min(recalls)), 4),
+        "mean_cosine_to_fp32": round(float(np.mean(cosines)), 5),
+        "min_cosine_to_fp32": round(float(np.min(cosines)), 5),
+        "fp32_texts_per_second": round(len(passages) / base_secs, 1),
+        "backend_texts_per_second": round(len(passages) / cand_secs, 1),
+        "speedup": round(base_secs / cand_secs, 2),
+    }
+    report["passed"] = report["recall_at_k"] >= RECALL_TOLERANCE and report["mean_cosine_to_fp32"] >= COSINE_TOLERANCE
+    return report
+
+
+def _read_lines(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare an embedding backend with fp32 PyTorch")
+    parser.add_argument("passages")
+    parser.add_argument("queries", nargs="?")
+    parser.add_argument("--backend", default="onnx-int8", choices=[b for b in EMBED_BACKENDS if b != "torch"])
+    parser.add_argument("--model", default=DEFAULT_EMBED_MODEL)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    result = recall_check(
+        _read_lines(args.passages),
+        _read_lines(args.queries) if args.queries else None,
+        backend=args.backend,
+        model_name=args.model,
+        k=args.k,
+    )
+    for key, value in result.items():
+        print(f"{key:>26}: {value}")
+    sys.exit(0 if result["passed"] else 1)
@@ -1,9 +1,9 @@
 import os
-from sentence_transformers import SentenceTransformer
+from app.services.model_registry import get_embedding_model
 
-# Load the embedding model once (downloads automatically the first time)
+# The model is loaded once per process by the model registry, on first use
 # You can change this model name to others like "all-MiniLM-L12-v2" if you want higher accuracy.
-model = SentenceTransformer("all-MiniLM-L6-v2")
+MODEL_NAME = "all-MiniLM-L6-v2"
 
 def embed_with_sentence_transformer(texts: list[str]) -> list[list[float]]:
     """
@@ -17,7 +17,7 @@ def embed_with_sentence_transformer(texts: list[str]) -> list[list[float]]:
     print(f"Generating embeddings for {len(texts)} text(s)...")
 
     # Generate embeddings (numpy array -> convert to list)
-    embeddings = model.encode(texts).tolist()
+    embeddings = get_embedding_model(MODEL_NAME).encode(texts).tolist()
     return embeddings
 
 
@@ -33,5 +33,5 @@ def embed_with_gemini(texts: list[str]) -> list[list[float]]:
     print(f"Generating embeddings for {len(texts)} text(s)...")
 
     # Generate embeddings (numpy array -> convert to list)
-    embeddings = model.encode(texts).tolist()
+    embeddings = get_embedding_model(MODEL_NAME).encode(texts).tolist()
     return embeddings
@@ -0,0 +1,453 @@
+# app/services/ingestion_jobs.py
+#
+# Background ingestion: train-files / train-url submit a job and return its id
+# right away; a bounded pool of asyncio workers runs parse -> embed -> upsert.
+#
+# - jobs live in the ingestion_jobs table, uploads are spooled under INGEST_JOB_DIR,
+#   so queued / interrupted jobs are picked up again after a restart
+# - a worker claims a job with one conditional UPDATE (queued, or running with an expired
+#   lease) and renews the lease while it runs, so with several API processes each job
+#   runs exactly once; every INGEST_RECLAIM_INTERVAL_S the table is scanned for jobs whose
+#   owner died (lease ran out) and for queued jobs submitted to another process
+# - progress (chunks_done) is checkpointed after every batch; a resumed job skips
+#   chunks that were already indexed (point ids are content-addressed)
+# - the queue is round-robin across companies so one tenant's big batch can't
+#   starve everybody else
+# - cancellation is a status flip in the DB, checked between batches
+import os
+import re
+import uuid
+import socket
+import shutil
+import asyncio
+import tempfile
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Optional, Tuple
+
+from fastapi import UploadFile
+from sqlalchemy import and_, or_, update
+
+from app.db.session import SessionLocal
+from app.models.ingestion_job import IngestionJob
+from app.services.chatbot_service import chunk_files, chunk_url, index_chunks
+
+# ---- CONFIG ----
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_JOB_DIR = os.getenv("INGEST_JOB_DIR", os.path.join(tempfile.gettempdir(), "tribe_ingest_jobs"))
+SPOOL_CHUNK_BYTES = 1024 * 1024
+INGEST_LEASE_S = float(os.getenv("INGEST_LEASE_S", "120"))
+INGEST_RECLAIM_INTERVAL_S = float(os.getenv("INGEST_RECLAIM_INTERVAL_S", "60"))
+
+# identifies this process as the owner of the jobs it runs
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+ACTIVE_STATUSES = ("queued", "running")
+FINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# ---- FAIR QUEUE ----
+class FairJobQueue:
+    """
+    One FIFO per company, served round-robin:
+    company A's 50 queued jobs don't delay company B's single job.
+    """
+
+    def __init__(self):
+        self._queues: Dict[int, Deque[str]] = {}
+        self._rotation: Deque[int] = deque()
+        self._ready = asyncio.Condition()
+
+    async def put(self, company_id: int, job_id: str):
+        async with self._ready:
+            if company_id not in self._queues:
+                self._queues[company_id] = deque()
+                self._rotation.append(company_id)
+            self._queues[company_id].append(job_id)
+            self._ready.notify()
+
+    async def get(self) -> str:
+        async with self._ready:
+            while not self._rotation:
+                await self._ready.wait()
+            company_id = self._rotation.popleft()
+            queue = self._queues[company_id]
+            job_id = queue.popleft()
+            if queue:
+                self._rotation.append(company_id)
+            else:
+                del self._queues[company_id]
+            return job_id
+
+    def remove(self, job_id: str) -> bool:
+        for company_id, queue in list(self._queues.items()):
+            if job_id in queue:
+                queue.remove(job_id)
+                if not queue:
+                    del self._queues[company_id]
+                    self._rotation.remove(company_id)
+                return True
+        return False
+
+    def contains(self, job_id: str) -> bool:
+        return any(job_id in queue for queue in self._queues.values())
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+
+job_queue = FairJobQueue()
+_workers: List[asyncio.Task] = []
+_reclaimer: Optional[asyncio.Task] = None
+
+
+# ---- DB helpers (sync session, run off the event loop) ----
+def _create_job(job_id: str, company_id: int, chatbot_id: int, kind: str, source: str):
+    db = SessionLocal()
+    try:
+        db.add(IngestionJob(
+            id=job_id, company_id=company_id, chatbot_id=chatbot_id,
+            kind=kind, source=source, status="queued", stage="queued",
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+
+def _load_job(job_id: str) -> Optional[IngestionJob]:
+    db = SessionLocal()
+    try:
+        job = db.get(IngestionJob, job_id)
+        if job is not None:
+            db.expunge(job)
+        return job
+    finally:
+        db.close()
+
+
+def _update_job(job_id: str, **fields) -> Optional[str]:
+    """Apply fields and return the job's current status (so callers notice a cancel)."""
+    db = SessionLocal()
+    try:
+        job = db.get(IngestionJob, job_id)
+        if job is None:
+            return None
+        if job.status == "cancelled" and fields.get("status") not in (None, "cancelled"):
+            # a cancel from the API wins over whatever the worker wanted to write
+            fields = {k: v for k, v in fields.items() if k not in ("status", "stage")}
+        for k, v in fields.items():
+            setattr(job, k, v)
+        db.commit()
+        return job.status
+    finally:
+        db.close()
+
+
+def _claimable():
+    # queued, or running but its owner stopped renewing the lease (crashed / shut down)
+    now = datetime.utcnow()
+    return or_(
+        IngestionJob.status == "queued",
+        and_(
+            IngestionJob.status == "running",
+            or_(IngestionJob.lease_until.is_(None), IngestionJob.lease_until < now),
+        ),
+    )
+
+
+def _claimable_jobs() -> List[Tuple[str, int]]:
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(IngestionJob.id, IngestionJob.company_id)
+            .filter(_claimable())
+            .order_by(IngestionJob.created_at)
+            .all()
+        )
+        return [(r.id, r.company_id) for r in rows]
+    finally:
+        db.close()
+
+
+def _claim_job(job_id: str) -> bool:
+    """Atomically make this process the job's owner; False if someone else holds it (or it's done)."""
+    db = SessionLocal()
+    try:
+        claimed = db.execute(
+            update(IngestionJob)
+            .where(IngestionJob.id == job_id, _claimable())
+            .values(
+                status="running",
+                owner=WORKER_ID,
+                lease_until=datetime.utcnow() + timedelta(seconds=INGEST_LEASE_S),
+            )
+            .returning(IngestionJob.id)
+        ).first()
+        db.commit()
+        return claimed is not None
+    finally:
+        db.close()
+
+
+def _renew_lease(job_id: str) -> bool:
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            update(IngestionJob)
+            .where(IngestionJob.id == job_id, IngestionJob.owner == WORKER_ID, IngestionJob.status == "running")
+            .values(lease_until=datetime.utcnow() + timedelta(seconds=INGEST_LEASE_S))
+        )
+        db.commit()
+        return result.rowcount > 0
+    finally:
+        db.close()
+
+
+def _release_leases():
+    """Shutdown: let another process resume our running jobs right away instead of after the lease."""
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(IngestionJob)
+            .where(IngestionJob.owner == WORKER_ID, IngestionJob.status == "running")
+            .values(lease_until=None)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _cancel_queued(job_id: str) -> bool:
+    """queued -> cancelled in one statement, so no worker can claim it in between."""
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            update(IngestionJob)
+            .where(IngestionJob.id == job_id, IngestionJob.status == "queued")
+            .values(status="cancelled", stage="finished", finished_at=datetime.utcnow())
+        )
+        db.commit()
+        return result.rowcount > 0
+    finally:
+        db.close()
+
+
+# ---- SPOOLING ----
+def _job_dir(job_id: str) -> str:
+    return os.path.join(INGEST_JOB_DIR, job_id)
+
+
+def _safe_name(filename: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]", "_", os.path.basename(filename or "upload"))
+
+
+async def _spool_files(job_id: str, files: List[UploadFile]) -> str:
+    job_dir = _job_dir(job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    for i, up in enumerate(files):
+        # index prefix keeps upload order; the rest is the original name
+        path = os.path.join(job_dir, f"{i:04d}_{_safe_name(up.filename)}")
+        with open(path, "wb") as f:
+            while True:
+                piece = await up.read(SPOOL_CHUNK_BYTES)
+                if not piece:
+                    break
+                f.write(piece)
+    return job_dir
+
+
+def _read_spooled_files(job_dir: str) -> List[Tuple[str, bytes]]:
+    files = []
+    for name in sorted(os.listdir(job_dir)):
+        with open(os.path.join(job_dir, name), "rb") as f:
+            files.append((name.split("_", 1)[1], f.read()))
+    return files
+
+
+# ---- SUBMIT / CANCEL / STATUS ----
+async def submit_files_job(company_id: int, chatbot_id: int, files: List[UploadFile]) -> str:
+    """The caller checks that company and chatbot exist; nothing is left on disk if this fails."""
+    job_id = str(uuid.uuid4())
+    try:
+        job_dir = await _spool_files(job_id, files)
+        await asyncio.to_thread(_create_job, job_id, company_id, chatbot_id, "files", job_dir)
+    except BaseException:
+        shutil.rmtree(_job_dir(job_id), ignore_errors=True)
+        raise
+    await job_queue.put(company_id, job_id)
+    return job_id
+
+
+async def submit_url_job(company_id: int, chatbot_id: int, url: str) -> str:
+    job_id = str(uuid.uuid4())
+    await asyncio.to_thread(_create_job, job_id, company_id, chatbot_id, "url", url)
+    await job_queue.put(company_id, job_id)
+    return job_id
+
+
+async def cancel_job(job_id: str) -> Optional[dict]:
+    job = await asyncio.to_thread(_load_job, job_id)
+    if job is None:
+        return None
+    if job.status in ACTIVE_STATUSES:
+        # queued: nobody runs it, so its spool can go now (another process's queue skips it
+        # when the claim fails); running: the owner sees the flag after its current batch
+        job_queue.remove(job_id)
+        if await asyncio.to_thread(_cancel_queued, job_id):
+            _cleanup(job)
+        else:
+            await asyncio.to_thread(_update_job, job_id, status="cancelled", finished_at=datetime.utcnow())
+    return await get_job_status(job_id)
+
+
+async def get_job_status(job_id: str) -> Optional[dict]:
+    job = await asyncio.to_thread(_load_job, job_id)
+    if job is None:
+        return None
+
+    elapsed = None
+    if job.started_at:
+        elapsed = ((job.finished_at or datetime.utcnow()) - job.started_at).total_seconds()
+    throughput = round(job.chunks_done / elapsed, 2) if elapsed else None
+
+    return {
+        "job_id": job.id,
+        "company_id": job.company_id,
+        "chatbot_id": job.chatbot_id,
+        "kind": job.kind,
+        "status": job.status,
+        "stage": job.stage,
+        "chunks_done": job.chunks_done,
+        "chunks_total": job.chunks_total,
+        "chunks_per_second": throughput,
+        "elapsed_seconds": round(elapsed, 2) if elapsed is not None else None,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+# ---- WORKERS ----
+def _cleanup(job: IngestionJob):
+    if job.kind == "files":
+        shutil.rmtree(job.source, ignore_errors=True)
+
+
+async def _heartbeat(job_id: str):
+    while True:
+        await asyncio.sleep(INGEST_LEASE_S / 3)
+        try:
+            if not await asyncio.to_thread(_renew_lease, job_id):
+                return  # finished, cancelled or taken over
+        except Exception as e:
+            print(f"⚠️ Could not renew lease of ingestion job {job_id}: {e}")
+
+
+async def _run_job(job_id: str) -> bool:
+    """Run the job if this process can claim it; False if it was skipped."""
+    if not await asyncio.to_thread(_claim_job, job_id):
+        return False  # done, cancelled, or running in another process
+    heartbeat = asyncio.create_task(_heartbeat(job_id))
+    try:
+        await _run_claimed_job(job_id)
+    finally:
+        heartbeat.cancel()
+    return True
+
+
+async def _run_claimed_job(job_id: str):
+    job = await asyncio.to_thread(_load_job, job_id)
+    if job is None:
+        return
+
+    started_at = job.started_at or datetime.utcnow()
+    status = await asyncio.to_thread(_update_job, job_id, stage="parsing", started_at=started_at)
+    if status == "cancelled":
+        raise JobCancelled()
+
+    if job.kind == "files":
+        files = await asyncio.to_thread(_read_spooled_files, job.source)
+        chunks = await chunk_files(files)
+    else:
+        chunks = await chunk_url(job.source)
+
+    async def on_progress(done: int, total: int):
+        status = await asyncio.to_thread(_update_job, job_id, chunks_done=done, chunks_total=total)
+        if status == "cancelled":
+            raise JobCancelled()
+
+    status = await asyncio.to_thread(_update_job, job_id, stage="indexing")
+    if status == "cancelled":
+        raise JobCancelled()
+
+    # point ids are content-addressed, so a resumed job only embeds what's still missing
+    await index_chunks(job.chatbot_id, chunks, on_progress=on_progress)
+    await asyncio.to_thread(
+        _update_job, job_id, status="succeeded", stage="finished", finished_at=datetime.utcnow()
+    )
+
+
+async def _worker():
+    while True:
+        job_id = await job_queue.get()
+        try:
+            if not await _run_job(job_id):
+                continue
+        except JobCancelled:
+            print(f"🛑 Ingestion job {job_id} cancelled")
+        except asyncio.CancelledError:
+            # app shutdown: the job stays 'running'; its lease is released so it resumes elsewhere
+            raise
+        except Exception as e:
+            print(f"❌ Ingestion job {job_id} failed: {e}")
+            await asyncio.to_thread(
+                _update_job, job_id, status="failed", error=str(e), finished_at=datetime.utcnow()
+            )
+
+        job = await asyncio.to_thread(_load_job, job_id)
+        if job is not None and job.status in FINAL_STATUSES:
+            _cleanup(job)
+
+
+async def _enqueue_claimable():
+    # queue whatever could be claimed now; the claim itself decides who runs it
+    for job_id, company_id in await asyncio.to_thread(_claimable_jobs):
+        if not job_queue.contains(job_id):
+            await job_queue.put(company_id, job_id)
+
+
+async def _reclaim_loop():
+    while True:
+        await asyncio.sleep(INGEST_RECLAIM_INTERVAL_S)
+        try:
+            await _enqueue_claimable()
+        except Exception as e:
+            print(f"❌ Ingestion job reclaim failed: {e}")
+
+
+async def start_ingestion_workers():
+    """Start the worker pool; queued jobs and running jobs whose lease expired are picked up."""
+    global _reclaimer
+    await _enqueue_claimable()
+    for _ in range(INGEST_WORKERS):
+        _workers.append(asyncio.create_task(_worker()))
+    _reclaimer = asyncio.create_task(_reclaim_loop())
+
+
+async def stop_ingestion_workers():
+    global _reclaimer
+    tasks = _workers + ([_reclaimer] if _reclaimer else [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _workers.clear()
+    _reclaimer = None
+    try:
+        await asyncio.to_thread(_release_leases)
+    except Exception as e:
+        print(f"⚠️ Could not release ingestion job leases: {e}")
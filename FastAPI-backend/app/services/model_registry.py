@@ -0,0 +1,188 @@
+# app/services/model_registry.py
+#
+# One place that owns the local SentenceTransformer models.
+# - each model is loaded once per process, on first use or by warm_embedding_models()
+#   at startup (in the background, so "/" answers before the weights are in memory)
+# - EMBED_BACKEND picks the runtime per deployment:
+#     torch      fp32 PyTorch (default)
+#     onnx       ONNX Runtime, fp32 graph
+#     onnx-int8  ONNX Runtime, dynamically int8-quantized graph (fastest on CPU-only nodes)
+#   check quality against fp32 with: python -m app.services.embedding_recall <passages.txt>
+# - cross-encoders (reranking) are held here too, under the "cross-encoder" backend
+# - importing this module does not import sentence_transformers / torch at all
+# - vector dimensions are recorded per model; well-known ones are answered without
+#   loading the model, so collection setup doesn't have to wait for it
+# - import / load times are exported as gauges on GET /metrics to track cold starts
+import os
+import re
+import time
+import asyncio
+import tempfile
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from app.utils.metrics import gauge
+
+# ---- CONFIG ----
+DEFAULT_EMBED_MODEL = os.getenv("LOCAL_EMBED_MODEL", "all-MiniLM-L6-v2")
+WARM_EMBED_MODELS = [m for m in os.getenv("WARM_EMBED_MODELS", DEFAULT_EMBED_MODEL).split(",") if m.strip()]
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+EMBED_BACKENDS = ("torch", "onnx", "onnx-int8")
+# pre-quantized graph shipped in the model repo (sentence-transformers models publish these under onnx/)
+EMBED_ONNX_INT8_FILE = os.getenv("EMBED_ONNX_INT8_FILE", "onnx/model_quint8_avx2.onnx")
+# when the repo has no quantized graph we quantize once and keep the result here
+EMBED_QUANT_CONFIG = os.getenv("EMBED_QUANT_CONFIG", "avx2")  # arm64 | avx2 | avx512 | avx512_vnni
+EMBED_ONNX_CACHE_DIR = os.getenv("EMBED_ONNX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tribe_onnx_models"))
+
+# dimension of models we know, checked against the real model once it's loaded
+KNOWN_DIMENSIONS = {
+    "all-MiniLM-L6-v2": 384,
+    "all-MiniLM-L12-v2": 384,
+    "paraphrase-MiniLM-L3-v2": 384,
+    "all-mpnet-base-v2": 768,
+    "BAAI/bge-small-en-v1.5": 384,
+    "BAAI/bge-base-en-v1.5": 768,
+}
+
+
+def _metric_name(model_name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", model_name).strip("_").lower()
+
+
+def embedding_cache_key(name: str, backend: str = EMBED_BACKEND) -> str:
+    """Embedding-cache namespace: vectors from different runtimes aren't bit-identical."""
+    return f"st:{name}" if backend == "torch" else f"st:{name}:{backend}"
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._models: Dict[Tuple[str, str], object] = {}
+        self._dimensions: Dict[str, int] = dict(KNOWN_DIMENSIONS)
+        self._load_seconds: Dict[Tuple[str, str], float] = {}
+        self._locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._registry_lock = threading.Lock()
+        self._st_class = None
+        self.import_seconds: Optional[float] = None
+
+    def _sentence_transformer_class(self):
+        # torch + sentence_transformers take seconds to import; only pay for it when a model is needed
+        if self._st_class is None:
+            started = time.perf_counter()
+            from sentence_transformers import SentenceTransformer
+            self.import_seconds = time.perf_counter() - started
+            gauge("embed_model_import_seconds", "time to import sentence_transformers").set(round(self.import_seconds, 3))
+            self._st_class = SentenceTransformer
+        return self._st_class
+
+    def _lock_for(self, key: Tuple[str, str]) -> threading.Lock:
+        with self._registry_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def is_loaded(self, name: str, backend: str = EMBED_BACKEND) -> bool:
+        return (name, backend) in self._models
+
+    def _load_int8(self, cls, name: str):
+        try:
+            return cls(name, backend="onnx", model_kwargs={"file_name": EMBED_ONNX_INT8_FILE})
+        except Exception as e:
+            print(f"⚠️ {name} has no {EMBED_ONNX_INT8_FILE} ({e}); quantizing locally")
+
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        target = os.path.join(EMBED_ONNX_CACHE_DIR, _metric_name(name))
+        suffix = f"qint8_{EMBED_QUANT_CONFIG}_local"
+        file_name = f"onnx/model_{suffix}.onnx"
+        if not os.path.exists(os.path.join(target, file_name)):
+            fp32 = cls(name, backend="onnx")
+            fp32.save(target)
+            export_dynamic_quantized_onnx_model(fp32, EMBED_QUANT_CONFIG, target, file_suffix=suffix)
+        return cls(target, backend="onnx", model_kwargs={"file_name": file_name})
+
+    def _load(self, name: str, backend: str):
+        cls = self._sentence_transformer_class()
+        if backend == "torch":
+            return cls(name)
+        if backend == "onnx":
+            return cls(name, backend="onnx")
+        if backend == "onnx-int8":
+            return self._load_int8(cls, name)
+        if backend == "cross-encoder":
+            from sentence_transformers import CrossEncoder
+            return CrossEncoder(name)
+        raise ValueError(f"Unknown EMBED_BACKEND {backend!r}, expected one of {EMBED_BACKENDS}")
+
+    def get(self, name: str = DEFAULT_EMBED_MODEL, backend: str = EMBED_BACKEND):
+        """The loaded model; the first caller loads it, concurrent callers wait for that load."""
+        key = (name, backend)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock_for(key):
+            model = self._models.get(key)
+            if model is not None:
+                return model
+
+            started = time.perf_counter()
+            model = self._load(name, backend)
+            elapsed = time.perf_counter() - started
+
+            dim = model.get_sentence_embedding_dimension() if hasattr(model, "get_sentence_embedding_dimension") else None
+            known = self._dimensions.get(name)
+            if known is not None and dim is not None and known != dim:
+                print(f"⚠️ Model {name} has dimension {dim}, expected {known}")
+            if dim is not None:
+                self._dimensions[name] = dim
+            self._load_seconds[key] = elapsed
+            gauge(f"embed_model_load_seconds_{_metric_name(name)}_{_metric_name(backend)}", f"time to load {name} ({backend})").set(round(elapsed, 3))
+            print(f"🧠 Loaded embedding model {name} [{backend}] (dim={dim}) in {elapsed:.2f}s")
+
+            self._models[key] = model
+            return model
+
+    def dimension(self, name: str = DEFAULT_EMBED_MODEL) -> int:
+        dim = self._dimensions.get(name)
+        if dim is None:
+            self.get(name)
+            dim = self._dimensions[name]
+        return dim
+
+    def stats(self) -> dict:
+        keys = set(self._models) | {(name, EMBED_BACKEND) for name in WARM_EMBED_MODELS}
+        return {
+            "import_seconds": self.import_seconds,
+            "backend": EMBED_BACKEND,
+            "models": {
+                f"{name} [{backend}]": {
+                    "loaded": (name, backend) in self._models,
+                    "dimension": self._dimensions.get(name),
+                    "load_seconds": self._load_seconds.get((name, backend)),
+                }
+                for name, backend in sorted(keys)
+            },
+        }
+
+
+model_registry = ModelRegistry()
+gauge("embed_models_loaded", "local embedding models held in memory", fn=lambda: len(model_registry._models))
+
+
+def get_embedding_model(name: str = DEFAULT_EMBED_MODEL, backend: str = EMBED_BACKEND):
+    return model_registry.get(name, backend)
+
+
+def get_cross_encoder(name: str):
+    return model_registry.get(name, "cross-encoder")
+
+
+def embedding_dimension(name: str = DEFAULT_EMBED_MODEL) -> int:
+    return model_registry.dimension(name)
+
+
+async def warm_embedding_models(names: Iterable[str] = WARM_EMBED_MODELS):
+    """Load models off the event loop; meant to run as a background task on startup."""
+    for name in names:
+        try:
+            await asyncio.to_thread(model_registry.get, name.strip())
+        except Exception as e:
+            print(f"❌ Could not load embedding model {name}: {e}")
@@ -0,0 +1,409 @@
+# app/services/ollama_client.py
+#
+# One pooled httpx.AsyncClient per Ollama backend for all Ollama traffic (embed, generate,
+# chat, warm-up). Created on app startup, closed on shutdown; keep-alive connections are
+# reused across requests instead of a new TCP handshake per call.
+#
+# With several backends (OLLAMA_URLS) the pool load-balances:
+# - requests carrying an affinity key (the chat session) always go to the same backend -
+#   rendezvous hashing - so that backend still holds the conversation's KV cache
+# - everything else (embeddings, training generation, first turns) goes to the backend
+#   with the fewest outstanding requests, ties broken by recent latency
+# - a backend failing OLLAMA_EJECT_AFTER times in a row is ejected for OLLAMA_EJECT_SECONDS
+#   (passive), and GET /api/version is polled every OLLAMA_HEALTH_INTERVAL_S (active);
+#   unavailable backends are only tried once the healthy ones have failed
+# - per-backend outstanding / latency / error stats are on GET /metrics (ollama_backends)
+# Any HTTP server speaking the Ollama API works as a backend, so local stub servers can
+# stand in for Ollama by listing them in OLLAMA_URLS.
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from app.utils.metrics import counter, gauge, histogram, LATENCY_BUCKETS_S
+
+# ---- CONFIG ----
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434")
+OLLAMA_URLS = [u.strip().rstrip("/") for u in os.getenv("OLLAMA_URLS", OLLAMA_URL).split(",") if u.strip()]
+# how long Ollama keeps a model (and its KV cache) loaded after a request
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "32"))
+OLLAMA_MAX_KEEPALIVE = int(os.getenv("OLLAMA_MAX_KEEPALIVE", "16"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "60"))
+OLLAMA_HTTP2 = os.getenv("OLLAMA_HTTP2", "0") == "1"  # only useful behind an h2-capable proxy
+OLLAMA_RETRIES = int(os.getenv("OLLAMA_RETRIES", "2"))
+OLLAMA_RETRY_BASE = float(os.getenv("OLLAMA_RETRY_BASE", "0.2"))  # seconds, full-jitter backoff
+OLLAMA_EJECT_AFTER = int(os.getenv("OLLAMA_EJECT_AFTER", "3"))  # consecutive failures
+OLLAMA_EJECT_SECONDS = float(os.getenv("OLLAMA_EJECT_SECONDS", "30"))
+OLLAMA_HEALTH_INTERVAL_S = float(os.getenv("OLLAMA_HEALTH_INTERVAL_S", "10"))
+OLLAMA_LATENCY_ALPHA = 0.2  # EWMA weight of the newest sample
+
+# per-operation timeouts: connect fast, read as long as the operation legitimately takes
+OP_TIMEOUTS = {
+    "embed": httpx.Timeout(60.0, connect=5.0),
+    "generate": httpx.Timeout(120.0, connect=5.0),
+    "chat": httpx.Timeout(60.0, connect=5.0),
+    "warm": httpx.Timeout(300.0, connect=5.0),  # first load of a model can be slow
+    "probe": httpx.Timeout(5.0, connect=2.0),  # /api/ps, /api/version health checks
+    "crawl": httpx.Timeout(30.0, connect=10.0),
+}
+
+# failures worth retrying: nothing reached the model, or the server said "try again"
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+RETRYABLE_STATUS = {502, 503, 504}
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_health_task: Optional[asyncio.Task] = None
+_web_client: Optional[httpx.AsyncClient] = None
+_web_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_closing: set = set()  # close tasks of clients left behind by another event loop
+
+_in_flight = gauge("ollama_requests_in_flight", "Ollama requests currently using the pool")
+_requests = counter("ollama_requests_total", "Ollama requests sent (including retries)")
+_retries = counter("ollama_retries_total", "Ollama requests retried")
+_errors = counter("ollama_errors_total", "Ollama requests that failed after all retries")
+
+
+def _pool_connections() -> int:
+    # httpx doesn't expose pool stats publicly; peek at the transport's pool
+    total = 0
+    for client in list(_clients.values()):
+        try:
+            total += len(client._transport._pool.connections)
+        except Exception:
+            pass
+    return total
+
+
+gauge("ollama_pool_connections", "open connections in the Ollama pool", fn=_pool_connections)
+gauge(
+    "ollama_pool_utilisation",
+    "in-flight requests / max pool connections",
+    fn=lambda: round(_in_flight.value / (OLLAMA_MAX_CONNECTIONS * len(OLLAMA_URLS)), 3),
+)
+
+
+@dataclass
+class Backend:
+    url: str
+    outstanding: int = 0
+    latency_ewma: Optional[float] = None  # seconds
+    requests: int = 0
+    errors: int = 0
+    consecutive_failures: int = 0
+    ejected_until: float = 0.0
+    healthy: bool = True  # last active health check
+
+    def __post_init__(self):
+        name = re.sub(r"[^A-Za-z0-9]+", "_", self.url.split("://")[-1]).strip("_").lower()
+        self.latency = histogram(f"ollama_backend_seconds_{name}", LATENCY_BUCKETS_S, f"Ollama latency on {self.url}")
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+    def record(self, ok: bool, elapsed: Optional[float] = None):
+        self.requests += 1
+        if ok:
+            self.consecutive_failures = 0
+            if elapsed is not None:
+                self.latency.observe(elapsed)
+                self.latency_ewma = elapsed if self.latency_ewma is None else (
+                    OLLAMA_LATENCY_ALPHA * elapsed + (1 - OLLAMA_LATENCY_ALPHA) * self.latency_ewma
+                )
+            return
+        self.errors += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= OLLAMA_EJECT_AFTER and len(_backends) > 1:
+            self.ejected_until = time.monotonic() + OLLAMA_EJECT_SECONDS
+            self.consecutive_failures = 0
+            _ejections.inc()
+            print(f"⚠️ Ollama backend {self.url} ejected for {OLLAMA_EJECT_SECONDS:.0f}s after repeated failures")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "available": self.available(now),
+            "healthy": self.healthy,
+            "ejected_for_s": round(max(0.0, self.ejected_until - now), 1),
+            "outstanding": self.outstanding,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+
+_backends: Dict[str, Backend] = {url: Backend(url) for url in OLLAMA_URLS}
+_ejections = counter("ollama_backend_ejections_total", "backends ejected after consecutive failures")
+gauge("ollama_backends", "per-backend routing stats", fn=lambda: {url: b.stats() for url, b in _backends.items()})
+
+
+def _new_client(base_url: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=base_url,
+        http2=OLLAMA_HTTP2,
+        limits=httpx.Limits(
+            max_connections=OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=OLLAMA_MAX_KEEPALIVE,
+            keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+        ),
+        timeout=OP_TIMEOUTS["generate"],
+    )
+
+
+async def _aclose_quietly(client: httpx.AsyncClient):
+    try:
+        await client.aclose()
+    except Exception:
+        pass  # its connections belonged to a loop that is gone; their sockets close on GC
+
+
+def _retire(clients: List[httpx.AsyncClient], old_loop: Optional[asyncio.AbstractEventLoop]):
+    """Close clients created on another event loop instead of just dropping their pools."""
+    for client in clients:
+        if old_loop is not None and old_loop.is_running():
+            # still serving in another thread: close there, where its connections live
+            asyncio.run_coroutine_threadsafe(_aclose_quietly(client), old_loop)
+        else:
+            task = asyncio.get_running_loop().create_task(_aclose_quietly(client))
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+
+
+def get_ollama_client(backend: Optional[str] = None) -> httpx.AsyncClient:
+    """The shared client of a backend (recreated if called from a different event loop, e.g. asyncio.run wrappers)."""
+    global _client_loop
+    backend = backend or OLLAMA_URLS[0]
+    loop = asyncio.get_running_loop()
+    if _client_loop is not loop:
+        _retire(list(_clients.values()), _client_loop)
+        _clients.clear()
+        _client_loop = loop
+    client = _clients.get(backend)
+    if client is None:
+        client = _clients[backend] = _new_client(backend)
+    return client
+
+
+def backend_order(affinity_key: Optional[str] = None) -> List[str]:
+    """
+    Backends in the order to try them: available ones first, ejected / unhealthy ones last.
+    With an affinity key the order is fixed per key (rendezvous hashing: adding / removing
+    a backend only moves the keys it owned); without one, least outstanding requests first.
+    """
+    if len(_backends) == 1:
+        return list(_backends)
+    now = time.monotonic()
+    if affinity_key is None:
+        key = lambda b: (b.outstanding, b.latency_ewma or 0.0, random.random())
+        reverse = False
+    else:
+        key = lambda b: hashlib.sha1(f"{affinity_key}|{b.url}".encode("utf-8")).digest()
+        reverse = True
+    available = sorted((b for b in _backends.values() if b.available(now)), key=key, reverse=reverse)
+    fallback = sorted((b for b in _backends.values() if not b.available(now)), key=key, reverse=reverse)
+    return [b.url for b in available + fallback]
+
+
+def backend_stats() -> Dict[str, dict]:
+    return {url: b.stats() for url, b in _backends.items()}
+
+
+async def _health_loop():
+    while True:
+        for backend in list(_backends.values()):
+            try:
+                resp = await get_ollama_client(backend.url).get("/api/version", timeout=OP_TIMEOUTS["probe"])
+                healthy = resp.status_code == 200
+            except Exception:
+                healthy = False
+            if healthy != backend.healthy:
+                print(f"{'✅' if healthy else '⚠️'} Ollama backend {backend.url} is {'healthy' if healthy else 'unhealthy'}")
+            backend.healthy = healthy
+        await asyncio.sleep(OLLAMA_HEALTH_INTERVAL_S)
+
+
+def get_web_client() -> httpx.AsyncClient:
+    """Shared pooled client for non-Ollama fetches (URL training crawler)."""
+    global _web_client, _web_client_loop
+    loop = asyncio.get_running_loop()
+    if _web_client is None or _web_client_loop is not loop:
+        if _web_client is not None:
+            _retire([_web_client], _web_client_loop)
+        _web_client = httpx.AsyncClient(timeout=OP_TIMEOUTS["crawl"], follow_redirects=True)
+        _web_client_loop = loop
+    return _web_client
+
+
+async def start_ollama_client():
+    global _health_task
+    for backend in OLLAMA_URLS:
+        get_ollama_client(backend)
+    get_web_client()
+    if len(_backends) > 1 and _health_task is None:
+        _health_task = asyncio.create_task(_health_loop())
+
+
+async def close_ollama_client():
+    global _web_client, _health_task
+    if _health_task is not None:
+        _health_task.cancel()
+        try:
+            await _health_task
+        except asyncio.CancelledError:
+            pass
+        _health_task = None
+    for client in [*_clients.values(), _web_client]:
+        if client is not None:
+            await client.aclose()
+    _clients.clear()
+    _web_client = None
+
+
+def _with_keep_alive(op: str, payload: dict) -> dict:
+    if op in ("chat", "generate", "embed", "warm") and "keep_alive" not in payload:
+        return {**payload, "keep_alive": OLLAMA_KEEP_ALIVE}
+    return payload
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, OLLAMA_RETRY_BASE * (2 ** attempt))
+
+
+async def ollama_post(
+    op: str,
+    path: str,
+    payload: dict,
+    affinity_key: Optional[str] = None,
+    backend: Optional[str] = None,
+) -> httpx.Response:
+    """
+    POST to Ollama through the shared pool.
+    op selects the timeout and the latency histogram (embed / generate / chat / warm).
+    Connection-level failures and 502/503/504 are retried with jittered backoff,
+    moving on to the next backend in affinity order (or the same one, if `backend` pins it);
+    other responses are returned as-is for the caller to inspect.
+    """
+    backends = [backend] if backend else backend_order(affinity_key)
+    payload = _with_keep_alive(op, payload)
+    latency = histogram(f"ollama_{op}_seconds", LATENCY_BUCKETS_S, f"Ollama {op} latency")
+    timeout = OP_TIMEOUTS.get(op, OP_TIMEOUTS["generate"])
+
+    attempt = 0
+    while True:
+        target = _backends[backends[attempt % len(backends)]]
+        client = get_ollama_client(target.url)
+        _requests.inc()
+        _in_flight.inc()
+        target.outstanding += 1
+        started = time.perf_counter()
+        try:
+            resp = await client.post(path, json=payload, timeout=timeout)
+        except RETRYABLE_ERRORS:
+            target.record(False)
+            if attempt >= OLLAMA_RETRIES:
+                _errors.inc()
+                raise
+        except Exception:
+            target.record(False)
+            _errors.inc()
+            raise
+        else:
+            elapsed = time.perf_counter() - started
+            latency.observe(elapsed)
+            target.record(resp.status_code < 500, elapsed)
+            if resp.status_code not in RETRYABLE_STATUS or attempt >= OLLAMA_RETRIES:
+                return resp
+        finally:
+            _in_flight.dec()
+            target.outstanding -= 1
+
+        _retries.inc()
+        await asyncio.sleep(_backoff(attempt))
+        attempt += 1
+
+
+async def ollama_get(path: str, backend: str) -> httpx.Response:
+    """Single GET against one backend with the short probe timeout; no retries (callers poll)."""
+    return await get_ollama_client(backend).get(path, timeout=OP_TIMEOUTS["probe"])
+
+
+async def ollama_stream(
+    op: str,
+    path: str,
+    payload: dict,
+    affinity_key: Optional[str] = None,
+    backend: Optional[str] = None,
+) -> AsyncIterator[dict]:
+    """
+    POST with "stream": true and yield each NDJSON object Ollama sends.
+    Connection failures are retried only before the first byte arrives -
+    once tokens have been forwarded to a client the request can't be replayed.
+    `backend` pins the request to one backend, as in ollama_post.
+    """
+    backends = [backend] if backend else backend_order(affinity_key)
+    latency = histogram(f"ollama_{op}_seconds", LATENCY_BUCKETS_S, f"Ollama {op} latency")
+    timeout = OP_TIMEOUTS.get(op, OP_TIMEOUTS["generate"])
+    payload = {**_with_keep_alive(op, payload), "stream": True}
+
+    attempt = 0
+    received = False
+    while True:
+        target = _backends[backends[attempt % len(backends)]]
+        client = get_ollama_client(target.url)
+        _requests.inc()
+        _in_flight.inc()
+        target.outstanding += 1
+        started = time.perf_counter()
+        try:
+            async with client.stream("POST", path, json=payload, timeout=timeout) as resp:
+                if resp.status_code in RETRYABLE_STATUS and attempt < OLLAMA_RETRIES:
+                    await resp.aread()
+                    target.record(False)
+                else:
+                    resp.raise_for_status()
+                    recorded = False
+                    async for line in resp.aiter_lines():
+                        if line.strip():
+                            received = True
+                            part = json.loads(line)
+                            if part.get("done") and not recorded:
+                                # callers usually stop at the done frame and never resume us,
+                                # so the success is recorded before it is handed over
+                                recorded = True
+                                elapsed = time.perf_counter() - started
+                                latency.observe(elapsed)
+                                target.record(True, elapsed)
+                            yield part
+                    if not recorded:
+                        elapsed = time.perf_counter() - started
+                        latency.observe(elapsed)
+                        target.record(True, elapsed)
+                    return
+        except RETRYABLE_ERRORS:
+            target.record(False)
+            if received or attempt >= OLLAMA_RETRIES:
+                _errors.inc()
+                raise
+        except httpx.HTTPStatusError as e:
+            target.record(e.response.status_code < 500)
+            _errors.inc()
+            raise
+        except Exception:
+            target.record(False)
+            _errors.inc()
+            raise
+        finally:
+            _in_flight.dec()
+            target.outstanding -= 1
+
+        _retries.inc()
+        await asyncio.sleep(_backoff(attempt))
+        attempt += 1
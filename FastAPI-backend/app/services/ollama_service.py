@@ -1,12 +1,42 @@
 # app/services/ollama_service.py
-
+#
+# Prompt layout (PROMPT_LAYOUT):
+#   prefix (default) - system prompt, then the conversation as real user / assistant turns,
+#                      then one user message with the retrieved context + the question.
+#                      Earlier turns are replayed as the bare question + answer, so the
+#                      prompt matches the previous turn's up to the start of that turn's
+#                      user message (which carried its retrieved context): Ollama reuses its
+#                      KV cache for the system prompt and all older turns, and prefills the
+#                      previous question + answer and the new context + question.
+#                      This needs the conversation in `history` (the client's `context`);
+#                      without it only the system prompt is shared between turns.
+#   legacy           - context first, history flattened into the same user message; the
+#                      prompt changes from its first token every turn (full prefill).
+# Ollama's prompt_eval_count / prompt_eval_duration are recorded per layout
+# (ollama_prefill_*_{layout}), so the two can be compared on /metrics.
+# Only the Ollama call itself holds an admission slot: answer-cache hits never queue, and
+# retrieval / prompt building happen before the slot is taken.
 import os
-import httpx
+import time
+from typing import AsyncIterator, List, Optional, Tuple
 from app.services.qdrant_service import search_similar_vectors
-from app.services.qdrant_service import retrieve_chunks
+from app.services.qdrant_service import retrieve_chunks, embed_query
+from app.services.answer_cache import answer_cache, refresh_generation, ANSWER_CACHE_ENABLED
+from app.services.ollama_client import OLLAMA_URL, ollama_post, ollama_stream
+from app.services.admission import Slot, admit
+from app.services.prompt_builder import assemble, TOKEN_BUCKETS
+from app.utils.metrics import histogram, LATENCY_BUCKETS_S
 
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434")
 LLM_MODEL = os.getenv("OLLAMA_LLM_MODEL", "llama3.2")  # change to the model you pulled via `ollama pull`
+PROMPT_LAYOUT = "legacy" if os.getenv("PROMPT_LAYOUT", "prefix") == "legacy" else "prefix"
+
+_ttft = histogram("chat_time_to_first_token_seconds", LATENCY_BUCKETS_S, "request start -> first streamed token")
+_prefill_seconds = histogram(
+    f"ollama_prefill_seconds_{PROMPT_LAYOUT}", LATENCY_BUCKETS_S, f"Ollama prompt evaluation time ({PROMPT_LAYOUT} layout)"
+)
+_prefill_tokens = histogram(
+    f"ollama_prefill_tokens_{PROMPT_LAYOUT}", TOKEN_BUCKETS, f"prompt tokens Ollama had to evaluate ({PROMPT_LAYOUT} layout)"
+)
 
 
 # chat history
@@ -22,68 +52,235 @@ def build_chat_history(history: list[dict]) -> str:
     return "\n".join(formatted)
 
 
-async def generate_reply(message: str, chatbot_id: str, history: list[dict]):
+SYSTEM_PROMPT = (
+    "You are a helpful company assistant.\n"
+    "Use the provided knowledge-base context when answering factual questions.\n"
+    "If the user's message is conversational (like 'ok', 'thanks', 'yes', 'continue', etc.), "
+    "respond naturally without requiring context.\n"
+    "If the user asks a factual question and the answer is NOT found in the knowledge context, reply:\n"
+    "'I don’t have information about that.'\n"
+    "Never invent facts.\n"
+    "Keep responses clear, concise, friendly, and conversational."
+)
 
-    print("🔵 OLLAMA_URL =", OLLAMA_URL)
+
+async def build_prompt(
+    message: str,
+    chatbot_id: str,
+    history: list[dict] | None = None,
+    query_vector: Optional[List[float]] = None,
+    report: dict | None = None,
+) -> list[dict]:
+    """
+    Chat messages for Ollama, fitted to the token budget (see prompt_builder).
+    The token counts that were used are written into `report` if given.
+    """
 
     # 1️⃣ Retrieve relevant context from Qdrant
-    user_message = message
-    chunks = retrieve_chunks(user_message, chatbot_id)
+    chunks = await retrieve_chunks(message, chatbot_id, query_vector=query_vector)
+
+    # 2️⃣ Keep the best chunks / most recent turns that fit the budget
+    parts = assemble(SYSTEM_PROMPT, message, chunks, history)
+    if report is not None:
+        report.update(parts.report)
 
     context = (
         "No knowledge base found for this chatbot."
-        if not chunks else "\n\n".join(chunks)
+        if not parts.context else "\n\n".join(parts.context)
     )
 
-    chat_history = build_chat_history(history)
+    # 3️⃣ Build prompt
+    if PROMPT_LAYOUT == "prefix":
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        for turn in parts.history:
+            messages.append({"role": "user", "content": turn.get("query", "")})
+            messages.append({"role": "assistant", "content": turn.get("answer", "")})
+        messages.append({
+            "role": "user",
+            "content": f"Knowledge Base Context:\n{context}\n\nUser question: {parts.question}"
+        })
+        return messages
 
-    # 2️⃣ Build prompt
-    prompt = [
+    chat_history = build_chat_history(parts.history)
+    return [
         {
             "role": "system",
-            "content": (
-                "You are a helpful company assistant.\n"
-                "Use the provided knowledge-base context when answering factual questions.\n"
-                "If the user's message is conversational (like 'ok', 'thanks', 'yes', 'continue', etc.), "
-                "respond naturally without requiring context.\n"
-                "If the user asks a factual question and the answer is NOT found in the knowledge context, reply:\n"
-                "'I don’t have information about that.'\n"
-                "Never invent facts.\n"
-                "Keep responses clear, concise, friendly, and conversational."
-            )
+            "content": SYSTEM_PROMPT
         },
         {
             "role": "user",
             "content": (
                 f"Knowledge Base Context:\n{context}\n\n"
                 f"Conversation History:\n{chat_history}\n\n"
-                f"User question: {user_message}"
+                f"User question: {parts.question}"
             )
         }
     ]
 
-    # 3️⃣ Call Ollama
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(
-            f"{OLLAMA_URL}/api/chat",
-            json={
+
+def _record_prefill(data: dict, info: dict | None):
+    """Prefill stats from Ollama's final response object (durations are in nanoseconds)."""
+    count = data.get("prompt_eval_count")
+    duration = data.get("prompt_eval_duration")
+    if count is None or duration is None:
+        return
+    _prefill_seconds.observe(duration / 1e9)
+    _prefill_tokens.observe(count)
+    if info is not None:
+        info["prefill"] = {
+            "layout": PROMPT_LAYOUT,
+            "prompt_eval_count": count,
+            "prompt_eval_ms": round(duration / 1e6, 1),
+            "load_ms": round((data.get("load_duration") or 0) / 1e6, 1),
+        }
+
+
+# ---- SEMANTIC ANSWER CACHE ----
+async def _cache_lookup(message: str, chatbot_id: str, history: list[dict] | None):
+    """
+    (cached answer or None, question vector, cache generation).
+    Follow-ups (non-empty history) bypass the cache; the vector is still reused for retrieval.
+    """
+    if not ANSWER_CACHE_ENABLED or history:
+        return None, None, None
+    vector = await embed_query(message)
+    generation = await refresh_generation(chatbot_id)
+    if generation is None:
+        return None, vector, None
+    hit = answer_cache.lookup("st", chatbot_id, vector)
+    return (hit.answer if hit else None), vector, generation
+
+
+def _cache_store(message: str, chatbot_id: str, vector, generation, answer: str):
+    if vector is not None and generation is not None and answer and not answer.startswith("⚠️"):
+        answer_cache.store("st", chatbot_id, message, vector, answer, generation)
+
+
+async def generate_reply(
+    message: str,
+    chatbot_id: str,
+    history: list[dict] | None = None,
+    info: dict | None = None,
+    session_key: str | None = None,
+):
+    """
+    info (optional dict) gets cache_hit=True/False and, when generated, prompt_tokens and prefill.
+    session_key pins the conversation to one Ollama backend so its KV cache is reused.
+    Raises AdmissionRejected if no generation slot can be had.
+    """
+
+    print("🔵 OLLAMA_URL =", OLLAMA_URL)
+
+    cached, vector, generation = await _cache_lookup(message, chatbot_id, history)
+    if info is not None:
+        info["cache_hit"] = cached is not None
+    if cached is not None:
+        return cached
+
+    tokens = {}
+    prompt = await build_prompt(message, chatbot_id, history, query_vector=vector, report=tokens)
+    if info is not None:
+        info["prompt_tokens"] = tokens
+
+    # 3️⃣ Call Ollama (shared pooled client), holding a generation slot only for the call
+    async with await admit(chatbot_id, session_key) as slot:
+        response = await ollama_post(
+            "chat",
+            "/api/chat",
+            {
                 "model": LLM_MODEL,
                 "messages": prompt,
                 "stream": False
-            }
+            },
+            affinity_key=session_key,
+            backend=slot.backend,
         )
 
     data = response.json()
     print("🔥 OLLAMA RAW RESPONSE:", data)
+    _record_prefill(data, info)
 
     # 4️⃣ Handle different Ollama response formats safely
     if "message" in data:
-        return data["message"]["content"]
+        reply = data["message"]["content"]
+    elif "messages" in data and isinstance(data["messages"], list):
+        reply = data["messages"][-1]["content"]
+    elif "response" in data:
+        reply = data["response"]
+    else:
+        return "⚠️ Could not read response from Ollama."
+
+    _cache_store(message, chatbot_id, vector, generation, reply)
+    return reply
+
+
+async def open_reply_stream(
+    message: str,
+    chatbot_id: str,
+    history: list[dict] | None = None,
+    info: dict | None = None,
+    session_key: str | None = None,
+) -> Tuple[AsyncIterator[str], Optional[Slot]]:
+    """
+    Same prompt as generate_reply, streamed. The answer-cache lookup, retrieval and admission
+    run here, before the caller starts its response, so AdmissionRejected can still become a
+    429 / 503. Returns the token stream and the generation slot it holds (None on a cache hit):
+    the stream releases the slot as soon as the model is done; a caller whose stream is never
+    consumed must release it itself (release() is idempotent).
+    A cached answer is streamed as a single token; info gets cache_hit like generate_reply.
+    """
+    started = time.perf_counter()
+    cached, vector, generation = await _cache_lookup(message, chatbot_id, history)
+    if info is not None:
+        info["cache_hit"] = cached is not None
+    if cached is not None:
+        return _cached_stream(cached, started), None
+
+    tokens = {}
+    prompt = await build_prompt(message, chatbot_id, history, query_vector=vector, report=tokens)
+    if info is not None:
+        info["prompt_tokens"] = tokens
+
+    slot = await admit(chatbot_id, session_key)
+    stream = _generate_stream(message, chatbot_id, prompt, info, session_key, vector, generation, started, slot)
+    return stream, slot
+
+
+async def _cached_stream(answer: str, started: float) -> AsyncIterator[str]:
+    _ttft.observe(time.perf_counter() - started)
+    yield answer
 
-    if "messages" in data and isinstance(data["messages"], list):
-        return data["messages"][-1]["content"]
 
-    if "response" in data:
-        return data["response"]
+async def _generate_stream(
+    message: str,
+    chatbot_id: str,
+    prompt: list[dict],
+    info: dict | None,
+    session_key: str | None,
+    vector,
+    generation,
+    started: float,
+    slot: Slot,
+) -> AsyncIterator[str]:
+    """Yields content tokens as Ollama produces them; time-to-first-token goes to chat_time_to_first_token_seconds."""
+    first = True
+    parts = []
+    try:
+        async for part in ollama_stream(
+            "chat", "/api/chat", {"model": LLM_MODEL, "messages": prompt}, affinity_key=session_key, backend=slot.backend
+        ):
+            token = (part.get("message") or {}).get("content") or part.get("response") or ""
+            if token:
+                if first:
+                    _ttft.observe(time.perf_counter() - started)
+                    first = False
+                parts.append(token)
+                yield token
+            if part.get("done"):
+                _record_prefill(part, info)
+                break
+    finally:
+        slot.release()
 
-    return "⚠️ Could not read response from Ollama."
+    # only a stream that ran to completion is worth caching
+    _cache_store(message, chatbot_id, vector, generation, "".join(parts))
@@ -0,0 +1,126 @@
+# app/services/parsing_executor.py
+import os
+import asyncio
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Callable, List, Optional
+
+from app.services.document_parsers import (
+    extract_text_from_file,
+    pdf_page_count,
+    extract_pdf_pages_pypdf,
+    extract_pdf_pages_pdfminer,
+)
+from app.utils.memory import RssTracker, peak_rss_bytes
+
+# ---- CONFIG ----
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# PDFs with more pages than this are split into ranges of this size and parsed on several cores
+PDF_RANGE_PAGES = int(os.getenv("PDF_RANGE_PAGES", "25"))
+# "spawn" keeps workers clean of the parent's threads / torch / open sockets
+PARSE_START_METHOD = os.getenv("PARSE_START_METHOD", "spawn")
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_parse_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=PARSE_WORKERS,
+            mp_context=multiprocessing.get_context(PARSE_START_METHOD),
+        )
+    return _executor
+
+
+def shutdown_parse_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _measured(fn: Callable, *args):
+    # runs in the worker: hand back its own peak RSS with the result
+    result = fn(*args)
+    return result, peak_rss_bytes()
+
+
+async def run_in_parse_pool(fn: Callable, *args, tracker: Optional[RssTracker] = None):
+    """
+    Run a picklable parsing function in the process pool without blocking the event loop.
+    With a tracker, the worker's peak RSS is added to it.
+    """
+    loop = asyncio.get_running_loop()
+    if tracker is None:
+        return await loop.run_in_executor(get_parse_executor(), fn, *args)
+    result, peak = await loop.run_in_executor(get_parse_executor(), _measured, fn, *args)
+    tracker.add_worker_peak(peak)
+    return result
+
+
+def _page_ranges(page_count: int, size: int = PDF_RANGE_PAGES) -> List[range]:
+    return [range(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+# ---- PAGE STREAMS ----
+async def iter_pdf_pages_parallel(
+    file_path: str,
+    extractor: Callable = extract_pdf_pages_pdfminer,
+    tracker: Optional[RssTracker] = None,
+) -> AsyncIterator[str]:
+    """
+    Yield page texts of a PDF on disk, in order.
+    Page ranges are extracted on separate cores; at most PARSE_WORKERS ranges
+    are in flight so memory stays bounded for very large documents.
+    """
+    page_count = await run_in_parse_pool(pdf_page_count, file_path, tracker=tracker)
+    pending = [(r.start, r.stop) for r in _page_ranges(page_count)]
+
+    in_flight: List[asyncio.Future] = []
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < PARSE_WORKERS:
+                start, end = pending.pop(0)
+                in_flight.append(asyncio.ensure_future(run_in_parse_pool(extractor, file_path, start, end, tracker=tracker)))
+            # always consume the oldest range first to keep page order
+            pages = await in_flight.pop(0)
+            for page_text in pages:
+                yield page_text
+    finally:
+        for fut in in_flight:
+            fut.cancel()
+
+
+# ---- WHOLE DOCUMENTS ----
+async def parse_document(filename: str, file_bytes: bytes, tracker: Optional[RssTracker] = None) -> str:
+    """
+    Parse one uploaded file off the event loop.
+    PDFs are spooled to a temp file and split into page ranges that are
+    extracted in parallel and stitched back together in order.
+    """
+    if not filename.lower().endswith(".pdf"):
+        return await run_in_parse_pool(extract_text_from_file, filename, file_bytes, tracker=tracker)
+
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        f.write(file_bytes)
+    try:
+        # small PDFs come back as a single range -> a single worker
+        page_count = await run_in_parse_pool(pdf_page_count, path, tracker=tracker)
+        parts = await asyncio.gather(*(
+            run_in_parse_pool(extract_pdf_pages_pypdf, path, r.start, r.stop, tracker=tracker)
+            for r in _page_ranges(page_count)
+        ))
+        return "\n".join(page for part in parts for page in part)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+async def parse_documents(files: List[tuple], tracker: Optional[RssTracker] = None) -> List[str]:
+    """Parse several (filename, bytes) pairs in parallel; results keep input order."""
+    return await asyncio.gather(*(parse_document(name, data, tracker) for name, data in files))
@@ -0,0 +1,167 @@
+# app/services/pdf_ingestion.py
+import os
+import time
+import asyncio
+import tempfile
+from typing import AsyncIterable, List, Optional
+
+from fastapi import UploadFile
+from qdrant_client.models import PointStruct
+
+from app.services.qdrant_service import aqdrant, embed_texts, COLLECTION_NAME, chunk_point_id, has_sparse
+from app.services.sparse_index import SPARSE_VECTOR_NAME, document_vectors
+from app.services.answer_cache import invalidate_chatbot_answers
+from app.utils.memory import RssTracker
+
+# ---- CONFIG ----
+SPOOL_CHUNK_BYTES = int(os.getenv("UPLOAD_SPOOL_CHUNK_BYTES", str(1024 * 1024)))  # 1 MB pieces
+INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "64"))  # chunks per encode + upsert
+CHUNK_SIZE = 500
+OVERLAP = 100
+
+
+# ---- SPOOLING ----
+async def spool_upload_to_disk(file: UploadFile, suffix: str = ".pdf") -> str:
+    """
+    Copy an upload to a temp file in fixed-size pieces so the whole body
+    is never held in memory. Caller is responsible for removing the file.
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                piece = await file.read(SPOOL_CHUNK_BYTES)
+                if not piece:
+                    break
+                f.write(piece)
+    except Exception:
+        remove_quietly(path)
+        raise
+    return path
+
+
+def remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# ---- CHUNKER ----
+class TextChunker:
+    """
+    Sliding-window char chunker fed one page at a time.
+    Produces the same windows as slicing the fully concatenated text with
+    step = chunk_size - overlap, but only keeps one window (plus the current page) buffered.
+    """
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE, overlap: int = OVERLAP):
+        self.chunk_size = chunk_size
+        self.step = chunk_size - overlap
+        self.buffer = ""
+
+    def feed(self, page_text: str) -> List[str]:
+        self.buffer += page_text
+        chunks = []
+        while len(self.buffer) >= self.chunk_size:
+            chunk = self.buffer[:self.chunk_size]
+            if chunk.strip():
+                chunks.append(chunk)
+            self.buffer = self.buffer[self.step:]
+        return chunks
+
+    def finish(self) -> List[str]:
+        # tail windows (each shorter than chunk_size)
+        chunks = []
+        while self.buffer:
+            if self.buffer.strip():
+                chunks.append(self.buffer)
+            self.buffer = self.buffer[self.step:]
+        return chunks
+
+
+# ---- EMBED + UPSERT ----
+def _build_points(chunks: List[str], first_index: int, company_id: int, chatbot_id: int, chat_name: str, source: str) -> List[PointStruct]:
+    embeddings = embed_texts(chunks)
+    # BM25 sparse vectors are built alongside the dense ones for hybrid retrieval
+    sparse = document_vectors(chunks) if has_sparse(COLLECTION_NAME) else None
+
+    points = []
+    for offset, vec in enumerate(embeddings):
+        points.append(
+            PointStruct(
+                id=chunk_point_id(chatbot_id, source, chunks[offset]),
+                vector={"": vec, SPARSE_VECTOR_NAME: sparse[offset]} if sparse else vec,
+                payload={
+                    "companyId": company_id,
+                    "chatbotId": chatbot_id,
+                    "chatName": chat_name,
+                    "source": source,
+                    "chunk_index": first_index + offset,
+                    "text": chunks[offset],
+                },
+            )
+        )
+
+    return points
+
+
+async def _store_batch(chunks: List[str], first_index: int, company_id: int, chatbot_id: int, chat_name: str, source: str) -> int:
+    # encoding is CPU-bound -> worker thread; the upsert is awaited on the shared async client
+    points = await asyncio.to_thread(_build_points, chunks, first_index, company_id, chatbot_id, chat_name, source)
+    await aqdrant.upsert(collection_name=COLLECTION_NAME, points=points)
+    return len(points)
+
+
+async def ingest_pages(
+    pages: AsyncIterable[str],
+    company_id: int,
+    chatbot_id: int,
+    chat_name: str,
+    source: str,
+    tracker: Optional[RssTracker] = None,
+) -> dict:
+    """
+    Chunk, embed and upsert pages as they arrive, INGEST_EMBED_BATCH chunks at a time.
+    Peak memory is bounded by the pages in flight + one batch regardless of document size.
+    Encoding runs on a worker thread so the event loop stays free.
+    Pass the tracker the page stream reports its parse workers to, so their peaks are in the report.
+    """
+    tracker = tracker or RssTracker()
+    started = time.perf_counter()
+    chunker = TextChunker()
+    page_count = 0
+    stored = 0
+    batch: List[str] = []
+
+    async def flush():
+        nonlocal stored, batch
+        stored += await _store_batch(batch, stored, company_id, chatbot_id, chat_name, source)
+        batch = []
+        tracker.sample()
+
+    async def add(chunks: List[str]):
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= INGEST_EMBED_BATCH:
+                await flush()
+
+    async for page_text in pages:
+        page_count += 1
+        tracker.sample()
+        await add(chunker.feed(page_text))
+
+    await add(chunker.finish())
+    if batch:
+        await flush()
+    if stored:
+        await invalidate_chatbot_answers(chatbot_id)
+
+    report = {
+        "pages": page_count,
+        "chunks_stored": stored,
+        "seconds": round(time.perf_counter() - started, 2),
+        "memory": tracker.as_dict(),
+    }
+    print(f"📄 Ingested chatbot {chatbot_id}: {report}")
+    return report
@@ -0,0 +1,166 @@
+# app/services/prompt_builder.py
+#
+# Token-budgeted prompt assembly.
+# The prompt gets PROMPT_CONTEXT_WINDOW - PROMPT_RESERVED_OUTPUT tokens. The system prompt
+# and the question are always included (an oversized question is truncated); what's left is
+# split between retrieved context (PROMPT_CONTEXT_SHARE) and conversation history, and
+# whatever one side doesn't use goes to the other.
+#   - context chunks are kept in retrieval order (best first); the first chunk that doesn't
+#     fit is truncated if a useful amount still fits, the rest are dropped
+#   - history is kept newest-first; older turns are dropped once the budget is spent, in
+#     steps of PROMPT_HISTORY_DROP_STEP turns so the start of the conversation (and with it
+#     the prefix Ollama has cached) only shifts every few turns instead of on every turn
+# Token counts use tiktoken (cl100k_base as a stand-in for the local model's tokenizer,
+# close enough for budgeting); if it can't load, ~4 characters per token is assumed.
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+from app.utils.metrics import histogram, SIZE_BUCKETS
+
+# ---- CONFIG ----
+PROMPT_CONTEXT_WINDOW = int(os.getenv("PROMPT_CONTEXT_WINDOW", "4096"))
+PROMPT_RESERVED_OUTPUT = int(os.getenv("PROMPT_RESERVED_OUTPUT", "512"))
+PROMPT_CONTEXT_SHARE = float(os.getenv("PROMPT_CONTEXT_SHARE", "0.65"))
+PROMPT_MAX_QUESTION_TOKENS = int(os.getenv("PROMPT_MAX_QUESTION_TOKENS", "512"))
+PROMPT_HISTORY_DROP_STEP = max(1, int(os.getenv("PROMPT_HISTORY_DROP_STEP", "4")))
+PROMPT_MIN_TRUNCATED_TOKENS = 48  # a shorter tail of a chunk isn't worth its tokens
+TIKTOKEN_ENCODING = os.getenv("TIKTOKEN_ENCODING", "cl100k_base")
+
+TOKEN_BUCKETS = [64, 128, 256, 512, 1024, 2048, 3072, 4096, 8192]
+_prompt_tokens = histogram("prompt_tokens", TOKEN_BUCKETS, "tokens in assembled prompts")
+_dropped_chunks = histogram("prompt_dropped_chunks", SIZE_BUCKETS, "context chunks dropped to fit the budget")
+
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        except Exception as e:
+            print(f"⚠️ tiktoken unavailable ({e}); estimating 4 chars per token")
+            _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _get_encoding()
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    enc = _get_encoding()
+    if enc is None:
+        return text[: max_tokens * 4]
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens]) + " …"
+
+
+@dataclass
+class PromptParts:
+    question: str
+    context: List[str]
+    history: List[dict]  # oldest -> newest, same shape as the client sent
+    report: dict = field(default_factory=dict)
+    chunk_indices: List[int] = field(default_factory=list)  # position in `chunks` of each kept chunk
+
+
+def _fit_context(chunks: Sequence[str], budget: int, separator_tokens: int) -> Tuple[List[str], List[int], int, int, bool]:
+    kept, indices, used, truncated = [], [], 0, False
+    # overlapping retrievers can return the same chunk twice; the first occurrence counts
+    first = {}
+    for i, chunk in enumerate(chunks):
+        first.setdefault(chunk, i)
+    for chunk, i in first.items():
+        cost = count_tokens(chunk) + (separator_tokens if kept else 0)
+        if used + cost <= budget:
+            kept.append(chunk)
+            indices.append(i)
+            used += cost
+            continue
+        room = budget - used - (separator_tokens if kept else 0)
+        if room >= PROMPT_MIN_TRUNCATED_TOKENS:
+            kept.append(truncate_tokens(chunk, room))
+            indices.append(i)
+            used = budget
+            truncated = True
+        break
+    return kept, indices, used, len(first) - len(kept), truncated
+
+
+def _turn_text(turn: dict) -> str:
+    return f"User: {turn.get('query', '')}\nBot: {turn.get('answer', '')}"
+
+
+def _fit_history(history: Sequence[dict], budget: int) -> Tuple[List[dict], int]:
+    history = list(history or [])
+    costs = [count_tokens(_turn_text(turn)) + 1 for turn in history]
+    fits, used = 0, 0
+    for cost in reversed(costs):
+        if used + cost > budget:
+            break
+        fits += 1
+        used += cost
+    if fits == len(history):
+        return history, used
+    # round the number of dropped (oldest) turns up to a whole step
+    drop = len(history) - fits
+    drop = min(len(history), -(-drop // PROMPT_HISTORY_DROP_STEP) * PROMPT_HISTORY_DROP_STEP)
+    return history[drop:], sum(costs[drop:])
+
+
+def assemble(
+    system: str,
+    question: str,
+    chunks: Sequence[str],
+    history: Optional[Sequence[dict]] = None,
+    separator: str = "\n\n",
+    template_overhead: int = 32,
+) -> PromptParts:
+    """Pick what fits: question + best chunks + most recent history, within the token budget."""
+    budget = PROMPT_CONTEXT_WINDOW - PROMPT_RESERVED_OUTPUT
+    system_tokens = count_tokens(system)
+
+    question_tokens = count_tokens(question)
+    if question_tokens > PROMPT_MAX_QUESTION_TOKENS:
+        question = truncate_tokens(question, PROMPT_MAX_QUESTION_TOKENS)
+        question_tokens = count_tokens(question)
+
+    remaining = max(0, budget - system_tokens - question_tokens - template_overhead)
+    history = list(history or [])
+
+    # context gets its share first; history can use what context leaves over, and vice versa
+    history_need = sum(count_tokens(_turn_text(t)) + 1 for t in history)
+    context_budget = max(int(remaining * PROMPT_CONTEXT_SHARE), remaining - history_need)
+    kept_chunks, kept_indices, context_tokens, dropped, truncated = _fit_context(chunks, context_budget, count_tokens(separator))
+    kept_history, history_tokens = _fit_history(history, remaining - context_tokens)
+
+    total = system_tokens + question_tokens + context_tokens + history_tokens + template_overhead
+    report = {
+        "budget": budget,
+        "total": total,
+        "system": system_tokens,
+        "question": question_tokens,
+        "context": context_tokens,
+        "history": history_tokens,
+        "chunks_used": len(kept_chunks),
+        "chunks_dropped": dropped,
+        "chunk_truncated": truncated,
+        "history_turns_used": len(kept_history),
+        "history_turns_dropped": len(history) - len(kept_history),
+    }
+    _prompt_tokens.observe(total)
+    _dropped_chunks.observe(dropped)
+    return PromptParts(question, kept_chunks, kept_history, report, kept_indices)
@@ -1,54 +1,277 @@
 # app/services/qdrant_service.py
-from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance
-from sentence_transformers import SentenceTransformer
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+from typing import List, Optional, Set
+import httpx
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    VectorParams, VectorParamsDiff, Distance, Filter, PointIdsList, PointStruct,
+    HnswConfigDiff, ScalarQuantization, ScalarQuantizationConfig, ScalarType,
+    PayloadSchemaType, SearchParams, QuantizationSearchParams, Disabled, ShardingMethod,
+    SparseVectorParams, Modifier, NamedSparseVector,
+)
 from app.core.config import get_settings
+from app.services.embedding_cache import cached_embed
+from app.services.embed_batcher import EmbeddingBatcher
+from app.services.model_registry import DEFAULT_EMBED_MODEL, get_embedding_model, embedding_dimension, embedding_cache_key
+from app.services.sparse_index import SPARSE_VECTOR_NAME, query_vector as sparse_query_vector, rrf_fuse
+from app.services.reranker import RERANK_ENABLED, RERANK_CANDIDATES, rerank
+from app.utils.metrics import histogram, LATENCY_BUCKETS_S
 
 settings = get_settings()
 QDRANT_URL = settings.QDRANT_URL  # e.g. "http://localhost:6333"
 
-# single client used everywhere
-qdrant = QdrantClient(url=QDRANT_URL)
+
+def _new_async_client() -> AsyncQdrantClient:
+    if settings.QDRANT_PREFER_GRPC:
+        # gRPC multiplexes requests over one HTTP/2 channel
+        return AsyncQdrantClient(
+            url=QDRANT_URL,
+            api_key=settings.QDRANT_API_KEY or None,
+            prefer_grpc=True,
+            grpc_port=settings.QDRANT_GRPC_PORT,
+            timeout=settings.QDRANT_TIMEOUT,
+        )
+    # REST: keep-alive connection pool shared by every request
+    return AsyncQdrantClient(
+        url=QDRANT_URL,
+        api_key=settings.QDRANT_API_KEY or None,
+        timeout=settings.QDRANT_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=settings.QDRANT_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.QDRANT_MAX_CONNECTIONS,
+        ),
+    )
+
+
+# single async client used everywhere (search, upsert, collection management)
+aqdrant = _new_async_client()
+
+
+async def close_qdrant_client():
+    await aqdrant.close()
+
 
 # model you'll use for embeddings (you already used all-MiniLM-L6-v2)
-EMBED_MODEL = SentenceTransformer("all-MiniLM-L6-v2")
-VECTOR_SIZE = EMBED_MODEL.get_sentence_embedding_dimension()
+# loaded lazily by the model registry, not at import
+EMBED_MODEL_NAME = DEFAULT_EMBED_MODEL
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Encode with the local model, going through the shared embedding cache."""
+    return cached_embed(
+        embedding_cache_key(EMBED_MODEL_NAME),
+        texts,
+        lambda misses: get_embedding_model(EMBED_MODEL_NAME).encode(misses, show_progress_bar=False).tolist(),
+    )
+
+
+# concurrent visitor questions are encoded together on a dedicated thread
+query_embedder = EmbeddingBatcher(
+    embed_texts,
+    max_batch=int(os.getenv("QUERY_EMBED_MAX_BATCH", "32")),
+    max_delay_ms=float(os.getenv("QUERY_EMBED_MAX_DELAY_MS", "5")),
+    name="query_embed",
+)
+
+
+async def embed_query(text: str) -> List[float]:
+    return await query_embedder.embed(text)
 
 # collection name (you may change per company/chatbot later)
 COLLECTION_NAME = "company_documents"
 
-def init_qdrant_collection(collection_name: str = COLLECTION_NAME):
-    """Create collection with correct vector size if it doesn't exist."""
-    existing = [c.name for c in qdrant.get_collections().collections]
-    if collection_name in existing:
-        return False  # existed already
-    qdrant.create_collection(
-        collection_name=collection_name,
-        vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
+# ---- COLLECTION LAYOUT ----
+QDRANT_HNSW_M = int(os.getenv("QDRANT_HNSW_M", "16"))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.getenv("QDRANT_HNSW_EF_CONSTRUCT", "128"))
+QDRANT_SEARCH_EF = int(os.getenv("QDRANT_SEARCH_EF", "128"))
+QDRANT_INT8 = os.getenv("QDRANT_INT8", "1") == "1"  # int8 scalar quantization, originals on disk
+QDRANT_INT8_QUANTILE = float(os.getenv("QDRANT_INT8_QUANTILE", "0.99"))
+QDRANT_RESCORE_OVERSAMPLING = float(os.getenv("QDRANT_RESCORE_OVERSAMPLING", "2.0"))
+
+# hybrid retrieval: BM25 sparse vectors next to the dense ones, fused with RRF
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))  # per retriever, before fusion
+
+# every query filters on the tenant keys, so they get payload indexes
+TENANT_PAYLOAD_INDEXES = {
+    "chatbotId": PayloadSchemaType.INTEGER,
+    "companyId": PayloadSchemaType.INTEGER,
+}
+
+
+def _hnsw_config() -> HnswConfigDiff:
+    return HnswConfigDiff(m=QDRANT_HNSW_M, ef_construct=QDRANT_HNSW_EF_CONSTRUCT)
+
+
+def _quantization_config() -> Optional[ScalarQuantization]:
+    if not QDRANT_INT8:
+        return None
+    # int8 copies stay in RAM for the graph walk; fp32 originals are only read to rescore
+    return ScalarQuantization(
+        scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=QDRANT_INT8_QUANTILE, always_ram=True)
+    )
+
+
+def search_params() -> SearchParams:
+    """Search-time counterpart of the layout: ef, and rescoring against the on-disk originals."""
+    if not QDRANT_INT8:
+        return SearchParams(hnsw_ef=QDRANT_SEARCH_EF)
+    return SearchParams(
+        hnsw_ef=QDRANT_SEARCH_EF,
+        quantization=QuantizationSearchParams(rescore=True, oversampling=QDRANT_RESCORE_OVERSAMPLING),
+    )
+
+
+def _layout_is_current(info) -> bool:
+    params = info.config.params
+    vectors = params.vectors
+    hnsw = info.config.hnsw_config
+    quant = info.config.quantization_config
+    return (
+        hnsw.m == QDRANT_HNSW_M
+        and hnsw.ef_construct == QDRANT_HNSW_EF_CONSTRUCT
+        and bool(getattr(vectors, "on_disk", False)) == QDRANT_INT8
+        and (quant is not None) == QDRANT_INT8
     )
-    return True
 
 
-def store_vector(company_id: str, vector: list[float], text: str):
+# collections provisioned with the BM25 sparse vector (upserts / searches check this)
+_sparse_collections: Set[str] = set()
+
+
+def has_sparse(collection_name: str) -> bool:
+    return collection_name in _sparse_collections
+
+
+def _sparse_config() -> dict:
+    # IDF is computed by Qdrant per collection at query time
+    return {SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)}
+
+
+async def provision_collection(collection_name: str, vector_size: int, payload_indexes: dict, custom_sharding: bool = False, sparse: bool = False) -> bool:
+    """
+    Create the collection with the full layout, or migrate an existing one in place:
+    HNSW m / ef_construct, int8 scalar quantization with originals on disk, the
+    given payload indexes and (sparse=True) the BM25 sparse vector.
+    Qdrant rebuilds segments in the background, searches keep working.
+    Returns True when the collection was created.
+    """
+    created = False
+    if not await aqdrant.collection_exists(collection_name):
+        await aqdrant.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE, on_disk=QDRANT_INT8),
+            sparse_vectors_config=_sparse_config() if sparse else None,
+            hnsw_config=_hnsw_config(),
+            quantization_config=_quantization_config(),
+            sharding_method=ShardingMethod.CUSTOM if custom_sharding else None,
+        )
+        created = True
+        info = None
+        if sparse:
+            _sparse_collections.add(collection_name)
+    else:
+        info = await aqdrant.get_collection(collection_name)
+        if not _layout_is_current(info):
+            print(f"⚙️ Migrating Qdrant collection {collection_name} to the current layout")
+            await aqdrant.update_collection(
+                collection_name=collection_name,
+                vectors_config={"": VectorParamsDiff(on_disk=QDRANT_INT8)},
+                hnsw_config=_hnsw_config(),
+                # switching int8 off has to be explicit on update
+                quantization_config=_quantization_config() or Disabled.DISABLED,
+            )
+        if sparse:
+            if SPARSE_VECTOR_NAME not in (info.config.params.sparse_vectors or {}):
+                try:
+                    await aqdrant.update_collection(collection_name=collection_name, sparse_vectors_config=_sparse_config())
+                except Exception as e:
+                    # older Qdrant can't add a sparse vector to an existing collection
+                    print(f"⚠️ {collection_name}: BM25 sparse vector unavailable, dense-only retrieval ({e})")
+                    sparse = False
+            if sparse:
+                _sparse_collections.add(collection_name)
+
+    indexed = set(info.payload_schema) if info is not None else set()
+    for field_name, schema in payload_indexes.items():
+        if field_name not in indexed:
+            await aqdrant.create_payload_index(collection_name, field_name=field_name, field_schema=schema)
+    return created
+
+
+async def init_qdrant_collection(collection_name: str = COLLECTION_NAME):
+    """Create (or migrate) the shared collection; True when it was created."""
+    # known models answer without loading; an unknown one is loaded off the event loop
+    vector_size = await asyncio.to_thread(embedding_dimension, EMBED_MODEL_NAME)
+    return await provision_collection(collection_name, vector_size, TENANT_PAYLOAD_INDEXES, sparse=HYBRID_SEARCH)
+
+
+# ---- stable point ids ----
+# fixed namespace so every worker / process derives the same uuid for the same chunk
+POINT_ID_NAMESPACE = uuid.UUID("6f1c1a52-4f7e-4c1e-9a54-0b6f3c2d7a10")
+
+def chunk_point_id(chatbot_id, source: str, text: str) -> str:
+    """
+    Content-addressed point id: uuid5 of (chatbot, source, sha256(text)).
+    Re-uploading the same chunk from any worker overwrites instead of duplicating.
+    """
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{chatbot_id}:{source}:{digest}"))
+
+
+async def scroll_point_ids(collection_name: str, query_filter: Optional[Filter] = None, shard_key: Optional[str] = None) -> Set[str]:
+    """All point ids matching a filter (ids only, no payload / vectors)."""
+    ids: Set[str] = set()
+    offset = None
+    while True:
+        points, offset = await aqdrant.scroll(
+            collection_name=collection_name,
+            scroll_filter=query_filter,
+            limit=1000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+            shard_key_selector=shard_key,
+        )
+        ids.update(str(p.id) for p in points)
+        if offset is None:
+            return ids
+
+
+async def delete_point_ids(collection_name: str, ids, shard_key: Optional[str] = None):
+    ids = list(ids)
+    for i in range(0, len(ids), 1000):
+        await aqdrant.delete(
+            collection_name=collection_name,
+            points_selector=PointIdsList(points=ids[i : i + 1000]),
+            shard_key_selector=shard_key,
+        )
+
+
+async def store_vector(company_id: str, vector: list[float], text: str):
     """
     Store vector and text data into Qdrant.
     """
-    qdrant.upsert(
+    await aqdrant.upsert(
         collection_name=COLLECTION_NAME,
         points=[
             PointStruct(
-                id=None,
+                id=str(uuid.uuid4()),
                 vector=vector,
                 payload={"company_id": company_id, "text": text},
             )
         ],
     )
 
-def search_similar(company_id: str, query_vector: list[float], limit: int = 3):
+async def search_similar(company_id: str, query_vector: list[float], limit: int = 3):
     """
     Search for similar vectors belonging to the same company.
     """
-    results = qdrant.search(
+    results = await aqdrant.search(
         collection_name=COLLECTION_NAME,
         query_vector=query_vector,
         query_filter={
@@ -60,22 +283,18 @@ def search_similar(company_id: str, query_vector: list[float], limit: int = 3):
     )
     return [r.payload["text"] for r in results]
 
-def search_similar_vectors(query: str):
-    vector = model.encode(query).tolist()
-    hits = qdrant.search(
+async def search_similar_vectors(query: str):
+    vector = await embed_query(query)
+    hits = await aqdrant.search(
         collection_name="chatbot_docs",
         query_vector=vector,
         limit=3
     )
     return [hit.payload.get("text") for hit in hits]
 
-# app/services/qdrant_service.py
-from qdrant_client import QdrantClient
-
-def get_qdrant_client():
-    # read host/port from settings in app.core.config
-    from app.core.config import settings
-    return QdrantClient(url=settings.QDRANT_URL)
+def get_qdrant_client() -> AsyncQdrantClient:
+    # the shared async client; don't create one per call
+    return aqdrant
 
 
 
@@ -83,29 +302,96 @@ def get_qdrant_client():
 
 # shubhansh code:
 from qdrant_client.models import Filter, FieldCondition, MatchValue
-from app.services.qdrant_service import qdrant, EMBED_MODEL, COLLECTION_NAME
 
-def retrieve_chunks(query: str, chatbot_id: int, top_k: int = 3):
-    """Search Qdrant for relevant context chunks."""
-    query_vec = EMBED_MODEL.encode([query])[0].tolist()
+_stage_seconds = {
+    stage: histogram(f"retrieval_{stage}_seconds", LATENCY_BUCKETS_S, f"retrieve_chunks: {stage} stage")
+    for stage in ("embed", "dense", "sparse", "fusion", "total")
+}
+
+
+async def _timed(stage: str, timings: dict, coro):
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        elapsed = time.perf_counter() - started
+        _stage_seconds[stage].observe(elapsed)
+        timings[stage] = round(elapsed * 1000, 2)
+
+
+async def retrieve_chunks(
+    query: str,
+    chatbot_id: int,
+    top_k: int = 3,
+    query_vector: Optional[List[float]] = None,
+    timings: Optional[dict] = None,
+):
+    """
+    Search Qdrant for relevant context chunks (pass query_vector if the question is already embedded).
+    With HYBRID_SEARCH the BM25 sparse search runs in parallel with embed + dense search and
+    both rankings are fused with RRF. With RERANK_ENABLED, RERANK_CANDIDATES chunks are fetched
+    and a cross-encoder picks the top_k (within its latency budget).
+    Per-stage milliseconds are written into `timings` if given.
+    """
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
 
     # Filter: only return chunks belonging to this chatbot
+    # (upload_pdf writes chatbotId as an int; routes may hand us the id as a string)
     query_filter = Filter(
         must=[
             FieldCondition(
-                key="chatId",
-                match=MatchValue(value=str(chatbot_id))
+                key="chatbotId",
+                match=MatchValue(value=int(chatbot_id))
             )
         ]
     )
 
-    # Perform similarity search
-    results = qdrant.search(
-        collection_name=COLLECTION_NAME,
-        query_vector=query_vec,
-        limit=top_k,
-        query_filter=query_filter
-    )
+    hybrid = HYBRID_SEARCH and has_sparse(COLLECTION_NAME)
+    # over-retrieve when a later stage picks the final top_k
+    keep = max(top_k, RERANK_CANDIDATES) if RERANK_ENABLED else top_k
+    limit = max(keep, HYBRID_CANDIDATES) if hybrid else keep
+
+    async def dense():
+        query_vec = query_vector
+        if query_vec is None:
+            query_vec = await _timed("embed", timings, embed_query(query))
+        # Perform similarity search
+        return await _timed("dense", timings, aqdrant.search(
+            collection_name=COLLECTION_NAME,
+            query_vector=query_vec,
+            limit=limit,
+            query_filter=query_filter,
+            search_params=search_params(),
+        ))
+
+    async def sparse():
+        vector = sparse_query_vector(query)
+        if not vector.indices:
+            return []
+        return await _timed("sparse", timings, aqdrant.search(
+            collection_name=COLLECTION_NAME,
+            query_vector=NamedSparseVector(name=SPARSE_VECTOR_NAME, vector=vector),
+            limit=limit,
+            query_filter=query_filter,
+        ))
+
+    if hybrid:
+        dense_hits, sparse_hits = await asyncio.gather(dense(), sparse())
+        fuse_started = time.perf_counter()
+        results = rrf_fuse([dense_hits, sparse_hits], limit=keep)
+        fusion = time.perf_counter() - fuse_started
+        _stage_seconds["fusion"].observe(fusion)
+        timings["fusion"] = round(fusion * 1000, 3)
+    else:
+        results = await dense()
+
+    if RERANK_ENABLED:
+        results = await rerank(query, results, top_k, timings=timings)
+
+    total = time.perf_counter() - started
+    _stage_seconds["total"].observe(total)
+    timings["total"] = round(total * 1000, 2)
 
     # Extract chunk texts
     chunks = [result.payload["text"] for result in results]
@@ -0,0 +1,162 @@
+# app/services/reranker.py
+#
+# Optional cross-encoder rerank stage for retrieve_chunks.
+# Retrieval over-fetches RERANK_CANDIDATES chunks, a small CPU cross-encoder scores
+# (question, chunk) pairs in batches on a dedicated thread, and only the best top_k
+# reach the prompt. Every request has a hard RERANK_BUDGET_MS: when scoring can't
+# finish in time the dense / fused order is used instead, so reranking never adds
+# more than the budget to a reply.
+# A batch still queued for the model when its request's deadline passes is skipped
+# rather than scored, and at most RERANK_MAX_INFLIGHT batches are queued / running at
+# once: past that a request falls back straight away instead of queueing behind work
+# nobody is waiting for.
+# Scores are cached by (question hash, chunk id) - repeated questions skip the model.
+import os
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+from app.services.embedding_cache import normalize_text
+from app.services.model_registry import get_cross_encoder
+from app.utils.metrics import counter, histogram, LATENCY_BUCKETS_S
+
+# ---- CONFIG ----
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "0") == "1"
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
+RERANK_BATCH = int(os.getenv("RERANK_BATCH", "16"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "150"))
+RERANK_CACHE_ENTRIES = int(os.getenv("RERANK_CACHE_ENTRIES", "50000"))
+RERANK_MAX_INFLIGHT = max(1, int(os.getenv("RERANK_MAX_INFLIGHT", "4")))
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reranker")
+_scores: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+_inflight = 0  # batches submitted to _executor and not finished yet (event-loop side only)
+
+_rerank_seconds = histogram("rerank_seconds", LATENCY_BUCKETS_S, "time spent in the rerank stage")
+_fallbacks = counter("rerank_budget_fallbacks", "reranks that ran out of budget and kept the dense order")
+_busy = counter("rerank_busy_fallbacks", "reranks that kept the dense order because RERANK_MAX_INFLIGHT batches were pending")
+_skipped = counter("rerank_batches_skipped", "queued batches dropped unscored because their deadline had passed")
+_cache_hits = counter("rerank_cache_hits", "(question, chunk) scores served from cache")
+_pairs_scored = counter("rerank_pairs_scored", "(question, chunk) pairs scored by the cross-encoder")
+
+
+def _query_key(query: str) -> str:
+    return hashlib.sha256(normalize_text(query).lower().encode("utf-8")).hexdigest()
+
+
+def _remember(key: Tuple[str, str], score: float):
+    _scores[key] = score
+    _scores.move_to_end(key)
+    while len(_scores) > RERANK_CACHE_ENTRIES:
+        _scores.popitem(last=False)
+
+
+def _score_batch(query: str, texts: List[str], deadline: float) -> Optional[List[float]]:
+    # the request may have given up while this batch waited for the thread
+    if time.perf_counter() >= deadline:
+        return None
+    model = get_cross_encoder(RERANK_MODEL)
+    return [float(s) for s in model.predict([(query, t) for t in texts], batch_size=len(texts), show_progress_bar=False)]
+
+
+def _hit_text(hit) -> str:
+    return (hit.payload or {}).get("text") or ""
+
+
+async def rerank(query: str, hits: Sequence, top_k: int, budget_ms: float = RERANK_BUDGET_MS, timings: Optional[dict] = None) -> List:
+    """
+    hits: retrieval order (Qdrant ScoredPoints with payload["text"]).
+    Returns the top_k hits by cross-encoder score, or the first top_k hits unchanged
+    if the budget runs out, the scoring thread is saturated or the cross-encoder fails.
+    """
+    global _inflight
+    hits = list(hits)
+    if len(hits) <= 1:
+        return hits[:top_k]
+
+    started = time.perf_counter()
+    deadline = started + budget_ms / 1000.0
+    loop = asyncio.get_running_loop()
+    qkey = _query_key(query)
+
+    scores = {}
+    missing = []
+    for i, hit in enumerate(hits):
+        cached = _scores.get((qkey, str(hit.id)))
+        if cached is not None:
+            scores[i] = cached
+            _scores.move_to_end((qkey, str(hit.id)))
+            _cache_hits.inc()
+        else:
+            missing.append(i)
+
+    fell_back = False
+    for b in range(0, len(missing), RERANK_BATCH):
+        batch = missing[b : b + RERANK_BATCH]
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            fell_back = True
+            break
+        if _inflight >= RERANK_MAX_INFLIGHT:
+            _busy.inc()
+            fell_back = True
+            break
+        _inflight += 1
+        future = loop.run_in_executor(_executor, _score_batch, query, [_hit_text(hits[i]) for i in batch], deadline)
+
+        def keep(done, batch=batch):
+            global _inflight
+            _inflight -= 1
+            # a batch that finishes after the deadline still fills the cache for next time
+            if done.cancelled() or done.exception() is not None:
+                return
+            if done.result() is None:
+                _skipped.inc()
+                return
+            for i, score in zip(batch, done.result()):
+                _remember((qkey, str(hits[i].id)), score)
+
+        future.add_done_callback(keep)
+        try:
+            batch_scores = await asyncio.wait_for(asyncio.shield(future), remaining)
+        except asyncio.TimeoutError:
+            fell_back = True
+            break
+        except Exception as e:
+            # model failed to load or predict: dense order is still a valid answer
+            print(f"❌ Rerank failed, keeping retrieval order: {e}")
+            fell_back = True
+            break
+        if batch_scores is None:  # reached the thread only after the deadline
+            fell_back = True
+            break
+        _pairs_scored.inc(len(batch))
+        scores.update(zip(batch, batch_scores))
+
+    elapsed = time.perf_counter() - started
+    _rerank_seconds.observe(elapsed)
+    if timings is not None:
+        timings["rerank"] = round(elapsed * 1000, 2)
+        timings["rerank_fallback"] = fell_back
+
+    if fell_back:
+        _fallbacks.inc()
+        return hits[:top_k]
+    order = sorted(range(len(hits)), key=lambda i: scores[i], reverse=True)
+    return [hits[i] for i in order[:top_k]]
+
+
+async def warm_reranker():
+    """Load the cross-encoder in the background so the first request isn't the one paying for it."""
+    try:
+        await asyncio.get_running_loop().run_in_executor(_executor, get_cross_encoder, RERANK_MODEL)
+    except Exception as e:
+        print(f"❌ Could not load rerank model {RERANK_MODEL}: {e}")
+
+
+def shutdown_reranker():
+    _executor.shutdown(wait=False)
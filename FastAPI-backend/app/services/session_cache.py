@@ -0,0 +1,106 @@
+# app/services/session_cache.py
+#
+# In-process TTL / LRU cache of active visitor sessions for the chat hot path.
+# An ongoing conversation resolves its session from here - by session id, or by
+# (chatbot, visitor_anonymous_id) - without touching Postgres.
+# - an entry is dropped once the session's own expires_at passes (the session is over),
+#   or SESSION_CACHE_TTL_S after it was cached (bounds staleness across workers)
+# - at most SESSION_CACHE_ENTRIES sessions are kept, least recently used evicted first
+# - deleting a chatbot or sweeping expired sessions invalidates the affected entries
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from app.utils.metrics import counter, gauge
+
+# ---- CONFIG ----
+SESSION_CACHE_TTL_S = float(os.getenv("SESSION_CACHE_TTL_S", "300"))
+SESSION_CACHE_ENTRIES = int(os.getenv("SESSION_CACHE_ENTRIES", "50000"))
+
+_hits = counter("session_cache_hits", "chat sessions resolved from the in-process cache")
+_misses = counter("session_cache_misses", "chat sessions that needed a database lookup")
+
+
+@dataclass
+class CachedSession:
+    id: int
+    visitor_id: int
+    chatbot_id: int
+    anonymous_id: Optional[str]
+    expires_at: Optional[datetime]
+    cached_at: float = 0.0
+
+    def valid(self, now: datetime) -> bool:
+        return (self.expires_at is None or self.expires_at > now) and time.monotonic() - self.cached_at < SESSION_CACHE_TTL_S
+
+
+class SessionCache:
+    def __init__(self, max_entries: int = SESSION_CACHE_ENTRIES):
+        self._by_id: "OrderedDict[int, CachedSession]" = OrderedDict()
+        self._by_visitor: Dict[Tuple[int, str], int] = {}
+        self._max_entries = max_entries
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def _get(self, session_id: Optional[int]) -> Optional[CachedSession]:
+        entry = self._by_id.get(session_id) if session_id is not None else None
+        if entry is None:
+            return None
+        if not entry.valid(datetime.utcnow()):
+            self.invalidate(entry.id)
+            return None
+        self._by_id.move_to_end(entry.id)
+        return entry
+
+    def by_id(self, session_id: int, chatbot_id: int) -> Optional[CachedSession]:
+        entry = self._get(session_id)
+        if entry is None or entry.chatbot_id != chatbot_id:
+            _misses.inc()
+            return None
+        _hits.inc()
+        return entry
+
+    def by_visitor(self, chatbot_id: int, anonymous_id: str) -> Optional[CachedSession]:
+        entry = self._get(self._by_visitor.get((chatbot_id, anonymous_id)))
+        if entry is None:
+            _misses.inc()
+            return None
+        _hits.inc()
+        return entry
+
+    def put(self, entry: CachedSession) -> CachedSession:
+        entry.cached_at = time.monotonic()
+        self.invalidate(entry.id)
+        self._by_id[entry.id] = entry
+        if entry.anonymous_id:
+            self._by_visitor[(entry.chatbot_id, entry.anonymous_id)] = entry.id
+        while len(self._by_id) > self._max_entries:
+            _, evicted = self._by_id.popitem(last=False)
+            self._forget_visitor(evicted)
+        return entry
+
+    def _forget_visitor(self, entry: CachedSession):
+        key = (entry.chatbot_id, entry.anonymous_id)
+        if entry.anonymous_id and self._by_visitor.get(key) == entry.id:
+            del self._by_visitor[key]
+
+    def invalidate(self, session_id: int):
+        entry = self._by_id.pop(session_id, None)
+        if entry is not None:
+            self._forget_visitor(entry)
+
+    def invalidate_many(self, session_ids: Iterable[int]):
+        for session_id in session_ids:
+            self.invalidate(session_id)
+
+    def invalidate_chatbot(self, chatbot_id: int):
+        for entry in [e for e in self._by_id.values() if e.chatbot_id == chatbot_id]:
+            self.invalidate(entry.id)
+
+
+session_cache = SessionCache()
+gauge("session_cache_entries", "visitor sessions held in the in-process cache", fn=lambda: len(session_cache))
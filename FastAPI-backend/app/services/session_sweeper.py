@@ -0,0 +1,302 @@
+# app/services/session_sweeper.py
+#
+# Background sweeper for expired visitor sessions and their chats.
+# - every SWEEP_INTERVAL_S it deletes sessions whose expires_at passed more than
+#   SWEEP_GRACE_S ago (the grace lets write-behind chat rows land first), together with
+#   their chats, SWEEP_BATCH_SIZE sessions per transaction
+# - batches are picked through the expires_at index (ix_visitor_sessions_expires_at) with
+#   FOR UPDATE SKIP LOCKED, so several workers can sweep without blocking each other, and
+#   chats go through ix_chats_visitor_session_id; nothing is loaded into Python but ids
+# - deletes are throttled to SWEEP_MAX_ROWS_PER_S rows (sessions + chats) so a backlog
+#   doesn't saturate the database
+# - optional (Postgres): with CHAT_PARTITIONING=1 and `chats` partitioned by month on
+#   created_at, partitions older than CHAT_RETENTION_DAYS are dropped whole and the next
+#   CHAT_PARTITIONS_AHEAD months are created in advance. Convert the table once with:
+#       python -m app.services.session_sweeper --partition-chats
+# - tables created before the sweeper's indexes were declared on the models need them added
+#   once (CREATE INDEX CONCURRENTLY, outside the app so startup never waits on a build):
+#       python -m app.services.session_sweeper --ensure-indexes
+#   an index left INVALID by an interrupted concurrent build is dropped and rebuilt; at
+#   startup the sweeper only warns about missing / invalid indexes
+import os
+import sys
+import asyncio
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import delete, select, text
+
+from app.db.async_session import async_engine
+from app.models.chat import Chat
+from app.models.visitor_session import VisitorSession
+from app.services.session_cache import session_cache
+from app.utils.metrics import counter, histogram, LATENCY_BUCKETS_S
+
+# ---- CONFIG ----
+SWEEP_ENABLED = os.getenv("SWEEP_ENABLED", "1") == "1"
+SWEEP_INTERVAL_S = float(os.getenv("SWEEP_INTERVAL_S", "300"))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "500"))
+SWEEP_MAX_ROWS_PER_S = float(os.getenv("SWEEP_MAX_ROWS_PER_S", "2000"))
+SWEEP_GRACE_S = float(os.getenv("SWEEP_GRACE_S", "600"))
+CHAT_PARTITIONING = os.getenv("CHAT_PARTITIONING", "0") == "1"
+CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "90"))
+CHAT_PARTITIONS_AHEAD = int(os.getenv("CHAT_PARTITIONS_AHEAD", "2"))
+
+_batch_seconds = histogram("sweep_batch_seconds", LATENCY_BUCKETS_S, "time to delete one batch of expired sessions")
+_sessions_deleted = counter("sweep_sessions_deleted", "expired visitor sessions deleted")
+_chats_deleted = counter("sweep_chats_deleted", "chats deleted with their expired sessions")
+_partitions_dropped = counter("sweep_chat_partitions_dropped", "chat partitions dropped past retention")
+
+_task = None
+
+# both are declared on the models (index=True); tables created before that need them added
+# with --ensure-indexes
+_INDEXES = (
+    ("ix_visitor_sessions_expires_at", "visitor_sessions", "expires_at"),
+    ("ix_chats_visitor_session_id", "chats", "visitor_session_id"),
+)
+
+
+async def _index_state(conn, name: str) -> Optional[bool]:
+    """None if the index doesn't exist, else whether it is valid (Postgres)."""
+    return (await conn.execute(
+        text("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"),
+        {"name": name},
+    )).scalar()
+
+
+async def ensure_indexes():
+    """One-off: create the sweeper's indexes, rebuilding any a failed concurrent build left INVALID."""
+    postgres = async_engine.dialect.name == "postgresql"
+    # CONCURRENTLY can't run inside a transaction block
+    engine = async_engine.execution_options(isolation_level="AUTOCOMMIT") if postgres else async_engine
+    async with engine.connect() as conn:
+        partitioned = postgres and await _chats_partitioned(conn)
+        for name, table, column in _INDEXES:
+            # a partitioned parent can't be indexed concurrently (its partitions are)
+            concurrently = "CONCURRENTLY " if postgres and not (partitioned and table == "chats") else ""
+            try:
+                if postgres:
+                    valid = await _index_state(conn, name)
+                    if valid:
+                        continue
+                    if valid is False:
+                        print(f"⚠️ Index {name} is INVALID (interrupted build), rebuilding")
+                        await conn.execute(text(f"DROP INDEX {concurrently}IF EXISTS {name}"))
+                await conn.execute(text(f"CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({column})"))
+                print(f"✅ Index {name} ready")
+            except Exception as e:
+                print(f"⚠️ Could not create index {name}: {e}")
+        if not postgres:
+            await conn.commit()
+
+
+async def check_indexes():
+    """Startup check: warn (don't build) when a sweeper index is missing or invalid."""
+    if async_engine.dialect.name != "postgresql":
+        return
+    async with async_engine.connect() as conn:
+        for name, table, _ in _INDEXES:
+            valid = await _index_state(conn, name)
+            if not valid:
+                state = "missing" if valid is None else "INVALID"
+                print(
+                    f"⚠️ Index {name} on {table} is {state}; sweeps will scan the table. "
+                    "Run python -m app.services.session_sweeper --ensure-indexes"
+                )
+
+
+async def sweep_batch(now: datetime) -> Tuple[List[int], int]:
+    """Delete up to SWEEP_BATCH_SIZE expired sessions and their chats; (session ids, chats deleted)."""
+    cutoff = now - timedelta(seconds=SWEEP_GRACE_S)
+    async with async_engine.begin() as conn:
+        ids = (
+            await conn.execute(
+                select(VisitorSession.id)
+                .where(VisitorSession.expires_at < cutoff)
+                .order_by(VisitorSession.expires_at)
+                .limit(SWEEP_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+            )
+        ).scalars().all()
+        if not ids:
+            return [], 0
+        chats = await conn.execute(delete(Chat).where(Chat.visitor_session_id.in_(ids)))
+        await conn.execute(delete(VisitorSession).where(VisitorSession.id.in_(ids)))
+    return list(ids), chats.rowcount or 0
+
+
+async def sweep_expired() -> Tuple[int, int]:
+    """Sweep until no expired sessions are left; returns (sessions, chats) deleted."""
+    sessions = chats = 0
+    while True:
+        started = asyncio.get_running_loop().time()
+        ids, deleted_chats = await sweep_batch(datetime.utcnow())
+        elapsed = asyncio.get_running_loop().time() - started
+        if not ids:
+            break
+        _batch_seconds.observe(elapsed)
+        _sessions_deleted.inc(len(ids))
+        _chats_deleted.inc(deleted_chats)
+        session_cache.invalidate_many(ids)
+        sessions += len(ids)
+        chats += deleted_chats
+        # throttle: this batch may take at most its share of the row budget
+        budget = (len(ids) + deleted_chats) / SWEEP_MAX_ROWS_PER_S
+        if budget > elapsed:
+            await asyncio.sleep(budget - elapsed)
+    return sessions, chats
+
+
+# ---- optional monthly partitions of chats (Postgres) ----
+def _month_start(day: datetime) -> datetime:
+    return datetime(day.year, day.month, 1)
+
+
+def _next_month(month: datetime) -> datetime:
+    return datetime(month.year + (month.month == 12), month.month % 12 + 1, 1)
+
+
+def _partition_name(month: datetime) -> str:
+    return f"chats_p{month:%Y%m}"
+
+
+async def _chats_partitioned(conn) -> bool:
+    kind = (await conn.execute(text("SELECT relkind FROM pg_class WHERE relname = 'chats'"))).scalar()
+    return kind == "p"
+
+
+async def _create_partition(conn, month: datetime):
+    await conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {_partition_name(month)} PARTITION OF chats "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_next_month(month):%Y-%m-%d}')"
+    ))
+
+
+async def maintain_chat_partitions(now: datetime):
+    """Create upcoming monthly partitions and drop the ones wholly past retention."""
+    if async_engine.dialect.name != "postgresql":
+        return
+    async with async_engine.begin() as conn:
+        if not await _chats_partitioned(conn):
+            print("⚠️ CHAT_PARTITIONING=1 but chats isn't partitioned; run python -m app.services.session_sweeper --partition-chats")
+            return
+        month = _month_start(now)
+        for _ in range(CHAT_PARTITIONS_AHEAD + 1):
+            await _create_partition(conn, month)
+            month = _next_month(month)
+
+        oldest_kept = _month_start(now - timedelta(days=CHAT_RETENTION_DAYS))
+        partitions = (await conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'chats'"
+        ))).scalars().all()
+        for name in partitions:
+            try:
+                month = datetime.strptime(name, "chats_p%Y%m")
+            except ValueError:
+                continue  # not one of ours
+            # the partition ends before the retention window starts: drop it whole
+            if _next_month(month) <= oldest_kept:
+                await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+                _partitions_dropped.inc()
+                print(f"🗑️ Dropped chat partition {name}")
+
+
+async def partition_chats_table():
+    """
+    One-off migration: chats -> monthly range partitions on created_at.
+    The old table is kept as chats_unpartitioned, without its foreign keys (drop it once
+    the copy is verified).
+    Run it while the app is stopped.
+    """
+    async with async_engine.begin() as conn:
+        if await _chats_partitioned(conn):
+            print("chats is already partitioned")
+            return
+        await conn.execute(text("ALTER TABLE chats RENAME TO chats_unpartitioned"))
+        # the old rows must not keep pointing at sessions / chatbots, or the sweeper couldn't
+        # delete a session that still has a row here
+        fks = (await conn.execute(text(
+            "SELECT conname FROM pg_constraint "
+            "WHERE conrelid = 'chats_unpartitioned'::regclass AND contype = 'f'"
+        ))).scalars().all()
+        for name in fks:
+            await conn.execute(text(f'ALTER TABLE chats_unpartitioned DROP CONSTRAINT "{name}"'))
+        # free the index names for the new table
+        for index in ("chats_pkey", "ix_chats_id", "ix_chats_visitor_session_id"):
+            await conn.execute(text(f"ALTER INDEX IF EXISTS {index} RENAME TO {index.replace('chats', 'chats_unpartitioned', 1)}"))
+        await conn.execute(text(
+            "CREATE TABLE chats (LIKE chats_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"
+        ))
+        await conn.execute(text("UPDATE chats_unpartitioned SET created_at = now() WHERE created_at IS NULL"))
+        await conn.execute(text("ALTER TABLE chats ALTER COLUMN created_at SET NOT NULL"))
+        # the partition key has to be part of the primary key
+        await conn.execute(text("ALTER TABLE chats ADD PRIMARY KEY (id, created_at)"))
+        await conn.execute(text(
+            "ALTER TABLE chats ADD FOREIGN KEY (visitor_session_id) REFERENCES visitor_sessions (id)"
+        ))
+        await conn.execute(text(
+            "ALTER TABLE chats ADD FOREIGN KEY (chatbot_id) REFERENCES chatbots (id)"
+        ))
+        await conn.execute(text("CREATE INDEX ix_chats_visitor_session_id ON chats (visitor_session_id)"))
+
+        oldest = (await conn.execute(text("SELECT min(created_at) FROM chats_unpartitioned"))).scalar()
+        month = _month_start(oldest or datetime.utcnow())
+        last = _month_start(datetime.utcnow())
+        for _ in range(CHAT_PARTITIONS_AHEAD):
+            last = _next_month(last)
+        while month <= last:
+            await _create_partition(conn, month)
+            month = _next_month(month)
+
+        await conn.execute(text("INSERT INTO chats SELECT * FROM chats_unpartitioned"))
+    print("✅ chats is now partitioned by month; the old rows are still in chats_unpartitioned")
+
+
+# ---- background task ----
+async def _run():
+    while True:
+        try:
+            if CHAT_PARTITIONING:
+                await maintain_chat_partitions(datetime.utcnow())
+            sessions, chats = await sweep_expired()
+            if sessions:
+                print(f"🧹 Swept {sessions} expired sessions and {chats} chats")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Session sweep failed: {e}")
+        await asyncio.sleep(SWEEP_INTERVAL_S)
+
+
+async def start_session_sweeper():
+    global _task
+    if not SWEEP_ENABLED:
+        return
+    try:
+        await check_indexes()
+    except Exception as e:
+        print(f"⚠️ Could not check the sweeper indexes: {e}")
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_run())
+
+
+async def stop_session_sweeper():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+if __name__ == "__main__":
+    if "--partition-chats" in sys.argv[1:]:
+        asyncio.run(partition_chats_table())
+    elif "--ensure-indexes" in sys.argv[1:]:
+        asyncio.run(ensure_indexes())
+    else:
+        print("usage: python -m app.services.session_sweeper --partition-chats | --ensure-indexes")
@@ -0,0 +1,89 @@
+# app/services/sparse_index.py
+#
+# Lexical (BM25) side of hybrid retrieval.
+# Chunks get a sparse vector next to their dense one: token id -> BM25 term weight
+# (tf saturation + length normalisation). Qdrant's IDF modifier on the sparse vector
+# supplies the idf part per collection at query time, so the index never needs
+# global statistics at ingestion time.
+# Tokens keep product codes / SKUs / error strings whole ("ERR-4012", "x86_64", "v2.3.1")
+# and also index their parts, so "4012" still matches "ERR-4012".
+import os
+import re
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, Sequence
+
+from qdrant_client.models import SparseVector
+
+# ---- CONFIG ----
+SPARSE_VECTOR_NAME = "bm25"
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+BM25_AVG_DOC_TOKENS = float(os.getenv("BM25_AVG_DOC_TOKENS", "90"))  # ~500-char chunks
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+_TOKEN = re.compile(r"[A-Za-z0-9]+(?:[-_./:#][A-Za-z0-9]+)*")
+_PART = re.compile(r"[A-Za-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for match in _TOKEN.finditer(text.lower()):
+        token = match.group(0)
+        if token in _STOPWORDS:
+            continue
+        tokens.append(token)
+        parts = _PART.findall(token)
+        if len(parts) > 1:
+            tokens.extend(p for p in parts if p not in _STOPWORDS)
+    return tokens
+
+
+def _token_id(token: str) -> int:
+    # stable across processes and restarts (unlike hash())
+    return zlib.crc32(token.encode("utf-8")) & 0x7FFFFFFF
+
+
+def _sparse(weights: Dict[int, float]) -> SparseVector:
+    indices = sorted(weights)
+    return SparseVector(indices=indices, values=[weights[i] for i in indices])
+
+
+def document_vector(text: str) -> SparseVector:
+    tokens = tokenize(text)
+    if not tokens:
+        return SparseVector(indices=[], values=[])
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * len(tokens) / BM25_AVG_DOC_TOKENS)
+    weights: Dict[int, float] = {}
+    for token, tf in Counter(tokens).items():
+        tid = _token_id(token)
+        # crc collisions are rare; summing keeps the vector valid if one happens
+        weights[tid] = weights.get(tid, 0.0) + tf * (BM25_K1 + 1) / (tf + norm)
+    return _sparse(weights)
+
+
+def document_vectors(texts: Sequence[str]) -> List[SparseVector]:
+    return [document_vector(t) for t in texts]
+
+
+def query_vector(text: str) -> SparseVector:
+    return _sparse({_token_id(t): 1.0 for t in set(tokenize(text))})
+
+
+def rrf_fuse(rankings: Iterable[Sequence], limit: int, k: int = RRF_K) -> List:
+    """
+    Reciprocal-rank fusion of several ranked hit lists (Qdrant ScoredPoints).
+    score(point) = sum over lists of 1 / (k + rank); only ranks matter, not raw scores.
+    """
+    scores: Dict[str, float] = {}
+    points = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking, start=1):
+            key = str(hit.id)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            points.setdefault(key, hit)
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [points[key] for key in best]
@@ -0,0 +1,473 @@
+# app/services/vector_placement.py
+#
+# Tenant placement for chatbot training vectors.
+# Every chatbot lives in exactly one of two layouts:
+#   shared     one SHARED_VECTOR_COLLECTION for all small bots, scoped by the chatbotId
+#              payload index (or by a per-bot shard key when QDRANT_CUSTOM_SHARDING=1)
+#   dedicated  its own chatbot_{id} collection, for bots big enough to deserve one
+# The choice is stored in vector_placements; a background migrator promotes bots that
+# grow past PLACEMENT_PROMOTE_AT_POINTS and demotes the ones that shrink below
+# PLACEMENT_DEMOTE_BELOW_POINTS.
+#
+# Online migration: mark the row "migrating" (writes now go to both layouts) ->
+# copy the points -> drop anything the copy resurrected -> flip reads to the target ->
+# after a grace period remove the old copy. Searches keep hitting the old layout
+# until the flip, so there is no downtime.
+# A migration is claimed in the row itself (status, owner, lease_until) with one conditional
+# UPDATE, so only one process across all workers moves a given bot; the owner renews the
+# lease while it works and a move whose owner died is resumed once the lease runs out.
+import os
+import socket
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from qdrant_client.models import (
+    Filter, FieldCondition, MatchValue, FilterSelector, PointStruct, PayloadSchemaType,
+)
+from sqlalchemy import and_, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from app.db.session import SessionLocal
+from app.models.vector_placement import VectorPlacement
+from app.services.qdrant_service import (
+    aqdrant, provision_collection, scroll_point_ids, delete_point_ids, search_params,
+)
+
+# ---- CONFIG ----
+VECTOR_LAYOUT_DEFAULT = os.getenv("VECTOR_LAYOUT_DEFAULT", "shared")  # layout for new chatbots
+SHARED_VECTOR_COLLECTION = os.getenv("SHARED_VECTOR_COLLECTION", "chatbots_shared")
+DEDICATED_PREFIX = "chatbot_"  # dedicated collection name: chatbot_{chatbot_id}
+QDRANT_CUSTOM_SHARDING = os.getenv("QDRANT_CUSTOM_SHARDING", "0") == "1"  # needs Qdrant in distributed mode
+PLACEMENT_PROMOTE_AT_POINTS = int(os.getenv("PLACEMENT_PROMOTE_AT_POINTS", "100000"))
+PLACEMENT_DEMOTE_BELOW_POINTS = int(os.getenv("PLACEMENT_DEMOTE_BELOW_POINTS", "20000"))
+PLACEMENT_CHECK_SECONDS = float(os.getenv("PLACEMENT_CHECK_SECONDS", "300"))
+PLACEMENT_CACHE_TTL = float(os.getenv("PLACEMENT_CACHE_TTL", "30"))  # also the grace period around a flip
+MIGRATION_PAGE = int(os.getenv("PLACEMENT_MIGRATION_PAGE", "256"))
+PLACEMENT_LEASE_S = float(os.getenv("PLACEMENT_LEASE_S", "120"))
+
+# identifies this process as the owner of the migrations it runs
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+LAYOUTS = ("shared", "dedicated")
+
+
+@dataclass(frozen=True)
+class Placement:
+    chatbot_id: int
+    layout: str
+    collection: str
+    shard_key: Optional[str] = None
+
+    def scope(self, *conditions) -> Optional[Filter]:
+        """Filter restricted to this chatbot's points (plus any extra conditions)."""
+        must = list(conditions)
+        if self.layout == "shared":
+            must.append(FieldCondition(key="chatbotId", match=MatchValue(value=self.chatbot_id)))
+        return Filter(must=must) if must else None
+
+
+@dataclass(frozen=True)
+class PlacementState:
+    current: Placement  # reads go here
+    target: Optional[Placement] = None  # set while migrating
+
+    def write_targets(self) -> List[Placement]:
+        return [self.current] + ([self.target] if self.target else [])
+
+
+def placement_for(chatbot_id: int, layout: str) -> Placement:
+    if layout == "dedicated":
+        return Placement(chatbot_id, "dedicated", f"{DEDICATED_PREFIX}{chatbot_id}")
+    return Placement(chatbot_id, "shared", SHARED_VECTOR_COLLECTION, str(chatbot_id) if QDRANT_CUSTOM_SHARDING else None)
+
+
+# ---- DB helpers (sync session, run off the event loop) ----
+def _load_row(chatbot_id: int) -> Optional[VectorPlacement]:
+    db = SessionLocal()
+    try:
+        row = db.get(VectorPlacement, chatbot_id)
+        if row is not None:
+            db.expunge(row)
+        return row
+    finally:
+        db.close()
+
+
+def _create_row(chatbot_id: int, layout: str) -> VectorPlacement:
+    p = placement_for(chatbot_id, layout)
+    db = SessionLocal()
+    try:
+        db.add(VectorPlacement(chatbot_id=chatbot_id, layout=layout, collection=p.collection, shard_key=p.shard_key))
+        db.commit()
+    except IntegrityError:
+        db.rollback()  # another worker placed it first; theirs wins
+    finally:
+        db.close()
+    return _load_row(chatbot_id)
+
+
+def _update_row(chatbot_id: int, **fields):
+    db = SessionLocal()
+    try:
+        row = db.get(VectorPlacement, chatbot_id)
+        if row is not None:
+            for k, v in fields.items():
+                setattr(row, k, v)
+            db.commit()
+    finally:
+        db.close()
+
+
+def _claim_migration(chatbot_id: int, layout: str) -> bool:
+    """
+    active -> migrating to `layout` owned by this process, or take over a move to the same
+    layout whose owner stopped renewing its lease. False if someone else is moving the bot.
+    """
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        claimed = db.execute(
+            update(VectorPlacement)
+            .where(
+                VectorPlacement.chatbot_id == chatbot_id,
+                VectorPlacement.layout != layout,
+                or_(
+                    VectorPlacement.status == "active",
+                    and_(
+                        VectorPlacement.status == "migrating",
+                        VectorPlacement.target_layout == layout,
+                        or_(VectorPlacement.lease_until.is_(None), VectorPlacement.lease_until < now),
+                    ),
+                ),
+            )
+            .values(
+                status="migrating",
+                target_layout=layout,
+                owner=WORKER_ID,
+                lease_until=now + timedelta(seconds=PLACEMENT_LEASE_S),
+            )
+            .returning(VectorPlacement.chatbot_id)
+        ).first()
+        db.commit()
+        return claimed is not None
+    finally:
+        db.close()
+
+
+def _renew_lease(chatbot_id: int) -> bool:
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            update(VectorPlacement)
+            .where(
+                VectorPlacement.chatbot_id == chatbot_id,
+                VectorPlacement.owner == WORKER_ID,
+                VectorPlacement.status == "migrating",
+            )
+            .values(lease_until=datetime.utcnow() + timedelta(seconds=PLACEMENT_LEASE_S))
+        )
+        db.commit()
+        return result.rowcount > 0
+    finally:
+        db.close()
+
+
+def _all_rows() -> List[VectorPlacement]:
+    db = SessionLocal()
+    try:
+        rows = db.query(VectorPlacement).order_by(VectorPlacement.chatbot_id).all()
+        for row in rows:
+            db.expunge(row)
+        return rows
+    finally:
+        db.close()
+
+
+# ---- RESOLUTION ----
+_cache: Dict[int, Tuple[float, PlacementState]] = {}
+_ready: set = set()  # (collection, shard_key) already provisioned by this process
+
+
+def _state_from_row(row: VectorPlacement) -> PlacementState:
+    current = Placement(row.chatbot_id, row.layout, row.collection, row.shard_key)
+    target = placement_for(row.chatbot_id, row.target_layout) if row.status == "migrating" and row.target_layout else None
+    return PlacementState(current, target)
+
+
+def forget(chatbot_id: int):
+    _cache.pop(chatbot_id, None)
+
+
+async def resolve(chatbot_id: int, fresh: bool = False) -> PlacementState:
+    chatbot_id = int(chatbot_id)
+    loop = asyncio.get_running_loop()
+    hit = _cache.get(chatbot_id)
+    if hit is not None and not fresh and loop.time() - hit[0] < PLACEMENT_CACHE_TTL:
+        return hit[1]
+
+    row = await asyncio.to_thread(_load_row, chatbot_id)
+    if row is None:
+        # bots trained before placement existed already have a chatbot_{id} collection
+        legacy = await aqdrant.collection_exists(f"{DEDICATED_PREFIX}{chatbot_id}")
+        row = await asyncio.to_thread(_create_row, chatbot_id, "dedicated" if legacy else VECTOR_LAYOUT_DEFAULT)
+
+    state = _state_from_row(row)
+    _cache[chatbot_id] = (loop.time(), state)
+    return state
+
+
+async def _ensure_storage(p: Placement, vector_size: int):
+    key = (p.collection, p.shard_key)
+    if key in _ready:
+        return
+    if p.layout == "shared":
+        await provision_collection(
+            p.collection,
+            vector_size,
+            {"chatbotId": PayloadSchemaType.INTEGER, "source": PayloadSchemaType.KEYWORD},
+            custom_sharding=QDRANT_CUSTOM_SHARDING,
+        )
+        if p.shard_key is not None:
+            try:
+                await aqdrant.create_shard_key(p.collection, shard_key=p.shard_key)
+            except Exception:
+                pass  # already exists
+    else:
+        if await provision_collection(p.collection, vector_size, {"source": PayloadSchemaType.KEYWORD}):
+            print(f"⚙️ Created new Qdrant collection: {p.collection}")
+    _ready.add(key)
+
+
+async def _exists(p: Placement) -> bool:
+    return (p.collection, p.shard_key) in _ready or await aqdrant.collection_exists(p.collection)
+
+
+# ---- DATA OPERATIONS (used by chatbot_service) ----
+async def upsert_points(chatbot_id: int, points: List[PointStruct], vector_size: int):
+    """Points must carry chatbotId in their payload (the shared layout filters on it)."""
+    state = await resolve(chatbot_id)
+    for p in state.write_targets():
+        await _ensure_storage(p, vector_size)
+        await aqdrant.upsert(collection_name=p.collection, points=points, shard_key_selector=p.shard_key)
+
+
+async def point_ids(chatbot_id: int, *conditions) -> set:
+    p = (await resolve(chatbot_id)).current
+    if not await _exists(p):
+        return set()
+    return await scroll_point_ids(p.collection, p.scope(*conditions), shard_key=p.shard_key)
+
+
+async def delete_points(chatbot_id: int, ids):
+    state = await resolve(chatbot_id)
+    for p in state.write_targets():
+        if await _exists(p):
+            await delete_point_ids(p.collection, ids, shard_key=p.shard_key)
+
+
+async def search(chatbot_id: int, query_vector: List[float], limit: int = 5):
+    p = (await resolve(chatbot_id)).current
+    return await aqdrant.search(
+        collection_name=p.collection,
+        query_vector=query_vector,
+        query_filter=p.scope(),
+        limit=limit,
+        shard_key_selector=p.shard_key,
+        search_params=search_params(),
+    )
+
+
+async def _count(p: Placement) -> int:
+    if not await _exists(p):
+        return 0
+    result = await aqdrant.count(p.collection, count_filter=p.scope(), exact=True, shard_key_selector=p.shard_key)
+    return result.count
+
+
+async def record_point_count(chatbot_id: int) -> int:
+    count = await _count((await resolve(chatbot_id)).current)
+    await asyncio.to_thread(_update_row, int(chatbot_id), point_count=count)
+    return count
+
+
+async def placement_info(chatbot_id: int) -> dict:
+    state = await resolve(chatbot_id, fresh=True)
+    row = await asyncio.to_thread(_load_row, int(chatbot_id))
+    return {
+        "chatbot_id": int(chatbot_id),
+        "layout": state.current.layout,
+        "collection": state.current.collection,
+        "shard_key": state.current.shard_key,
+        "status": row.status if row else "active",
+        "target_layout": state.target.layout if state.target else None,
+        "point_count": row.point_count if row else 0,
+        "migrated_at": row.migrated_at if row else None,
+    }
+
+
+# ---- MIGRATION ----
+_background: Set[asyncio.Task] = set()  # API-started moves, referenced until done
+
+
+async def _copy_points(chatbot_id: int, source: Placement, target: Placement):
+    offset = None
+    while True:
+        records, offset = await aqdrant.scroll(
+            collection_name=source.collection,
+            scroll_filter=source.scope(),
+            limit=MIGRATION_PAGE,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+            shard_key_selector=source.shard_key,
+        )
+        if records:
+            points = [PointStruct(id=r.id, vector=r.vector, payload={**(r.payload or {}), "chatbotId": chatbot_id}) for r in records]
+            await aqdrant.upsert(collection_name=target.collection, points=points, shard_key_selector=target.shard_key)
+        if offset is None:
+            return
+
+
+async def _heartbeat(chatbot_id: int):
+    while True:
+        await asyncio.sleep(PLACEMENT_LEASE_S / 3)
+        try:
+            if not await asyncio.to_thread(_renew_lease, chatbot_id):
+                return
+        except Exception as e:
+            print(f"⚠️ Could not renew placement lease of chatbot {chatbot_id}: {e}")
+
+
+async def migrate(chatbot_id: int, layout: str):
+    """Move a chatbot's vectors to `layout` while it keeps serving reads and writes."""
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout!r}, expected one of {LAYOUTS}")
+    chatbot_id = int(chatbot_id)
+    await resolve(chatbot_id)  # makes sure the row exists
+    # 1) claim + dual-write in one step; nobody else (in any process) moves this bot now
+    if not await asyncio.to_thread(_claim_migration, chatbot_id, layout):
+        return
+    heartbeat = asyncio.create_task(_heartbeat(chatbot_id))
+    try:
+        state = await resolve(chatbot_id, fresh=True)
+        source = state.current
+        target = placement_for(chatbot_id, layout)
+        print(f"🚚 Moving chatbot {chatbot_id} vectors: {source.layout} -> {layout}")
+
+        # wait until every process has picked the dual-write state up
+        forget(chatbot_id)
+        await asyncio.sleep(PLACEMENT_CACHE_TTL)
+
+        # 2) copy
+        if await _exists(source):
+            info = await aqdrant.get_collection(source.collection)
+            await _ensure_storage(target, info.config.params.vectors.size)
+            await _copy_points(chatbot_id, source, target)
+
+            # 3) a point deleted from the source mid-copy may have been copied anyway
+            extra = (
+                await scroll_point_ids(target.collection, target.scope(), shard_key=target.shard_key)
+                - await scroll_point_ids(source.collection, source.scope(), shard_key=source.shard_key)
+            )
+            if extra:
+                await delete_point_ids(target.collection, extra, shard_key=target.shard_key)
+
+        # 4) flip reads, keep the old copy around for the grace period
+        await asyncio.to_thread(
+            _update_row, chatbot_id,
+            layout=layout, collection=target.collection, shard_key=target.shard_key,
+            status="active", target_layout=None, migrated_at=datetime.utcnow(),
+            owner=None, lease_until=None,
+        )
+        forget(chatbot_id)
+        await record_point_count(chatbot_id)
+        await asyncio.sleep(PLACEMENT_CACHE_TTL)
+
+        # 5) drop the old copy
+        if await _exists(source):
+            if source.layout == "dedicated":
+                await aqdrant.delete_collection(source.collection)
+                _ready.discard((source.collection, source.shard_key))
+            else:
+                await aqdrant.delete(
+                    collection_name=source.collection,
+                    points_selector=FilterSelector(filter=source.scope()),
+                    shard_key_selector=source.shard_key,
+                )
+                if source.shard_key is not None:
+                    await aqdrant.delete_shard_key(source.collection, shard_key=source.shard_key)
+                    _ready.discard((source.collection, source.shard_key))
+        print(f"✅ Chatbot {chatbot_id} now uses the {layout} layout")
+    except Exception as e:
+        print(f"❌ Moving chatbot {chatbot_id} to {layout} failed: {e}")
+        # reads never left the source; just stop dual-writing
+        await asyncio.to_thread(
+            _update_row, chatbot_id, status="active", target_layout=None, owner=None, lease_until=None
+        )
+        forget(chatbot_id)
+        raise
+    finally:
+        heartbeat.cancel()
+
+
+def _migration_done(task: asyncio.Task):
+    _background.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"❌ Background placement migration failed: {task.exception()}")
+
+
+def start_migration(chatbot_id: int, layout: str) -> asyncio.Task:
+    """Run migrate() in the background, keeping a reference so the task isn't collected mid-run."""
+    task = asyncio.create_task(migrate(chatbot_id, layout))
+    _background.add(task)
+    task.add_done_callback(_migration_done)
+    return task
+
+
+def _wanted_layout(layout: str, point_count: int) -> Optional[str]:
+    if layout == "shared" and point_count >= PLACEMENT_PROMOTE_AT_POINTS:
+        return "dedicated"
+    if layout == "dedicated" and point_count < PLACEMENT_DEMOTE_BELOW_POINTS:
+        return "shared"
+    return None
+
+
+async def rebalance_once():
+    """One pass over all placements: finish interrupted moves, then apply the size thresholds."""
+    for row in await asyncio.to_thread(_all_rows):
+        try:
+            if row.status == "migrating" and row.target_layout:
+                await migrate(row.chatbot_id, row.target_layout)
+                continue
+            count = await record_point_count(row.chatbot_id)
+            layout = _wanted_layout(row.layout, count)
+            if layout is not None:
+                await migrate(row.chatbot_id, layout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            continue  # logged by migrate(); try the next bot
+
+
+_migrator: Optional[asyncio.Task] = None
+
+
+async def _migrator_loop():
+    while True:
+        await rebalance_once()
+        await asyncio.sleep(PLACEMENT_CHECK_SECONDS)
+
+
+def start_placement_migrator():
+    global _migrator
+    _migrator = asyncio.create_task(_migrator_loop())
+
+
+async def stop_placement_migrator():
+    global _migrator
+    if _migrator is not None:
+        _migrator.cancel()
+        await asyncio.gather(_migrator, return_exceptions=True)
+        _migrator = None
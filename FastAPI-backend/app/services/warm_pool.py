@@ -0,0 +1,237 @@
+# app/services/warm_pool.py
+#
+# Keeps the models this service actually uses loaded on every Ollama backend.
+# - the generation models (OLLAMA_LLM_MODEL as seen by the chat and the training code) and
+#   the Ollama embedding model (EMBED_MODEL) are preloaded on each backend in OLLAMA_URLS
+#   with keep_alive=WARM_POOL_KEEP_ALIVE
+# - every WARM_POOL_INTERVAL_S each backend's /api/ps is checked: a model that is no longer
+#   listed was evicted (or the backend restarted) and is warmed again; one whose keep_alive
+#   is about to run out is touched so it stays resident
+# - per backend / model readiness is served by GET /ready, together with the local
+#   (SentenceTransformer) embedding models from model_registry
+import os
+import re
+import time
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from app.services.ollama_client import OLLAMA_URLS, OLLAMA_KEEP_ALIVE, ollama_post, ollama_get
+from app.services.ollama_service import LLM_MODEL as CHAT_MODEL
+from app.services.chatbot_service import LLM_MODEL as TRAINING_MODEL, EMBED_MODEL
+from app.services.model_registry import model_registry, WARM_EMBED_MODELS, EMBED_BACKEND
+from app.utils.metrics import counter, gauge, histogram, LATENCY_BUCKETS_S
+
+# ---- CONFIG ----
+WARM_POOL_ENABLED = os.getenv("WARM_POOL_ENABLED", "1") == "1"
+WARM_POOL_INTERVAL_S = float(os.getenv("WARM_POOL_INTERVAL_S", "30"))
+# "-1" keeps a model loaded until Ollama has to evict it; a duration ("2h") lets it expire
+WARM_POOL_KEEP_ALIVE = os.getenv("WARM_POOL_KEEP_ALIVE", OLLAMA_KEEP_ALIVE)
+# extra models to keep warm, as model or model:kind (kind = generate | embed)
+WARM_POOL_EXTRA_MODELS = [m.strip() for m in os.getenv("WARM_POOL_EXTRA_MODELS", "").split(",") if m.strip()]
+
+_warm_seconds = histogram("warm_pool_warm_seconds", LATENCY_BUCKETS_S, "time to (re)load a model on an Ollama backend")
+_rewarms = counter("warm_pool_rewarms_total", "models warmed again after an eviction or backend restart")
+_warm_failures = counter("warm_pool_warm_failures_total", "warm-up requests that failed")
+
+
+def _keep_alive_value(value: str):
+    # Ollama wants a number for "forever" (-1); durations stay strings
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _canonical(model: str) -> str:
+    return model if ":" in model else f"{model}:latest"
+
+
+def _parse_expiry(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    # Ollama sends nanoseconds; fromisoformat takes at most microseconds
+    value = re.sub(r"(\.\d{6})\d+", r"\1", value).replace("Z", "+00:00")
+    try:
+        return datetime.fromisoformat(value).astimezone(timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def _wanted_models() -> List[Tuple[str, str]]:
+    wanted = {CHAT_MODEL: "generate", TRAINING_MODEL: "generate", EMBED_MODEL: "embed"}
+    for entry in WARM_POOL_EXTRA_MODELS:
+        name, _, kind = entry.rpartition(":") if entry.endswith((":embed", ":generate")) else (entry, "", "")
+        wanted[name] = kind or "generate"
+    return sorted(wanted.items())
+
+
+@dataclass
+class ModelState:
+    backend: str
+    model: str
+    kind: str  # generate | embed
+    ready: bool = False
+    warm_count: int = 0
+    last_warmed: Optional[float] = None
+    warm_seconds: Optional[float] = None
+    expires_at: Optional[float] = None
+    error: Optional[str] = None
+
+    def info(self) -> dict:
+        return {
+            "ready": self.ready,
+            "kind": self.kind,
+            "warm_count": self.warm_count,
+            "warm_seconds": self.warm_seconds,
+            "expires_in_s": round(self.expires_at - time.time()) if self.expires_at else None,
+            "error": self.error,
+        }
+
+
+class WarmPool:
+    def __init__(self, backends: List[str], models: List[Tuple[str, str]]):
+        self._states: Dict[Tuple[str, str], ModelState] = {
+            (backend, model): ModelState(backend, model, kind)
+            for backend in backends
+            for model, kind in models
+        }
+        self._task: Optional[asyncio.Task] = None
+
+    def _backend_states(self, backend: str) -> List[ModelState]:
+        return [s for (b, _), s in self._states.items() if b == backend]
+
+    async def _warm(self, state: ModelState):
+        keep_alive = _keep_alive_value(WARM_POOL_KEEP_ALIVE)
+        started = time.perf_counter()
+        try:
+            if state.kind == "embed":
+                resp = await ollama_post(
+                    "warm", "/api/embed", {"model": state.model, "input": "warm", "keep_alive": keep_alive}, backend=state.backend
+                )
+                if resp.status_code == 404:
+                    # older Ollama only has /api/embeddings
+                    resp = await ollama_post(
+                        "warm", "/api/embeddings", {"model": state.model, "prompt": "warm", "keep_alive": keep_alive}, backend=state.backend
+                    )
+            else:
+                # an empty prompt loads the model without generating anything
+                resp = await ollama_post(
+                    "warm", "/api/generate", {"model": state.model, "keep_alive": keep_alive, "stream": False}, backend=state.backend
+                )
+            resp.raise_for_status()
+        except Exception as e:
+            _warm_failures.inc()
+            state.ready = False
+            state.error = str(e) or type(e).__name__
+            print(f"❌ Could not warm {state.model} on {state.backend}: {state.error}")
+            return
+
+        elapsed = time.perf_counter() - started
+        _warm_seconds.observe(elapsed)
+        state.ready = True
+        state.error = None
+        state.warm_count += 1
+        state.last_warmed = time.time()
+        state.warm_seconds = round(elapsed, 3)
+        print(f"🔥 Warmed {state.model} on {state.backend} in {elapsed:.2f}s")
+
+    async def check_backend(self, backend: str):
+        states = self._backend_states(backend)
+        try:
+            resp = await ollama_get("/api/ps", backend)
+        except Exception as e:
+            for state in states:
+                if state.ready:
+                    print(f"⚠️ Ollama backend {backend} unreachable ({e}); {state.model} marked not ready")
+                state.ready = False
+                state.error = f"backend unreachable: {e}"
+            return
+
+        if resp.status_code == 404:
+            # no /api/ps (old Ollama): eviction can't be seen, warm once and trust keep_alive
+            for state in states:
+                if not state.ready:
+                    await self._warm(state)
+            return
+
+        try:
+            loaded = {_canonical(m.get("name") or m.get("model", "")): m for m in resp.json().get("models", [])}
+        except Exception:
+            loaded = {}
+        for state in states:
+            entry = loaded.get(_canonical(state.model))
+            if entry is None:
+                if state.warm_count:
+                    _rewarms.inc()
+                    print(f"♻️ {state.model} is no longer loaded on {backend}; warming again")
+                await self._warm(state)
+                continue
+            state.ready = True
+            state.error = None
+            state.expires_at = _parse_expiry(entry.get("expires_at"))
+            # about to expire before the next check: touch it to restart keep_alive
+            if state.expires_at is not None and state.expires_at - time.time() < 2 * WARM_POOL_INTERVAL_S:
+                await self._warm(state)
+
+    async def check_all(self):
+        backends = sorted({b for b, _ in self._states})
+        await asyncio.gather(*(self.check_backend(b) for b in backends))
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Warm pool check failed: {e}")
+            await asyncio.sleep(WARM_POOL_INTERVAL_S)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def ready_count(self) -> int:
+        return sum(1 for s in self._states.values() if s.ready)
+
+    def readiness(self) -> dict:
+        """
+        ready: every Ollama model is loaded on at least one backend and every local
+        embedding model is in memory. Per-backend detail is included for each model.
+        """
+        models: Dict[str, dict] = {}
+        for (backend, model), state in sorted(self._states.items()) if WARM_POOL_ENABLED else ():
+            entry = models.setdefault(model, {"ready": False, "backends": {}})
+            entry["backends"][backend] = state.info()
+            entry["ready"] = entry["ready"] or state.ready
+
+        local = {
+            name.strip(): {"ready": model_registry.is_loaded(name.strip()), "backend": EMBED_BACKEND}
+            for name in WARM_EMBED_MODELS
+        }
+        ready = all(m["ready"] for m in models.values()) and all(m["ready"] for m in local.values())
+        return {"ready": ready, "ollama": models, "local": local}
+
+
+warm_pool = WarmPool(OLLAMA_URLS, _wanted_models())
+gauge("warm_pool_models_ready", "backend / model pairs currently loaded", fn=warm_pool.ready_count)
+
+
+def start_warm_pool():
+    if WARM_POOL_ENABLED:
+        warm_pool.start()
+
+
+async def stop_warm_pool():
+    await warm_pool.stop()
@@ -0,0 +1,70 @@
+# app/utils/memory.py
+import os
+import sys
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+MB = 1024 * 1024
+
+
+def current_rss_bytes() -> int:
+    """
+    Resident set size of this process right now.
+    Reads /proc on Linux, falls back to the peak value elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    """Highest RSS this process has ever reached (0 if the platform can't tell us)."""
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes on Linux
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+class RssTracker:
+    """
+    Tracks the peak RSS seen while a single job runs.
+    Call sample() at natural checkpoints (after each page / batch).
+    Parsing runs in pool workers, so their own peaks are reported separately
+    through add_worker_peak().
+    """
+
+    def __init__(self):
+        self.start = current_rss_bytes()
+        self.peak = self.start
+        self.worker_peak = 0
+        self.worker_calls = 0
+
+    def add_worker_peak(self, peak: int):
+        self.worker_calls += 1
+        if peak > self.worker_peak:
+            self.worker_peak = peak
+
+    def sample(self) -> int:
+        rss = current_rss_bytes()
+        if rss > self.peak:
+            self.peak = rss
+        return rss
+
+    def as_dict(self) -> dict:
+        self.sample()
+        return {
+            "rss_start_mb": round(self.start / MB, 1),
+            "rss_peak_mb": round(self.peak / MB, 1),
+            "rss_growth_mb": round((self.peak - self.start) / MB, 1),
+            "process_peak_rss_mb": round(peak_rss_bytes() / MB, 1),
+            # ru_maxrss of the pool workers that served this job (a worker's lifetime peak)
+            "parse_worker_peak_rss_mb": round(self.worker_peak / MB, 1),
+            "parse_worker_calls": self.worker_calls,
+        }
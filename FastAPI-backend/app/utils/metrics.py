@@ -0,0 +1,124 @@
+# app/utils/metrics.py
+#
+# Tiny in-process metrics registry (counters, gauges, histograms).
+# Everything registered here is exposed as JSON on GET /metrics.
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional
+
+_lock = threading.Lock()
+_registry: Dict[str, "Metric"] = {}
+
+
+class Metric(ABC):
+    kind = "metric"
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+
+    @abstractmethod
+    def snapshot(self):
+        ...
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str = ""):
+        super().__init__(name, description)
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        with _lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str = "", fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, description)
+        self.value = 0
+        self.fn = fn  # read lazily at snapshot time when given
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        with _lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with _lock:
+            self.value -= amount
+
+    def snapshot(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, buckets: List[float], description: str = ""):
+        super().__init__(name, description)
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot = +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        with _lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        cumulative, running = {}, 0
+        for bound, n in zip(self.buckets + ["+Inf"], self.counts):
+            running += n
+            cumulative[str(bound)] = running
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else None,
+            "buckets": cumulative,
+        }
+
+
+def _get_or_create(name: str, factory: Callable[[], Metric]) -> Metric:
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = factory()
+        return metric
+
+
+def counter(name: str, description: str = "") -> Counter:
+    return _get_or_create(name, lambda: Counter(name, description))
+
+
+def gauge(name: str, description: str = "", fn: Optional[Callable[[], float]] = None) -> Gauge:
+    return _get_or_create(name, lambda: Gauge(name, description, fn))
+
+
+def histogram(name: str, buckets: List[float], description: str = "") -> Histogram:
+    return _get_or_create(name, lambda: Histogram(name, buckets, description))
+
+
+# common bucket layouts
+LATENCY_BUCKETS_S = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+
+def snapshot() -> dict:
+    with _lock:
+        metrics = list(_registry.values())
+    return {
+        m.name: {"type": m.kind, "value": m.snapshot(), "description": m.description}
+        for m in sorted(metrics, key=lambda m: m.name)
+    }
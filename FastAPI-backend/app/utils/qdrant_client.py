@@ -1,31 +1,12 @@
-from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance
-import os
-from app.core.config import get_settings
-from dotenv import load_dotenv
+from qdrant_client import AsyncQdrantClient
+from app.services.qdrant_service import aqdrant
 
-load_dotenv()
-settings=get_settings()
+# kept for old imports: there is one shared async client, owned by qdrant_service
+qdrant_client = aqdrant
 
-QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", None)
 
-qdrant_client = QdrantClient(
-    url=settings.QDRANT_URL,
-    api_key=settings.QDRANT_API_KEY or None,
-    prefer_grpc=False
-)
-
-def get_qdrant() -> QdrantClient:
+def get_qdrant() -> AsyncQdrantClient:
     """
-    Returns a configured Qdrant client.
-    Uses environment variables for host and API key.
+    Returns the shared async Qdrant client (configured from settings in qdrant_service).
     """
-    try:
-        client = QdrantClient(
-            url=QDRANT_URL,
-            # api_key=QDRANT_API_KEY
-        )
-        return client
-    except Exception as e:
-        raise RuntimeError(f"Failed to connect to Qdrant: {str(e)}")
+    return aqdrant
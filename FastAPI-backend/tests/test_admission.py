@@ -0,0 +1,191 @@
+# tests/test_admission.py
+#
+# AdmissionController: weighted-fair ordering, per-backend slots, 429 / 503 thresholds and
+# slot accounting when a waiter gives up. backend_order / backend_stats are replaced so no
+# Ollama backend is involved.
+import asyncio
+
+import pytest
+
+from app.services import admission as admission_module
+from app.services.admission import AdmissionController, AdmissionRejected
+
+
+@pytest.fixture
+def backends():
+    return ["b1"]
+
+
+@pytest.fixture
+def controller(monkeypatch, backends):
+    monkeypatch.setattr(admission_module, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(admission_module, "ADMISSION_CONCURRENCY_PER_BACKEND", 1)
+    monkeypatch.setattr(admission_module, "ADMISSION_QUEUE_SIZE", 64)
+    monkeypatch.setattr(admission_module, "ADMISSION_TENANT_QUEUE_SHARE", 0.5)
+    monkeypatch.setattr(admission_module, "ADMISSION_COMPANY_WEIGHTS", {})
+    # affinity key "k2" prefers b2, everything else b1 first
+    monkeypatch.setattr(
+        admission_module, "backend_order", lambda key=None: sorted(backends, reverse=(key == "k2"))
+    )
+    monkeypatch.setattr(admission_module, "backend_stats", lambda: {url: {"available": True} for url in backends})
+    return AdmissionController()
+
+
+async def _queue(ctl: AdmissionController, tenant: str, affinity_key: str = None, max_wait: float = 60) -> asyncio.Task:
+    task = asyncio.create_task(ctl.acquire(tenant, affinity_key, max_wait=max_wait))
+    await asyncio.sleep(0)  # let it reach the queue before the next one
+    return task
+
+
+async def _drain(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_free_slot_is_granted_immediately(controller):
+    slot = await controller.acquire("1", max_wait=60)
+    assert slot.backend == "b1"
+    assert controller.active() == 1
+    assert controller.queue_depth() == 0
+    slot.release()
+    slot.release()  # idempotent
+    assert controller.active() == 0
+
+
+@pytest.mark.asyncio
+async def test_busy_tenant_does_not_starve_others(controller):
+    order = []
+
+    async def worker(tenant):
+        slot = await controller.acquire(tenant, max_wait=60)
+        order.append(tenant)
+        slot.release()
+
+    held = await controller.acquire("A", max_wait=60)
+    tasks = []
+    for tenant in ["A", "A", "A", "B"]:
+        tasks.append(asyncio.create_task(worker(tenant)))
+        await asyncio.sleep(0)
+    held.release()
+    await asyncio.gather(*tasks)
+    # B arrived last but its first request ties with A's first: it goes second
+    assert order == ["A", "B", "A", "A"]
+    assert controller.active() == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backends", [["b1", "b2"]])
+async def test_slots_are_bounded_per_backend(controller):
+    # the conversation's own backend first, the next one in its order when that is full
+    first = await controller.acquire("A", "k2", max_wait=60)
+    second = await controller.acquire("A", "k2", max_wait=60)
+    assert (first.backend, second.backend) == ("b2", "b1")
+    assert controller.active_by_backend() == {"b1": 1, "b2": 1}
+
+    # every backend is at its limit: the next request waits for one to free up
+    waiting = await _queue(controller, "B", "k1")
+    assert controller.queue_depth() == 1
+    first.release()
+    third = await waiting
+    assert third.backend == "b2"
+    assert controller.active_by_backend() == {"b1": 1, "b2": 1}
+    second.release()
+    third.release()
+    assert controller.active() == 0
+
+
+@pytest.mark.asyncio
+async def test_company_weights_shift_the_order(controller, monkeypatch):
+    monkeypatch.setattr(admission_module, "ADMISSION_COMPANY_WEIGHTS", {"B": 2.0})
+    order = []
+
+    async def worker(tenant):
+        slot = await controller.acquire(tenant, max_wait=60)
+        order.append(tenant)
+        slot.release()
+
+    held = await controller.acquire("A", max_wait=60)
+    tasks = []
+    for tenant in ["A", "A", "B", "B"]:
+        tasks.append(asyncio.create_task(worker(tenant)))
+        await asyncio.sleep(0)
+    held.release()
+    await asyncio.gather(*tasks)
+    # finish tags: A 1, 2 / B 0.5, 1
+    assert order == ["B", "A", "B", "A"]
+
+
+@pytest.mark.asyncio
+async def test_company_over_its_queue_share_gets_429(controller, monkeypatch):
+    monkeypatch.setattr(admission_module, "ADMISSION_QUEUE_SIZE", 4)  # share: 2 per company
+    held = await controller.acquire("A", max_wait=60)
+    tasks = [await _queue(controller, "A"), await _queue(controller, "A")]
+    with pytest.raises(AdmissionRejected) as rejected:
+        await controller.acquire("A", max_wait=60)
+    assert rejected.value.status_code == 429
+    assert int(rejected.value.headers["Retry-After"]) >= 1
+    # another company still gets in line
+    tasks.append(await _queue(controller, "B"))
+    assert controller.queue_depth() == 3
+    await _drain(tasks)
+    held.release()
+
+
+@pytest.mark.asyncio
+async def test_full_queue_gets_503(controller, monkeypatch):
+    monkeypatch.setattr(admission_module, "ADMISSION_QUEUE_SIZE", 2)
+    monkeypatch.setattr(admission_module, "ADMISSION_TENANT_QUEUE_SHARE", 1.0)
+    held = await controller.acquire("A", max_wait=60)
+    tasks = [await _queue(controller, "A"), await _queue(controller, "B")]
+    with pytest.raises(AdmissionRejected) as rejected:
+        await controller.acquire("C", max_wait=60)
+    assert rejected.value.status_code == 503
+    await _drain(tasks)
+    held.release()
+
+
+@pytest.mark.asyncio
+async def test_expected_wait_past_the_deadline_gets_503_up_front(controller):
+    held = await controller.acquire("A", max_wait=60)
+    controller._service_ewma = 5.0
+    with pytest.raises(AdmissionRejected) as rejected:
+        await controller.acquire("B", max_wait=1)
+    assert rejected.value.status_code == 503
+    assert controller.queue_depth() == 0
+    held.release()
+
+
+@pytest.mark.asyncio
+async def test_deadline_passing_in_the_queue_gets_503(controller):
+    held = await controller.acquire("A", max_wait=60)
+    controller._service_ewma = 0.001
+    with pytest.raises(AdmissionRejected) as rejected:
+        await controller.acquire("B", max_wait=0.05)
+    assert rejected.value.status_code == 503
+    assert controller.queue_depth() == 0
+    assert controller.active() == 1
+    held.release()
+    assert controller.active() == 0
+
+
+@pytest.mark.asyncio
+async def test_slot_granted_as_the_waiter_gives_up_is_handed_back(controller):
+    held = await controller.acquire("A", max_wait=60)
+    task = await _queue(controller, "B")
+    assert controller.queue_depth() == 1
+    # B gives up, and in the same tick the slot is granted to its waiter
+    task.cancel()
+    held.release()
+    service_estimate = controller._service_ewma
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert controller.active() == 0
+    assert controller.queue_depth() == 0
+    # the unused slot is no sample of how long a generation takes
+    assert controller._service_ewma == service_estimate
+    # the slot is really free again
+    slot = await controller.acquire("C", max_wait=60)
+    assert controller.active() == 1
+    slot.release()
@@ -0,0 +1,166 @@
+# tests/test_chat_writer.py
+#
+# ChatWriter: WAL rotation, replay of orphaned per-process logs, retention of rows when
+# the database is down, and row-by-row retry with dead letters. _insert is replaced so
+# no database is needed.
+import os
+import sys
+import json
+import glob
+import subprocess
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from app.services.chat_writer import ChatWriter
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.rows = []
+        self.down = False
+
+    async def insert(self, rows):
+        if self.down:
+            raise ConnectionError("database unavailable")
+        if any(row["message"] == "bad" for row in rows):
+            raise IntegrityError("INSERT INTO chats", {}, Exception("violates foreign key"))
+        self.rows.extend(rows)
+
+
+@pytest.fixture
+def db():
+    return FakeDatabase()
+
+
+@pytest.fixture
+def wal_path(tmp_path):
+    return str(tmp_path / "chat.wal")
+
+
+@pytest.fixture
+def writer(db, wal_path, tmp_path):
+    w = ChatWriter(wal_path=wal_path, dead_letter_path=str(tmp_path / "dead.jsonl"))
+    w._insert = db.insert
+    w._open_wal()
+    yield w
+    w._wal.close()
+
+
+def segments(wal_path):
+    return glob.glob(f"{wal_path}.*.seg")
+
+
+def dead_pid() -> int:
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def wal_line(message: str) -> str:
+    return json.dumps({
+        "visitor_session_id": 1,
+        "chatbot_id": 1,
+        "role": "visitor",
+        "message": message,
+        "created_at": "2024-01-01T00:00:00",
+    }) + "\n"
+
+
+@pytest.mark.asyncio
+async def test_rows_are_logged_then_rotated_and_removed_on_commit(writer, db, wal_path):
+    live = f"{wal_path}.{os.getpid()}.log"
+    writer.enqueue(1, 1, "visitor", "hi")
+    writer.enqueue(1, 1, "bot", "hello")
+    with open(live) as f:
+        assert len(f.readlines()) == 2
+
+    await writer.flush()
+    assert [row["message"] for row in db.rows] == ["hi", "hello"]
+    assert writer.buffered() == 0
+    assert segments(wal_path) == []
+    assert os.path.getsize(live) == 0  # a fresh log for the next rows
+
+
+@pytest.mark.asyncio
+async def test_rows_and_segments_are_kept_while_the_database_is_down(writer, db, wal_path):
+    writer.enqueue(1, 1, "visitor", "hi")
+    writer.enqueue(1, 1, "bot", "hello")
+    db.down = True
+    await writer.flush()
+    assert writer.buffered() == 2
+    assert len(segments(wal_path)) == 1
+
+    db.down = False
+    await writer.flush()
+    assert [row["message"] for row in db.rows] == ["hi", "hello"]
+    assert writer.buffered() == 0
+    assert segments(wal_path) == []
+
+
+@pytest.mark.asyncio
+async def test_rejected_row_is_dead_lettered_and_the_rest_written(writer, db, tmp_path):
+    for message in ["one", "bad", "two"]:
+        writer.enqueue(1, 1, "visitor", message)
+    await writer.flush()
+    assert [row["message"] for row in db.rows] == ["one", "two"]
+    assert writer.buffered() == 0
+    with open(tmp_path / "dead.jsonl") as f:
+        dead = [json.loads(line) for line in f]
+    assert [row["message"] for row in dead] == ["bad"]
+    assert "foreign key" in dead[0]["error"]
+
+
+@pytest.mark.asyncio
+async def test_full_buffer_drops_new_rows(db, tmp_path):
+    w = ChatWriter(wal_path="", dead_letter_path="", max_buffered=2)
+    w._insert = db.insert
+    for message in ["one", "two", "three"]:
+        w.enqueue(1, 1, "visitor", message)
+    assert w.buffered() == 2
+    await w.flush()
+    assert [row["message"] for row in db.rows] == ["one", "two"]
+    w.enqueue(1, 1, "visitor", "four")  # room again once drained
+    assert w.buffered() == 1
+
+
+@pytest.mark.asyncio
+async def test_recover_replays_only_files_of_dead_processes(db, wal_path, tmp_path):
+    gone = dead_pid()
+    with open(f"{wal_path}.{gone}.log", "w") as f:
+        f.write(wal_line("from log"))
+        f.write('{"torn": ')  # crash mid-write
+    with open(f"{wal_path}.{gone}.123.seg", "w") as f:
+        f.write(wal_line("from segment"))
+    live_owner = f"{wal_path}.{os.getppid()}.log"  # our parent is still running
+    with open(live_owner, "w") as f:
+        f.write(wal_line("not ours"))
+
+    w = ChatWriter(wal_path=wal_path, dead_letter_path=str(tmp_path / "dead.jsonl"))
+    w._insert = db.insert
+    await w.recover()
+
+    assert sorted(row["message"] for row in db.rows) == ["from log", "from segment"]
+    assert not os.path.exists(f"{wal_path}.{gone}.log")
+    assert segments(wal_path) == []
+    with open(live_owner) as f:
+        assert f.read() == wal_line("not ours")
+
+
+@pytest.mark.asyncio
+async def test_replayed_rows_survive_a_failed_replay(db, wal_path, tmp_path):
+    gone = dead_pid()
+    with open(f"{wal_path}.{gone}.log", "w") as f:
+        f.write(wal_line("pending"))
+
+    w = ChatWriter(wal_path=wal_path, dead_letter_path=str(tmp_path / "dead.jsonl"))
+    w._insert = db.insert
+    db.down = True
+    await w.recover()
+    assert w.buffered() == 1
+    assert len(segments(wal_path)) == 1  # claimed, kept until the rows are written
+
+    db.down = False
+    await w.flush()
+    assert [row["message"] for row in db.rows] == ["pending"]
+    assert segments(wal_path) == []
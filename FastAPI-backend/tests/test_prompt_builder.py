@@ -0,0 +1,113 @@
+# tests/test_prompt_builder.py
+#
+# Token budgeting in prompt_builder.assemble / _fit_history.
+# Tokens are counted as whitespace-separated words here so the numbers are exact
+# whether or not tiktoken is installed.
+import pytest
+
+from app.services import prompt_builder
+
+
+def words(n: int, word: str = "x") -> str:
+    return " ".join([word] * n)
+
+
+def turn(i: int) -> dict:
+    return {"query": f"q{i}", "answer": f"a{i}"}  # "User: q\nBot: a" = 4 words, +1 separator
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(prompt_builder, "count_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(
+        prompt_builder, "truncate_tokens", lambda text, n: " ".join(text.split()[:n]) + " …"
+    )
+    monkeypatch.setattr(prompt_builder, "PROMPT_CONTEXT_WINDOW", 200)
+    monkeypatch.setattr(prompt_builder, "PROMPT_RESERVED_OUTPUT", 0)
+    monkeypatch.setattr(prompt_builder, "PROMPT_CONTEXT_SHARE", 0.5)
+    monkeypatch.setattr(prompt_builder, "PROMPT_MAX_QUESTION_TOKENS", 20)
+    monkeypatch.setattr(prompt_builder, "PROMPT_MIN_TRUNCATED_TOKENS", 5)
+    monkeypatch.setattr(prompt_builder, "PROMPT_HISTORY_DROP_STEP", 4)
+
+
+# ---- _fit_history ----
+def test_fit_history_keeps_everything_that_fits():
+    history = [turn(i) for i in range(10)]
+    kept, used = prompt_builder._fit_history(history, 50)
+    assert kept == history
+    assert used == 50
+
+
+def test_fit_history_drops_oldest_turns_in_whole_steps():
+    history = [turn(i) for i in range(10)]
+    # 6 turns fit, 4 are dropped: exactly one step
+    kept, used = prompt_builder._fit_history(history, 32)
+    assert kept == history[4:]
+    assert used == 30
+    # 5 turns fit, 5 must go: rounded up to two steps, so the prefix only moves every 4 turns
+    kept, used = prompt_builder._fit_history(history, 28)
+    assert kept == history[8:]
+    assert used == 10
+
+
+def test_fit_history_empty():
+    assert prompt_builder._fit_history(None, 100) == ([], 0)
+    assert prompt_builder._fit_history([turn(0)], 0) == ([], 0)
+
+
+# ---- assemble ----
+def test_assemble_keeps_chunks_in_order_and_skips_duplicates():
+    chunks = [words(60, "a"), words(60, "b"), words(60, "a"), words(60, "c")]
+    parts = prompt_builder.assemble("sys", "q", chunks, template_overhead=0)
+    assert parts.context == [chunks[0], chunks[1], chunks[3]]
+    assert parts.chunk_indices == [0, 1, 3]
+    assert parts.report["chunks_dropped"] == 0
+    assert parts.report["chunk_truncated"] is False
+
+
+def test_assemble_truncates_the_first_chunk_that_does_not_fit():
+    chunks = [words(60, w) for w in "abcd"]
+    parts = prompt_builder.assemble("sys", "q", chunks, template_overhead=0)
+    # 198 tokens of room: three whole chunks, then 18 words of the fourth
+    assert parts.chunk_indices == [0, 1, 2, 3]
+    assert parts.context[3] == words(18, "d") + " …"
+    assert parts.report["chunk_truncated"] is True
+    assert parts.report["context"] == 198
+    assert parts.report["total"] == parts.report["budget"]
+
+
+def test_assemble_drops_a_chunk_when_too_little_of_it_would_fit(monkeypatch):
+    monkeypatch.setattr(prompt_builder, "PROMPT_MIN_TRUNCATED_TOKENS", 48)
+    chunks = [words(60, w) for w in "abcd"]
+    parts = prompt_builder.assemble("sys", "q", chunks, template_overhead=0)
+    assert parts.chunk_indices == [0, 1, 2]
+    assert parts.report["chunks_dropped"] == 1
+    assert parts.report["chunk_truncated"] is False
+
+
+def test_assemble_splits_the_budget_between_context_and_history():
+    chunks = [words(60, w) for w in "abcd"]
+    history = [turn(i) for i in range(10)]
+    parts = prompt_builder.assemble("sys", "q", chunks, history, template_overhead=0)
+    # history needs 50 of the 198 tokens; context gets the other 148
+    assert parts.history == history
+    assert parts.report["context"] == 148
+    assert parts.report["history"] == 50
+    assert parts.report["total"] <= parts.report["budget"]
+
+
+def test_assemble_history_gets_at_least_its_share():
+    chunks = [words(60, w) for w in "abcd"]
+    history = [turn(i) for i in range(40)]  # needs 200 tokens, more than the whole budget
+    parts = prompt_builder.assemble("sys", "q", chunks, history, template_overhead=0)
+    assert parts.report["context"] <= 99
+    assert parts.history == history[-len(parts.history):]
+    assert parts.report["history_turns_dropped"] == 40 - len(parts.history)
+    assert parts.report["total"] <= parts.report["budget"]
+
+
+def test_assemble_truncates_an_oversized_question():
+    parts = prompt_builder.assemble("sys", words(30, "w"), [], template_overhead=0)
+    assert parts.question == words(20, "w") + " …"
+    assert parts.report["question"] == 21
+    assert parts.context == []
@@ -0,0 +1,103 @@
+# tests/test_session_cache.py
+#
+# SessionCache: lookups by id and by visitor, TTL / expires_at, LRU eviction and
+# invalidation keeping the visitor index consistent.
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.services import session_cache as session_cache_module
+from app.services.session_cache import CachedSession, SessionCache
+
+
+def session(session_id: int, chatbot_id: int = 1, anonymous_id: str = None, expires_in_s: float = 3600) -> CachedSession:
+    return CachedSession(
+        id=session_id,
+        visitor_id=session_id,
+        chatbot_id=chatbot_id,
+        anonymous_id=anonymous_id,
+        expires_at=datetime.utcnow() + timedelta(seconds=expires_in_s),
+    )
+
+
+def test_lookup_by_id_checks_the_chatbot():
+    cache = SessionCache()
+    cache.put(session(1, chatbot_id=7))
+    assert cache.by_id(1, 7).id == 1
+    assert cache.by_id(1, 8) is None  # someone else's session id
+    assert cache.by_id(2, 7) is None
+
+
+def test_lookup_by_visitor():
+    cache = SessionCache()
+    cache.put(session(1, chatbot_id=7, anonymous_id="anon"))
+    assert cache.by_visitor(7, "anon").id == 1
+    assert cache.by_visitor(8, "anon") is None
+
+
+def test_newer_session_takes_over_the_visitor_key():
+    cache = SessionCache()
+    cache.put(session(1, anonymous_id="anon"))
+    cache.put(session(2, anonymous_id="anon"))
+    assert cache.by_visitor(1, "anon").id == 2
+    cache.invalidate(1)  # dropping the old session leaves the new mapping alone
+    assert cache.by_visitor(1, "anon").id == 2
+
+
+def test_expired_session_is_dropped():
+    cache = SessionCache()
+    cache.put(session(1, anonymous_id="anon", expires_in_s=-1))
+    assert cache.by_id(1, 1) is None
+    assert cache.by_visitor(1, "anon") is None
+    assert len(cache) == 0
+
+
+def test_entries_older_than_the_ttl_are_dropped(monkeypatch):
+    cache = SessionCache()
+    cache.put(session(1, anonymous_id="anon"))
+    assert cache.by_id(1, 1) is not None
+    monkeypatch.setattr(session_cache_module, "SESSION_CACHE_TTL_S", 0.0)
+    assert cache.by_id(1, 1) is None
+    assert cache.by_visitor(1, "anon") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = SessionCache(max_entries=2)
+    cache.put(session(1, anonymous_id="a"))
+    cache.put(session(2, anonymous_id="b"))
+    assert cache.by_id(1, 1) is not None  # 2 is now the least recently used
+    cache.put(session(3, anonymous_id="c"))
+    assert len(cache) == 2
+    assert cache.by_id(2, 1) is None
+    assert cache.by_visitor(1, "b") is None
+    assert cache.by_id(1, 1) is not None
+    assert cache.by_id(3, 1) is not None
+
+
+def test_invalidate_many_and_chatbot():
+    cache = SessionCache()
+    cache.put(session(1, chatbot_id=7, anonymous_id="a"))
+    cache.put(session(2, chatbot_id=7, anonymous_id="b"))
+    cache.put(session(3, chatbot_id=8, anonymous_id="c"))
+    cache.put(session(4, chatbot_id=8))
+
+    cache.invalidate_many([3, 99])
+    assert cache.by_visitor(8, "c") is None
+    assert len(cache) == 3
+
+    cache.invalidate_chatbot(7)
+    assert cache.by_visitor(7, "a") is None
+    assert cache.by_visitor(7, "b") is None
+    assert len(cache) == 1
+    assert cache.by_id(4, 8) is not None
+
+
+@pytest.mark.parametrize("expires_in_s", [None, 3600])
+def test_session_without_expiry_stays_until_the_ttl(expires_in_s):
+    cache = SessionCache()
+    entry = session(1)
+    if expires_in_s is None:
+        entry.expires_at = None
+    cache.put(entry)
+    assert cache.by_id(1, 1) is entry